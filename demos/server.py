@@ -9,23 +9,26 @@ import tornado.ioloop
 import tornado.web
 import tornado.gen as gen
 import torncache.client as memcached
+from torncache.memoize import Memoizer
 import time
 
 ccs = memcached.ClientPool(['127.0.0.1:11211'], size=100)
+memoize = Memoizer(ccs)
+
+
+@memoize(ttl=60)
+@gen.coroutine
+def hello():
+    time_str = time.strftime('%Y-%m-%d %H:%M:%S')
+    raise gen.Return('Hello world @ %s' % time_str)
 
 
 class MainHandler(tornado.web.RequestHandler):
 
-    @tornado.web.asynchronous
-    @gen.engine
+    @gen.coroutine
     def get(self):
-        test_data = yield gen.Task(ccs.get, 'test_data2')
-        if not test_data:
-            time_str = time.strftime('%Y-%m-%d %H:%M:%S')
-            yield gen.Task(ccs.set, 'test_data2', 'Hello world @ %s' % time_str)
-            test_data = yield gen.Task(ccs.get, 'test_data2')
+        test_data = yield hello()
         self.write(test_data)
-        self.finish()
 
 
 application = tornado.web.Application([
@@ -0,0 +1,142 @@
+# -*- mode: python; coding: utf-8 -*-
+
+"""
+Backpressure
+
+Bounds the number of commands in flight to a server and the number of
+commands waiting for a slot, so a slow memcached turns into fast misses
+instead of unbounded queues in the web process.
+"""
+
+import time
+import functools
+import collections
+
+from tornado import stack_context
+from tornado.ioloop import IOLoop
+
+# What to do with a command when the server has no free slot:
+#   fail:        reject it right away
+#   wait:        queue it, rejecting new commands when the queue is full
+#   drop_oldest: queue it, rejecting the oldest queued one if full
+POLICIES = ('fail', 'wait', 'drop_oldest')
+
+
+class Limiter(object):
+    """
+    Slots for commands to a single server.
+
+    Args:
+      max_inflight: int, commands admitted at once, or zero for no limit.
+      max_queue: int, commands waiting for a slot, or zero for no limit.
+      policy: str, one of POLICIES.
+      timeout: optional float, seconds a command may wait for a slot.
+
+    Commands call acquire(callback) and get callback(True) once admitted,
+    or callback(False) when rejected. Admitted commands must call
+    release() when done.
+    """
+
+    def __init__(self, max_inflight=0, max_queue=0, policy='wait',
+                 timeout=None, ioloop=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown policy: {0}".format(policy))
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.policy = policy
+        self.timeout = timeout
+        self.inflight = 0
+        self._ioloop = ioloop or IOLoop.instance()
+        self._queue = collections.deque()
+        self.stats = dict.fromkeys(
+            ('admitted', 'queued', 'rejected', 'dropped', 'expired'), 0)
+
+    @property
+    def waiting(self):
+        return len(self._queue)
+
+    def acquire(self, callback):
+        """Ask for a slot"""
+        if not self.max_inflight or self.inflight < self.max_inflight:
+            self.inflight += 1
+            self.stats['admitted'] += 1
+            callback(True)
+            return
+        if self.policy == 'fail':
+            self.stats['rejected'] += 1
+            callback(False)
+            return
+        if self.max_queue and len(self._queue) >= self.max_queue:
+            if self.policy == 'wait':
+                self.stats['rejected'] += 1
+                callback(False)
+                return
+            self.stats['dropped'] += 1
+            self._reject(self._queue.popleft())
+        # wait for a slot
+        waiter = [stack_context.wrap(callback), None]
+        if self.timeout:
+            waiter[1] = self._ioloop.add_timeout(
+                time.time() + self.timeout,
+                functools.partial(self._expire, waiter))
+        self._queue.append(waiter)
+        self.stats['queued'] += 1
+
+    def release(self):
+        """Give a slot back, handing it to the oldest waiter"""
+        if self._queue:
+            waiter = self._queue.popleft()
+            waiter[1] and self._ioloop.remove_timeout(waiter[1])
+            self.stats['admitted'] += 1
+            self._ioloop.add_callback(functools.partial(waiter[0], True))
+        else:
+            self.inflight -= 1
+
+    def _expire(self, waiter):
+        waiter[1] = None
+        self._queue.remove(waiter)
+        self.stats['expired'] += 1
+        waiter[0](False)
+
+    def _reject(self, waiter):
+        waiter[1] and self._ioloop.remove_timeout(waiter[1])
+        self._ioloop.add_callback(functools.partial(waiter[0], False))
+
+
+class Limits(object):
+    """
+    Limiter settings shared by every connection to a server.
+
+    Pass the same instance to all clients (ClientPool does it for you) so
+    limits apply per server across them. Arguments are those of Limiter.
+    """
+
+    def __init__(self, max_inflight=0, max_queue=0, policy='wait',
+                 timeout=None, ioloop=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown policy: {0}".format(policy))
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.policy = policy
+        self.timeout = timeout
+        self._ioloop = ioloop
+        self._limiters = {}
+
+    def limiter(self, host, max_inflight=None):
+        """Limiter of a host, created on first use"""
+        try:
+            return self._limiters[host]
+        except KeyError:
+            limiter = Limiter(
+                self.max_inflight if max_inflight is None else max_inflight,
+                self.max_queue, self.policy, self.timeout, self._ioloop)
+            return self._limiters.setdefault(host, limiter)
+
+    def stats(self):
+        """Counters and current load of every limiter"""
+        retval = {}
+        for host, limiter in self._limiters.items():
+            stats = dict(limiter.stats)
+            stats.update(inflight=limiter.inflight, waiting=limiter.waiting)
+            retval[host] = stats
+        return retval
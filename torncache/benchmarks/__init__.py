@@ -0,0 +1,10 @@
+# -*- mode: python; coding: utf-8 -*-
+
+"""
+Benchmarks
+
+Performance scenarios for torncache run against an in-process memcached
+stand-in, so no external service is required:
+
+    python -m torncache.benchmarks.runner --ops=5000 --latency=0.001
+"""
@@ -0,0 +1,226 @@
+# -*- mode: python; coding: utf-8 -*-
+
+"""
+Hot path microbenchmark
+
+Runs single commands back to back and reports microseconds per op, and
+the memory blocks allocated and still held by a command waiting for its
+reply: the request, its callbacks and anything they capture. Memory is
+traced with tracemalloc; on Python 2, which lacks it, the count is the
+growth of gc.get_objects() instead, which only sees container objects,
+and bytes are not reported. The fake server runs on its own thread and
+is paused while measuring, so only client allocations are counted.
+
+  python -m torncache.benchmarks.alloc --ops=20000
+"""
+
+from __future__ import absolute_import, print_function
+
+import gc
+import json
+import time
+import threading
+
+try:
+    import tracemalloc  # py3
+except ImportError:
+    tracemalloc = None
+
+from tornado import stack_context
+from tornado.ioloop import IOLoop
+
+from torncache.client import Client
+from torncache.benchmarks.server import start_server
+
+
+class Result(object):
+    """Cost of a single operation"""
+
+    def __init__(self, name, usecs, allocs, size=None):
+        self.name = name
+        self.usecs = usecs
+        self.allocs = allocs
+        self.size = size
+
+    def as_dict(self):
+        return {'usecs': self.usecs, 'allocs': self.allocs,
+                'bytes': self.size}
+
+    def __str__(self):
+        line = "{0:<24} {1:>8.1f} us/op {2:>8.1f} allocs/op".format(
+            self.name, self.usecs, self.allocs)
+        if self.size is not None:
+            line += " {0:>8.0f} bytes/op".format(self.size)
+        return line
+
+
+class Microbenchmark(object):
+    """A client on a private IOLoop, talking to a fake server thread"""
+
+    def __init__(self):
+        self.server_loop = IOLoop()
+        self.server, address = start_server(io_loop=self.server_loop)
+        self.thread = threading.Thread(target=self.server_loop.start)
+        self.thread.daemon = True
+        self.thread.start()
+        self.ioloop = IOLoop()
+        self.client = Client([address], ioloop=self.ioloop, timeout=10)
+
+    def close(self):
+        def stop():
+            self.server.stop()
+            self.server_loop.stop()
+        self.server_loop.add_callback(stop)
+        self.thread.join()
+        self.ioloop.close(all_fds=True)
+        self.server_loop.close(all_fds=True)
+
+    def _loop(self, operation, ops):
+        """Run operation ops times, each one once the previous is done"""
+        state = [ops]
+
+        def step(*args):
+            if not state[0]:
+                self.ioloop.stop()
+                return
+            state[0] -= 1
+            operation(step)
+
+        with stack_context.NullContext():
+            self.ioloop.add_callback(step)
+        self.ioloop.start()
+
+    def _pause_server(self):
+        """Block the server thread, returning a function resuming it"""
+        paused, resumed = threading.Event(), threading.Event()
+
+        def block():
+            paused.set()
+            resumed.wait()
+
+        self.server_loop.add_callback(block)
+        paused.wait()
+        return resumed.set
+
+    def _held(self, operation, count):
+        """
+        Allocations held by count commands waiting for their replies.
+
+        Returns:
+          A tuple of (allocations, bytes) per command. Allocations are
+          memory blocks, or objects without tracemalloc, and bytes None.
+        """
+        remaining = [count]
+
+        def done(*args):
+            remaining[0] -= 1
+            remaining[0] or self.ioloop.add_callback(self.ioloop.stop)
+
+        commands = [operation] * count
+        resume = self._pause_server()
+        gc.collect()
+        try:
+            with stack_context.NullContext():
+                if tracemalloc is not None:
+                    tracemalloc.start()
+                    for command in commands:
+                        command(done)
+                    snapshot = tracemalloc.take_snapshot()
+                    tracemalloc.stop()
+                    stats = snapshot.statistics('filename')
+                    allocs = sum(stat.count for stat in stats)
+                    size = float(sum(stat.size for stat in stats)) / count
+                else:
+                    before = len(gc.get_objects())
+                    for command in commands:
+                        command(done)
+                    allocs = len(gc.get_objects()) - before
+                    size = None
+        finally:
+            resume()
+        # let every reply arrive before the next scenario
+        self.ioloop.start()
+        return float(allocs) / count, size
+
+    def run(self, name, operation, ops):
+        """
+        Measure operation, invoked as operation(callback).
+
+        Timing and allocations are separate runs, as tracing slows down
+        everything it watches.
+        """
+        # warm up, so the connection is open when measuring
+        self._loop(operation, min(ops, 100))
+        started = time.time()
+        self._loop(operation, ops)
+        usecs = (time.time() - started) * 1e6 / ops
+        allocs, size = self._held(operation, min(ops, 1000))
+        return Result(name, usecs, allocs, size)
+
+
+def scenarios(ops):
+    """Yield a Result for every single command scenario"""
+    bench = Microbenchmark()
+    client = bench.client
+    keys = ['key{0}'.format(i) for i in range(10)]
+
+    def in_context(callback):
+        with stack_context.ExceptionStackContext(lambda *exc_info: False):
+            client.get('key0', callback=callback)
+
+    try:
+        client.set_many(dict((key, 'x' * 16) for key in keys))
+        yield bench.run(
+            'get', lambda cb: client.get('key0', callback=cb), ops)
+        yield bench.run('get in context', in_context, ops)
+        yield bench.run(
+            'get miss', lambda cb: client.get('missing', callback=cb), ops)
+        yield bench.run(
+            'get_many 10', lambda cb: client.get_many(keys, callback=cb), ops)
+        yield bench.run(
+            'set', lambda cb: client.set(
+                'key0', 'x' * 16, noreply=False, callback=cb), ops)
+        yield bench.run(
+            'set noreply', lambda cb: client.set(
+                'key0', 'x' * 16, callback=cb), ops)
+        yield bench.run(
+            'delete', lambda cb: client.delete(
+                'missing', noreply=False, callback=cb), ops)
+        yield bench.run(
+            'incr', lambda cb: client.incr('missing', 1, callback=cb), ops)
+    finally:
+        bench.close()
+
+
+def main():
+    from tornado.options import define, options, parse_command_line
+
+    define('ops', type=int, default=5000, help="operations per scenario")
+    define('json', type=str, default=None, help="write results to file")
+    define('baseline', type=str, default=None,
+           help="json file of a previous run to compare with")
+    parse_command_line()
+
+    reference = {}
+    if options.baseline:
+        with open(options.baseline) as fd:
+            reference = json.load(fd)
+
+    results = []
+    for result in scenarios(options.ops):
+        line = str(result)
+        if result.name in reference:
+            before = reference[result.name]
+            line += "  (was {0:.1f} us/op {1:.1f} allocs/op)".format(
+                before['usecs'], before['allocs'])
+        print(line)
+        results.append(result)
+
+    if options.json:
+        with open(options.json, 'w') as fd:
+            json.dump(dict((r.name, r.as_dict()) for r in results), fd,
+                      indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# -*- mode: python; coding: utf-8 -*-
+
+"""
+Key routing benchmark
+
+Times hashing.partition for every hasher on the scalar path and, for
+hashers with a vectorized counterpart, on the NumPy path, so the gain
+of the vectorized path can be checked on the machine at hand:
+
+  python -m torncache.benchmarks.routing --keys=5000 --buckets=8
+"""
+
+from __future__ import absolute_import, print_function
+
+import timeit
+
+from torncache import hashing
+
+
+class Result(object):
+    """Time to route a batch of keys"""
+
+    def __init__(self, name, path, msecs):
+        self.name = name
+        self.path = path
+        self.msecs = msecs
+
+    def __str__(self):
+        return "{0:<10} {1:<8} {2:>8.2f} ms".format(
+            self.name, self.path, self.msecs)
+
+
+def measure(keys, buckets, hasher, vectorized, number=10):
+    """Best time, in milliseconds, to partition keys"""
+    threshold = hashing.NUMPY_THRESHOLD
+    hashing.NUMPY_THRESHOLD = 0 if vectorized else float('inf')
+    try:
+        return min(timeit.repeat(
+            lambda: hashing.partition(keys, buckets, hasher),
+            number=number, repeat=3)) * 1000 / number
+    finally:
+        hashing.NUMPY_THRESHOLD = threshold
+
+
+def scenarios(count, nbuckets, number=10):
+    """Yield a Result for every hasher and routing path"""
+    keys = ['user:profile:{0}'.format(i) for i in range(count)]
+    buckets = list(range(nbuckets))
+    for name, hasher in sorted(hashing.HASHERS.items()):
+        yield Result(name, 'scalar',
+                     measure(keys, buckets, hasher, False, number))
+        if hashing.numpy is not None and hasher in hashing.VECTORIZED:
+            yield Result(name, 'numpy',
+                         measure(keys, buckets, hasher, True, number))
+
+
+def main():
+    from tornado.options import define, options, parse_command_line
+
+    define('keys', type=int, default=5000, help="keys per batch")
+    define('buckets', type=int, default=8, help="number of buckets")
+    parse_command_line()
+
+    for result in scenarios(options.keys, options.buckets):
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
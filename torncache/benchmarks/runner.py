@@ -0,0 +1,206 @@
+# -*- mode: python; coding: utf-8 -*-
+
+"""
+Benchmark runner
+
+Runs torncache against the in-process fake server and reports ops/s and
+p50/p99 latencies per scenario. Results can be stored as JSON and used as
+a baseline for later runs, failing when any scenario regresses beyond a
+tolerance.
+"""
+
+from __future__ import absolute_import, print_function
+
+import sys
+import json
+import time
+import functools
+
+from tornado.ioloop import IOLoop
+
+from torncache.client import ClientPool
+from torncache.benchmarks.server import start_server
+
+
+def percentile(samples, pct):
+    """Nearest rank percentile of a sorted list"""
+    if not samples:
+        return 0.0
+    index = int(round(pct / 100.0 * (len(samples) - 1)))
+    return samples[index]
+
+
+class Result(object):
+    """Outcome of a benchmark scenario"""
+
+    def __init__(self, name, ops, elapsed, latencies):
+        latencies = sorted(latencies)
+        self.name = name
+        self.ops = ops
+        self.ops_per_sec = ops / elapsed if elapsed else 0.0
+        self.p50 = percentile(latencies, 50)
+        self.p99 = percentile(latencies, 99)
+
+    def as_dict(self):
+        return {'ops': self.ops, 'ops_per_sec': self.ops_per_sec,
+                'p50': self.p50, 'p99': self.p99}
+
+    def __str__(self):
+        return "{0:<40} {1:>10.0f} ops/s  p50 {2:>8.3f} ms  p99 {3:>8.3f} ms"\
+            .format(self.name, self.ops_per_sec,
+                    self.p50 * 1000, self.p99 * 1000)
+
+
+class Benchmark(object):
+    """
+    Drive a scenario with a fixed concurrency on a private IOLoop.
+
+    Args:
+      servers: int, number of fake servers to start.
+      latency: optional float, reply latency of every fake server.
+      bandwidth: optional int, bytes per second of every fake server.
+    """
+
+    def __init__(self, servers=1, latency=0, bandwidth=0):
+        self.ioloop = IOLoop()
+        self.ioloop.make_current()
+        self.servers, self.addresses = [], []
+        for _ in range(servers):
+            server, address = start_server(
+                latency=latency, bandwidth=bandwidth, io_loop=self.ioloop)
+            self.servers.append(server)
+            self.addresses.append(address)
+
+    def pool(self, **kwargs):
+        kwargs.setdefault('timeout', 10)
+        return ClientPool(self.addresses, ioloop=self.ioloop, **kwargs)
+
+    def run(self, name, operation, ops, concurrency=1):
+        """
+        Run operation ops times keeping concurrency calls in flight.
+
+        Args:
+          operation: callable invoked as operation(i, callback).
+        """
+        def on_done(started, result=None):
+            latencies.append(time.time() - started)
+            state['done'] += 1
+            if state['done'] == ops:
+                self.ioloop.stop()
+            elif state['issued'] < ops:
+                issue()
+
+        def issue():
+            i = state['issued']
+            state['issued'] += 1
+            operation(i, functools.partial(on_done, time.time()))
+
+        latencies, state = [], {'issued': 0, 'done': 0}
+        started = time.time()
+        for _ in range(min(concurrency, ops)):
+            self.ioloop.add_callback(issue)
+        self.ioloop.start()
+        return Result(name, ops, time.time() - started, latencies)
+
+    def close(self):
+        for server in self.servers:
+            server.stop()
+        self.ioloop.close(all_fds=True)
+
+
+def _keys(count, prefix='key'):
+    return ['{0}:{1}'.format(prefix, i) for i in range(count)]
+
+
+def scenarios(ops, value_sizes, key_counts, concurrencies, **kwargs):
+    """Yield a Result for every configured scenario"""
+    for size in value_sizes:
+        bench = Benchmark(**kwargs)
+        pool = bench.pool()
+        value = 'x' * size
+        keys = _keys(max(key_counts))
+        # populate
+        bench.run('populate', lambda i, cb: pool.set(
+            keys[i], value, noreply=False, callback=cb), len(keys))
+
+        yield bench.run(
+            'get value={0}B'.format(size),
+            lambda i, cb: pool.get(keys[i % len(keys)], callback=cb), ops)
+
+        for count in key_counts:
+            batch = keys[:count]
+            yield bench.run(
+                'get_many keys={0} value={1}B'.format(count, size),
+                lambda i, cb: pool.get_many(batch, callback=cb),
+                max(ops // count, 1))
+            values = dict((key, value) for key in batch)
+            yield bench.run(
+                'set_many keys={0} value={1}B'.format(count, size),
+                lambda i, cb: pool.set_many(values, callback=cb),
+                max(ops // count, 1))
+
+        for concurrency in concurrencies:
+            yield bench.run(
+                'pool get concurrency={0} value={1}B'.format(
+                    concurrency, size),
+                lambda i, cb: pool.get(keys[i % len(keys)], callback=cb),
+                ops, concurrency)
+        bench.close()
+
+
+def compare(results, baseline, tolerance):
+    """Return scenarios whose throughput regressed beyond tolerance"""
+    regressions = []
+    for result in results:
+        reference = baseline.get(result.name)
+        if not reference:
+            continue
+        floor = reference['ops_per_sec'] * (1 - tolerance)
+        if result.ops_per_sec < floor:
+            regressions.append((result, reference))
+    return regressions
+
+
+def main():
+    from tornado.options import define, options, parse_command_line
+
+    define('ops', type=int, default=2000, help="operations per scenario")
+    define('servers', type=int, default=1, help="number of fake servers")
+    define('latency', type=float, default=0, help="server latency in secs")
+    define('bandwidth', type=int, default=0, help="server bytes/sec")
+    define('value_sizes', type=int, multiple=True, default=[16, 1024, 65536])
+    define('key_counts', type=int, multiple=True, default=[10, 100, 1000])
+    define('concurrency', type=int, multiple=True, default=[1, 8, 32])
+    define('json', type=str, default=None, help="write results to file")
+    define('baseline', type=str, default=None, help="baseline json file")
+    define('tolerance', type=float, default=0.2,
+           help="allowed throughput drop against baseline")
+    parse_command_line()
+
+    results = []
+    for result in scenarios(options.ops, options.value_sizes,
+                            options.key_counts, options.concurrency,
+                            servers=options.servers,
+                            latency=options.latency,
+                            bandwidth=options.bandwidth):
+        print(result)
+        results.append(result)
+
+    if options.json:
+        with open(options.json, 'w') as fd:
+            json.dump(dict((r.name, r.as_dict()) for r in results), fd,
+                      indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as fd:
+            regressions = compare(results, json.load(fd), options.tolerance)
+        for result, reference in regressions:
+            print("REGRESSION {0}: {1:.0f} ops/s, baseline {2:.0f} ops/s"
+                  .format(result.name, result.ops_per_sec,
+                          reference['ops_per_sec']))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,371 @@
+# -*- mode: python; coding: utf-8 -*-
+
+"""
+In-process memcached stand-in
+
+A tornado TCPServer speaking enough of the memcached text protocol to
+run torncache against it without an external service. Latency and
+throughput can be degraded on purpose to model slow or saturated nodes.
+"""
+
+from __future__ import absolute_import
+
+import os
+import time
+import socket
+import logging
+
+try:
+    from urllib import quote  # py2
+except ImportError:
+    from urllib.parse import quote  # py3
+
+from tornado import gen
+from tornado import iostream
+from tornado.ioloop import IOLoop
+from tornado.tcpserver import TCPServer
+
+# Relative expiration times are allowed up to 30 days
+RELATIVE_EXPIRE_LIMIT = 60 * 60 * 24 * 30
+
+STORE_COMMANDS = ('set', 'add', 'replace', 'append', 'prepend', 'cas')
+
+
+def _b(value):
+    """Coerce native strings to bytes"""
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('latin-1')
+
+
+class Item(object):
+    """A cached value"""
+
+    __slots__ = ('value', 'flags', 'expire', 'cas', 'access')
+
+    def __init__(self, value, flags, expire, cas):
+        self.value = value
+        self.flags = flags
+        self.expire = expire
+        self.cas = cas
+        self.access = time.time()
+
+    def expired(self, now):
+        return self.expire and self.expire <= now
+
+
+class MemcacheServer(TCPServer):
+    """
+    Fake memcached server.
+
+    Args:
+      latency: optional float, seconds to wait before every reply.
+      bandwidth: optional int, bytes per second replies are throttled to,
+                 or zero to not limit it (the default).
+    """
+
+    def __init__(self, latency=0, bandwidth=0, io_loop=None, **kwargs):
+        self.io_loop = io_loop or IOLoop.instance()
+        super(MemcacheServer, self).__init__(io_loop=self.io_loop, **kwargs)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.items = {}
+        self.stats = dict.fromkeys(
+            ('cmd_get', 'cmd_set', 'cmd_touch', 'get_hits', 'get_misses',
+             'evictions', 'curr_connections', 'total_connections'), 0)
+        self.started = time.time()
+        self._cas = 0
+
+    def handle_stream(self, stream, address):
+        def on_close():
+            self.stats['curr_connections'] -= 1
+
+        self.stats['curr_connections'] += 1
+        self.stats['total_connections'] += 1
+        stream.set_close_callback(on_close)
+        _Session(self, stream).run()
+
+    def next_cas(self):
+        self._cas += 1
+        return self._cas
+
+    def lookup(self, key, now=None):
+        """Fetch a live item or None"""
+        item = self.items.get(key)
+        if item is not None and item.expired(now or time.time()):
+            del self.items[key]
+            item = None
+        return item
+
+    def absolute(self, expire):
+        """Convert a protocol exptime into an absolute timestamp"""
+        expire = int(expire)
+        if expire < 0:
+            return -1
+        if expire and expire <= RELATIVE_EXPIRE_LIMIT:
+            return time.time() + expire
+        return expire
+
+    def reply_delay(self, size):
+        """Seconds a reply of size bytes must wait before being sent"""
+        delay = self.latency
+        if self.bandwidth:
+            delay += float(size) / self.bandwidth
+        return delay
+
+
+class _Session(object):
+    """A connection to the fake server"""
+
+    def __init__(self, server, stream):
+        self.server = server
+        self.stream = stream
+
+    @gen.engine
+    def run(self):
+        stream = self.stream
+        try:
+            while not stream.closed():
+                line = yield gen.Task(stream.read_until, b'\r\n')
+                args = line.split()
+                if not args:
+                    continue
+                name = args[0].decode('latin-1')
+                handler = getattr(self, 'cmd_' + name, None)
+                try:
+                    if handler is None:
+                        reply = b'ERROR\r\n'
+                    elif name in STORE_COMMANDS:
+                        data = yield gen.Task(
+                            stream.read_bytes, int(args[4]) + 2)
+                        reply = handler(args[1:], data[:-2])
+                    else:
+                        reply = handler(args[1:])
+                except (ValueError, IndexError):
+                    reply = b'CLIENT_ERROR bad command line format\r\n'
+                if reply is None:
+                    stream.close()
+                    break
+                if args[-1] == b'noreply':
+                    continue
+                delay = self.server.reply_delay(len(reply))
+                if delay:
+                    yield gen.Task(
+                        self.server.io_loop.add_timeout, time.time() + delay)
+                yield gen.Task(stream.write, reply)
+        except iostream.StreamClosedError:
+            pass
+
+    def _fetch(self, keys, with_cas, touch=None):
+        server, now = self.server, time.time()
+        stats = server.stats
+        retval = []
+        for key in keys:
+            stats['cmd_get'] += 1
+            item = server.lookup(key, now)
+            if item is None:
+                stats['get_misses'] += 1
+                continue
+            stats['get_hits'] += 1
+            item.access = now
+            if touch is not None:
+                item.expire = touch
+            header = [b'VALUE', key, _b(item.flags), _b(len(item.value))]
+            with_cas and header.append(_b(item.cas))
+            retval.extend((b' '.join(header), b'\r\n', item.value, b'\r\n'))
+        retval.append(b'END\r\n')
+        return b''.join(retval)
+
+    def cmd_get(self, args):
+        return self._fetch(args, False)
+
+    def cmd_gets(self, args):
+        return self._fetch(args, True)
+
+    def cmd_gat(self, args):
+        self.server.stats['cmd_touch'] += 1
+        return self._fetch(args[1:], False, self.server.absolute(args[0]))
+
+    def cmd_gats(self, args):
+        self.server.stats['cmd_touch'] += 1
+        return self._fetch(args[1:], True, self.server.absolute(args[0]))
+
+    def _store(self, name, args, data):
+        server = self.server
+        server.stats['cmd_set'] += 1
+        key, flags, expire = args[0], int(args[1]), server.absolute(args[2])
+        item = server.lookup(key)
+        if name == 'add' and item is not None:
+            return b'NOT_STORED\r\n'
+        if name in ('replace', 'append', 'prepend') and item is None:
+            return b'NOT_STORED\r\n'
+        if name == 'cas':
+            if item is None:
+                return b'NOT_FOUND\r\n'
+            if item.cas != int(args[4]):
+                return b'EXISTS\r\n'
+        if name == 'append':
+            data, flags, expire = item.value + data, item.flags, item.expire
+        elif name == 'prepend':
+            data, flags, expire = data + item.value, item.flags, item.expire
+        if expire != -1:
+            server.items[key] = Item(data, flags, expire, server.next_cas())
+        else:
+            server.items.pop(key, None)
+        return b'STORED\r\n'
+
+    def cmd_set(self, args, data):
+        return self._store('set', args, data)
+
+    def cmd_add(self, args, data):
+        return self._store('add', args, data)
+
+    def cmd_replace(self, args, data):
+        return self._store('replace', args, data)
+
+    def cmd_append(self, args, data):
+        return self._store('append', args, data)
+
+    def cmd_prepend(self, args, data):
+        return self._store('prepend', args, data)
+
+    def cmd_cas(self, args, data):
+        return self._store('cas', args, data)
+
+    def cmd_delete(self, args):
+        if self.server.lookup(args[0]) is None:
+            return b'NOT_FOUND\r\n'
+        del self.server.items[args[0]]
+        return b'DELETED\r\n'
+
+    def _delta(self, args, sign):
+        item = self.server.lookup(args[0])
+        if item is None:
+            return b'NOT_FOUND\r\n'
+        try:
+            value = max(int(item.value) + sign * int(args[1]), 0)
+        except ValueError:
+            return (b'CLIENT_ERROR cannot increment or decrement '
+                    b'non-numeric value\r\n')
+        item.value, item.cas = _b(value), self.server.next_cas()
+        return item.value + b'\r\n'
+
+    def cmd_incr(self, args):
+        return self._delta(args, 1)
+
+    def cmd_decr(self, args):
+        return self._delta(args, -1)
+
+    def cmd_touch(self, args):
+        self.server.stats['cmd_touch'] += 1
+        item = self.server.lookup(args[0])
+        if item is None:
+            return b'NOT_FOUND\r\n'
+        item.expire = self.server.absolute(args[1])
+        return b'TOUCHED\r\n'
+
+    def cmd_stats(self, args):
+        server = self.server
+        if args and args[0] == b'settings':
+            stats = {'maxconns': 1024, 'evictions': 'on',
+                     'growth_factor': '1.25', 'cas_enabled': 'yes'}
+        elif args and args[0] == b'slabs':
+            # a single slab class holding every item
+            stats = {'1:chunk_size': 96, '1:used_chunks': len(server.items),
+                     '1:get_hits': server.stats['get_hits'],
+                     'active_slabs': 1, 'total_malloced': 1048576}
+        elif args and args[0] == b'items':
+            stats = {'items:1:number': len(server.items),
+                     'items:1:evicted': 0, 'items:1:age': 0}
+        elif args:
+            stats = {}
+        else:
+            stats = dict(server.stats)
+            stats.update({
+                'pid': os.getpid(),
+                'uptime': int(time.time() - server.started),
+                'time': int(time.time()),
+                'version': '1.4.torncache',
+                'curr_items': len(server.items),
+                'bytes': sum(len(i.value) for i in server.items.values()),
+            })
+        lines = [b'STAT ' + _b(k) + b' ' + _b(v) + b'\r\n'
+                 for k, v in sorted(stats.items())]
+        lines.append(b'END\r\n')
+        return b''.join(lines)
+
+    def cmd_flush_all(self, args):
+        delay = int(args[0]) if args and args[0].isdigit() else 0
+        if delay:
+            expire = time.time() + delay
+            for item in self.server.items.values():
+                item.expire = min(item.expire or expire, expire)
+        else:
+            self.server.items.clear()
+        return b'OK\r\n'
+
+    def cmd_lru_crawler(self, args):
+        if len(args) != 2 or args[0] != b'metadump':
+            return b'ERROR\r\n'
+        if args[1] != b'all' and b'1' not in args[1].split(b','):
+            return b'END\r\n'
+        now, lines = time.time(), []
+        for key, item in list(self.server.items.items()):
+            if item.expired(now):
+                continue
+            expire = int(item.expire) if item.expire else -1
+            lines.append(b''.join((
+                b'key=', _b(quote(key)), b' exp=', _b(expire),
+                b' la=', _b(int(item.access)), b' cas=', _b(item.cas),
+                b' fetch=no cls=1 size=', _b(len(key) + len(item.value)),
+                b'\r\n')))
+        lines.append(b'END\r\n')
+        return b''.join(lines)
+
+    def cmd_version(self, args):
+        return b'VERSION 1.4.torncache\r\n'
+
+    def cmd_verbosity(self, args):
+        return b'OK\r\n'
+
+    def cmd_quit(self, args):
+        return None
+
+
+def start_server(port=0, address='127.0.0.1', **kwargs):
+    """
+    Start a fake server on the current IOLoop.
+
+    Args:
+      port: optional int, port to listen on or zero to pick an unused one.
+      **kwargs: MemcacheServer arguments.
+
+    Returns:
+      A tuple of (server, "host:port").
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((address, port))
+    sock.listen(128)
+    sock.setblocking(0)
+    server = MemcacheServer(**kwargs)
+    server.add_sockets([sock])
+    return server, "{0}:{1}".format(*sock.getsockname()[:2])
+
+
+def main():
+    from tornado.options import define, options, parse_command_line
+
+    define('port', type=int, default=11211, help="port to listen on")
+    define('latency', type=float, default=0, help="reply latency in secs")
+    define('bandwidth', type=int, default=0, help="bytes/sec, 0 for no limit")
+    parse_command_line()
+
+    _, address = start_server(
+        options.port, latency=options.latency, bandwidth=options.bandwidth)
+    logging.info("Fake memcached listening on %s", address)
+    IOLoop.instance().start()
+
+
+if __name__ == '__main__':
+    main()
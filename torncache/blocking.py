@@ -0,0 +1,391 @@
+# -*- mode: python; coding: utf-8 -*-
+
+"""
+Blocking client
+
+A synchronous client for scripts and batch jobs running without an
+IOLoop. It parses servers, routes keys and serializes values exactly
+like Client, so both read and write the same keys, and uses pools of
+plain sockets where multi-key commands are pipelined per server.
+"""
+
+import time
+import socket
+import threading
+
+from torncache import hashing
+from torncache.client import (
+    Client, ClientPool, Connection, STORE_RESULTS, VALID_STORE_RESULTS,
+    MemcacheClientError, MemcacheUnknownError, MemcacheUnexpectedCloseError,
+    _ascii, _native)
+
+
+class BlockingConnection(Connection):
+    """
+    A pool of blocking sockets to a server.
+
+    Args:
+      max_sockets: optional int, idle sockets kept open for reuse.
+
+    Other arguments are those of Connection.
+    """
+
+    __slots__ = ('_max_sockets', '_sockets', '_lock')
+
+    def __init__(self, host, max_sockets=4, **kwargs):
+        Connection.__init__(self, host, **kwargs)
+        self._max_sockets = max_sockets
+        self._sockets = []
+        self._lock = threading.Lock()
+
+    def _checkout(self):
+        """Fetch an idle socket, or open a new one"""
+        with self._lock:
+            if self._sockets:
+                return self._sockets.pop()
+        # Check if server is dead
+        if self._dead_until > time.time():
+            msg = "Server {0} will stay dead next {1} secs"
+            msg = msg.format(self, self._dead_until - time.time())
+            raise MemcacheClientError(msg)
+        self._dead_until = 0
+        # now connect
+        sock = socket.create_connection(
+            (self.ip, self.port), self._connect_timeout)
+        sock.settimeout(self._request_timeout)
+        if self._no_delay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, sock.makefile('rb')
+
+    def _checkin(self, conn):
+        with self._lock:
+            if len(self._sockets) < self._max_sockets:
+                self._sockets.append(conn)
+                return
+        self._discard(conn)
+
+    @staticmethod
+    def _discard(conn):
+        conn[1].close()
+        conn[0].close()
+
+    def _readline(self, rfile, name):
+        line = rfile.readline()
+        if not line.endswith(b'\r\n'):
+            raise MemcacheUnexpectedCloseError(name)
+        line = line[:-2]
+        self._raise_errors(line, name)
+        return line
+
+    def execute(self, cmds, name, reader=None, default=None):
+        """
+        Send cmds in a single write and parse the replies.
+
+        Args:
+          cmds: list of fully formatted commands.
+          reader: optional callable invoked as reader(readline, rfile)
+                  once everything is sent, where readline() returns the
+                  next reply line and rfile is the socket file, to read
+                  values. Missing for noreply commands.
+          default: result on errors, if ignore_exc is set.
+
+        Returns:
+          What reader returns, or True if there's no reader.
+        """
+        try:
+            conn = self._checkout()
+        except (IOError, OSError) as err:
+            self.mark_dead(str(err))
+            if self._ignore_exc:
+                return default
+            raise
+        except MemcacheClientError:
+            if self._ignore_exc:
+                return default
+            raise
+
+        try:
+            conn[0].sendall(b''.join(cmds))
+            if reader is None:
+                result = True
+            else:
+                result = reader(lambda: self._readline(conn[1], name), conn[1])
+        except Exception as err:
+            # replies may be left on the socket, so drop it
+            self._discard(conn)
+            if isinstance(err, (IOError, OSError)):
+                self.mark_dead(str(err))
+            if self._ignore_exc:
+                return default
+            raise
+        self._checkin(conn)
+        return result
+
+    def fetch(self, name, keys, expect_cas):
+        """Run a retrieval command. See Connection.fetch_cmd"""
+        def reader(readline, rfile):
+            result, items = {}, []
+            while True:
+                line = readline()
+                if line == b'END':
+                    break
+                elif line.startswith(b'VALUE'):
+                    if expect_cas:
+                        _, key, flags, size, cas = line.split()
+                    else:
+                        _, key, flags, size = line.split()
+                    # read also \r\n
+                    value = rfile.read(int(size) + 2)
+                    if len(value) != int(size) + 2:
+                        raise MemcacheUnexpectedCloseError(name)
+                    key = names.get(key, key)
+                    if self._deserialize_many:
+                        items.append((key, value[:-2], int(flags)))
+                        result[key] = expect_cas and cas
+                        continue
+                    value = self._decode(key, value[:-2], int(flags))
+                    result[key] = (value, cas) if expect_cas else value
+                elif name == 'stats' and line.startswith(b'STAT'):
+                    _, key, value = _native(line).split(' ', 2)
+                    result[key] = value
+                else:
+                    raise MemcacheUnknownError(line[:32])
+            if items:
+                for key, value in self._decode_many(items).items():
+                    result[key] = (value, result[key]) if expect_cas \
+                        else value
+            return result
+
+        names = dict((self.encode_key(key), key) for key in keys)
+        cmd = b''.join((_ascii(name), b' ', b' '.join(names), b'\r\n'))
+        return self.execute([cmd], name, reader, {})
+
+    def store(self, name, items, expire, noreply, cas=None):
+        """
+        Pipeline storage commands.
+
+        Args:
+          items: list of (key, value) pairs.
+
+        Returns:
+          A dict of key to result, as Client.set would return it.
+        """
+        def reader(readline, rfile):
+            result = {}
+            for key, _ in items:
+                line = readline()
+                if line not in VALID_STORE_RESULTS[name]:
+                    raise MemcacheUnknownError(line[:32])
+                result[key] = STORE_RESULTS[line]
+            return result
+
+        cmds = [self.build_store(name, key, expire, noreply, value, cas)[0]
+                for key, value in items]
+        if noreply:
+            sent = self.execute(cmds, name)
+            return dict((key, sent) for key, _ in items)
+        return self.execute(cmds, name, reader, {})
+
+    def misc(self, cmds, name, noreply):
+        """Pipeline commands answered with a single line each"""
+        if noreply:
+            return [self.execute(cmds, name)] * len(cmds)
+        return self.execute(
+            cmds, name, lambda readline, rfile: [readline() for _ in cmds],
+            [None] * len(cmds))
+
+    def close(self):
+        """Close every idle socket"""
+        with self._lock:
+            sockets, self._sockets = self._sockets, []
+        for conn in sockets:
+            self._discard(conn)
+
+    def closed(self):
+        return not self._sockets
+
+
+class BlockingClient(object):
+    """
+    A synchronous memcached client.
+
+    Args:
+      servers: servers in any form accepted by ClientPool.
+      max_sockets: optional int, idle sockets kept per server.
+
+    Other arguments are those of Client. Keys are routed, and values
+    serialized, exactly as Client does, so use the same hasher and
+    serializer than the applications sharing the cache. It's safe to
+    use from several threads.
+    """
+
+    def __init__(self, servers, serializer=None, deserializer=None,
+                 connect_timeout=5, timeout=1, no_delay=True,
+                 ignore_exc=True, dead_retry=30, hasher='crc32',
+                 hash_long_keys=False, max_sockets=4, deserialize_many=None):
+        self._hasher = hashing.get_hasher(hasher)
+        self._servers = []
+        self._buckets = []
+        for server in ClientPool._parse_servers(servers):
+            server = BlockingConnection(
+                server, max_sockets=max_sockets, serializer=serializer,
+                deserializer=deserializer, connect_timeout=connect_timeout,
+                timeout=timeout, no_delay=no_delay, ignore_exc=ignore_exc,
+                dead_retry=dead_retry, hash_long_keys=hash_long_keys,
+                deserialize_many=deserialize_many)
+            for i in range(server.weight):
+                self._buckets.append(server)
+            self._servers.append(server)
+
+    # Same key routing than Client
+    _get_server = Client.__dict__['_get_server']
+    _route = Client.__dict__['_route']
+    _find_server = Client.__dict__['_find_server']
+
+    def _store(self, name, key, value, expire, noreply, cas=None):
+        server, key = self._get_server(key)
+        if not server:
+            return None
+        return server.store(name, [(key, value)], expire, noreply, cas)\
+            .get(key)
+
+    def _store_many(self, name, values, expire, noreply):
+        retval = {}
+        for server, keys in self._route(list(values)).items():
+            items = [(key, values[key]) for key in keys]
+            result = server.store(name, items, expire, noreply)
+            for key, _ in items:
+                retval[key] = result.get(key)
+        return retval
+
+    def set(self, key, value, expire=0, noreply=True):
+        """The memcached "set" command. See Client.set"""
+        return self._store('set', key, value, expire, noreply)
+
+    def set_many(self, values, expire=0, noreply=True):
+        """
+        Set many values, pipelined in a single write per server.
+
+        Returns:
+          A dict of key to result, see Client.set_many.
+        """
+        return self._store_many('set', values, expire, noreply)
+
+    def add(self, key, value, expire=0, noreply=True):
+        """The memcached "add" command. See Client.add"""
+        return self._store('add', key, value, expire, noreply)
+
+    def add_many(self, values, expire=0, noreply=True):
+        """Pipelined "add" of many values, useful to warm up caches"""
+        return self._store_many('add', values, expire, noreply)
+
+    def replace(self, key, value, expire=0, noreply=True):
+        """The memcached "replace" command. See Client.replace"""
+        return self._store('replace', key, value, expire, noreply)
+
+    def append(self, key, value, expire=0, noreply=True):
+        """The memcached "append" command. See Client.append"""
+        return self._store('append', key, value, expire, noreply)
+
+    def prepend(self, key, value, expire=0, noreply=True):
+        """The memcached "prepend" command. See Client.prepend"""
+        return self._store('prepend', key, value, expire, noreply)
+
+    def cas(self, key, value, cas, expire=0, noreply=False):
+        """The memcached "cas" command. See Client.cas"""
+        return self._store('cas', key, value, expire, noreply, cas)
+
+    def get(self, key):
+        """The value of key, or None if it wasn't found"""
+        server, key = self._get_server(key)
+        if not server:
+            return None
+        return server.fetch('get', [key], False).get(key)
+
+    def get_many(self, keys):
+        """A dict with the values found for keys. See Client.get_many"""
+        retval = {}
+        for server, keys in self._route(keys).items():
+            retval.update(server.fetch('get', keys, False))
+        return retval
+
+    def gets(self, key):
+        """A tuple of (value, cas), or (None, None) if key wasn't found"""
+        server, key = self._get_server(key)
+        if not server:
+            return None, None
+        return server.fetch('gets', [key], True).get(key, (None, None))
+
+    def gets_many(self, keys):
+        """A dict of key to (value, cas) tuples. See Client.gets_many"""
+        retval = {}
+        for server, keys in self._route(keys).items():
+            retval.update(server.fetch('gets', keys, True))
+        return retval
+
+    def _misc_many(self, name, keys, args, noreply):
+        """Pipeline '<name> <key><args>' commands for every key"""
+        retval = {}
+        head = _ascii(name + ' ')
+        tail = _ascii(args + (' noreply' if noreply else '') + '\r\n')
+        for server, keys in self._route(keys).items():
+            cmds = [head + server.encode_key(key) + tail for key in keys]
+            retval.update(zip(keys, server.misc(cmds, name, noreply)))
+        return retval
+
+    def delete(self, key, noreply=True):
+        """The memcached "delete" command. See Client.delete"""
+        return self.delete_many([key], noreply).popitem()[1]
+
+    def delete_many(self, keys, noreply=True):
+        """
+        Delete many keys, pipelined in a single write per server.
+
+        Returns:
+          A dict of key to True if it was deleted, False if it wasn't
+          found, or None on errors.
+        """
+        result = self._misc_many('delete', keys, '', noreply)
+        if noreply:
+            return result
+        return dict((key, line and line.startswith(b'DELETED'))
+                    for key, line in result.items())
+
+    def _counter(self, name, key, value, noreply):
+        args = ' {0}'.format(value)
+        line = self._misc_many(name, [key], args, noreply).popitem()[1]
+        if noreply or line is None:
+            return None
+        return False if line.startswith(b'NOT_FOUND') else int(line)
+
+    def incr(self, key, value, noreply=False):
+        """The memcached "incr" command. See Client.incr"""
+        return self._counter('incr', key, value, noreply)
+
+    def decr(self, key, value, noreply=False):
+        """The memcached "decr" command. See Client.decr"""
+        return self._counter('decr', key, value, noreply)
+
+    def touch(self, key, expire=0, noreply=True):
+        """The memcached "touch" command. See Client.touch"""
+        args = ' {0}'.format(expire)
+        line = self._misc_many('touch', [key], args, noreply).popitem()[1]
+        if noreply:
+            return line
+        return line and line.startswith(b'TOUCHED')
+
+    def flush_all(self, delay=0, noreply=True):
+        """Flush every server. Returns a dict of server to result"""
+        cmd = _ascii('flush_all {0}{1}\r\n'.format(
+            delay, ' noreply' if noreply else ''))
+        retval = {}
+        for server in self._servers:
+            line = server.misc([cmd], 'flush_all', noreply)[0]
+            retval[str(server)] = line if noreply else \
+                bool(line and line.startswith(b'OK'))
+        return retval
+
+    def close(self):
+        """Close every idle socket"""
+        for server in self._servers:
+            server.close()
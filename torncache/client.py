@@ -4,11 +4,14 @@
 Tornado Memcached
 """
 
+import re
 import weakref
 import socket
 import time
+import math
+import random
+import hashlib
 import logging
-import itertools
 import functools
 import collections
 
@@ -21,30 +24,147 @@ except ImportError:
 
 from tornado import iostream
 from tornado import stack_context
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.gen import engine, Task
+from tornado.concurrent import TracebackFuture
+
+from torncache import hashing
+from torncache import stats as mcstats
+from torncache.backpressure import Limiter
+
+text_type = hashing.text_type
+
+if bytes is str:
+    # py2 strings are already bytes
+    def _ascii(text):
+        return text
+    _native = _ascii
+else:
+    def _ascii(text):
+        return text.encode('ascii')
+
+    def _native(data):
+        return data.decode('latin-1')
+
+# Longest key memcached accepts
+MAX_KEY_LENGTH = 250
+
+# Keys can't contain whitespace or control characters
+_INVALID_KEY = re.compile(b'[\\x00-\\x20\\x7f]')
+
+# Pieces of commands, built once
+_CRLF = b'\r\n'
+_NOREPLY = b' noreply\r\n'
+_COMMANDS = {}
+
+# Returned by Request.parse while a reply is still being read
+_MORE = object()
+
+# Stack contexts of code running outside any StackContext
+_NO_CONTEXTS = ((), None)
+
+
+def _in_stack_context():
+    """Whether a StackContext or ExceptionStackContext is active"""
+    return stack_context._state.contexts != _NO_CONTEXTS
+
+
+def _command(name):
+    """Command name followed by a space, as bytes"""
+    try:
+        return _COMMANDS[name]
+    except KeyError:
+        prefix = _COMMANDS[name] = _ascii(name + ' ')
+        return prefix
+
+
+# Results of single line replies
+def _is_deleted(line):
+    return line.startswith(b'DELETED')
+
+
+def _is_touched(line):
+    return line.startswith(b'TOUCHED')
+
+
+def _is_ok(line):
+    return line.startswith(b'OK')
+
+
+def _counter(line):
+    return False if line.startswith(b'NOT_FOUND') else int(line)
+
+
+def _chunks(keys, max_keys=None, max_bytes=None):
+    """Split keys in runs of at most max_keys keys and max_bytes bytes"""
+    if max_bytes is None:
+        if max_keys is None or len(keys) <= max_keys:
+            return [keys]
+        return [keys[i:i + max_keys] for i in range(0, len(keys), max_keys)]
+    chunks, chunk, size = [], [], 0
+    for key in keys:
+        # keys are separated by a space
+        if isinstance(key, (bytes, text_type)):
+            length = len(key) + 1
+        else:
+            length = len(str(key)) + 1
+        if chunk and (size + length > max_bytes or len(chunk) == max_keys):
+            chunks.append(chunk)
+            chunk, size = [], 0
+        chunk.append(key)
+        size += length
+    chunks.append(chunk)
+    return chunks
+
+
+# Command lifecycle events that hooks can be registered for
+HOOK_EVENTS = ('enqueue', 'write', 'first_byte', 'complete')
 
 VALID_STORE_RESULTS = {
-    'set':     ('STORED',),
-    'add':     ('STORED', 'NOT_STORED'),
-    'replace': ('STORED', 'NOT_STORED'),
-    'append':  ('STORED', 'NOT_STORED'),
-    'prepend': ('STORED', 'NOT_STORED'),
-    'cas':     ('STORED', 'EXISTS', 'NOT_FOUND'),
+    'set':     (b'STORED',),
+    'add':     (b'STORED', b'NOT_STORED'),
+    'replace': (b'STORED', b'NOT_STORED'),
+    'append':  (b'STORED', b'NOT_STORED'),
+    'prepend': (b'STORED', b'NOT_STORED'),
+    'cas':     (b'STORED', b'EXISTS', b'NOT_FOUND'),
+}
+
+STORE_RESULTS = {
+    b'STORED': True,
+    b'NOT_STORED': False,
+    # only for cas related actions
+    b'NOT_FOUND': None,
+    b'EXISTS': False,
+}
+
+# Results of pool commands shed by backpressure, as if they had missed
+REJECTED_RESULTS = {
+    'gets': lambda: (None, None),
+    'gats': lambda: (None, None),
+    'get_many': dict,
+    'gat_many': dict,
+    'update_many': dict,
+    'gets_many': dict,
+    'set_many': dict,
+    'add_many': dict,
+    'delete_many': dict,
+    'incr_many': dict,
+    'pipeline': dict,
 }
 
 
 # Some of the values returned by the "stats" command
-# need mapping into native Python types
+# need mapping into native Python types. General stats
 STAT_TYPES = {
-    # General stats
     'version': str,
     'rusage_user': lambda value: float(value.replace(':', '.')),
     'rusage_system': lambda value: float(value.replace(':', '.')),
     'hash_is_expanding': lambda value: int(value) != 0,
     'slab_reassign_running': lambda value: int(value) != 0,
+}
 
-    # Settings stats
+# "stats settings", where some names of general counters are reused
+SETTINGS_STAT_TYPES = {
     'inter': str,
     'evictions': lambda value: value == 'on',
     'growth_factor': float,
@@ -58,6 +178,127 @@ STAT_TYPES = {
     'slab_automove': lambda value: int(value) != 0,
 }
 
+# Converters by "stats" argument. Values without one are ints
+STAT_TYPES_BY_KIND = {
+    'general': STAT_TYPES,
+    'settings': SETTINGS_STAT_TYPES,
+    'slabs': {},
+    'items': {},
+}
+
+
+# Flag bit of values stored along their compute time and logical
+# expiry, see Client.get_or_compute
+ENVELOPE_FLAG = 1 << 15
+
+# A value read or stored with its metadata
+Envelope = collections.namedtuple('Envelope', 'value delta expiry')
+
+# Suffix of the keys locking a recomputation
+LOCK_SUFFIX = ':lock'
+
+# Clients a split multi-get of a pool without size limit runs on at once
+MAX_PARALLEL_GETS = 8
+
+# Bytes a stream may buffer before it's closed, and bytes read at once
+# when draining values too large to keep
+DEFAULT_MAX_BUFFER_SIZE = 64 * 1024 * 1024
+DRAIN_CHUNK_SIZE = 64 * 1024
+
+# A key listed by "lru_crawler metadump"
+KeyRecord = collections.namedtuple(
+    'KeyRecord', 'key exp la cas fetch cls size server')
+
+
+def _open_envelope(value, flags):
+    """Split Envelope metadata from a stored value, if it has any"""
+    if not flags & ENVELOPE_FLAG:
+        return value, flags, None
+    delta, expiry, value = value.split(b' ', 2)
+    return value, flags & ~ENVELOPE_FLAG, (float(delta), float(expiry))
+
+
+def _parse_host(host):
+    """Split a "host:port" string or ("host:port", weight) tuple"""
+    weight = 1
+    if isinstance(host, tuple):
+        host, weight = host
+    ip, port = host, 11211
+    if ":" in host:
+        ip, _, port = host.partition(":")
+        port = int(port)
+    return ip, port, weight
+
+
+def _parse_metadump(line, server):
+    """Parse a 'key=<key> exp=<exp> la=<la> ...' metadump line"""
+    fields = dict(field.partition('=')[::2] for field in line.split(' '))
+    return KeyRecord(
+        urlparse.unquote(fields['key']),
+        int(fields.get('exp', -1)),
+        int(fields.get('la', 0)),
+        int(fields.get('cas', 0)),
+        fields.get('fetch') == 'yes',
+        int(fields.get('cls', 0)),
+        int(fields.get('size', 0)),
+        server)
+
+
+@engine
+def _get_or_compute(cache, key, producer, ttl, beta, lock_ttl, grace,
+                    retry_delay, callback):
+    """
+    Body of get_or_compute, shared by Client and ClientPool. Every step
+    is a command of its own, so a pool client is only held while one
+    runs, not while producer computes the value or the lock is polled.
+    """
+    cached = yield Task(cache.get_envelope, key)
+    envelope = cached if isinstance(cached, Envelope) else None
+    if cached is not None and envelope is None:
+        # stored without metadata, like by a plain set
+        callback and callback(cached)
+        return
+    if envelope is not None:
+        gap = envelope.delta * beta * math.log(1.0 - random.random())
+        if time.time() - gap < envelope.expiry:
+            callback and callback(envelope.value)
+            return
+
+    if isinstance(key, bytes):
+        lock = key + _ascii(LOCK_SUFFIX)
+    else:
+        lock = '{0}{1}'.format(key, LOCK_SUFFIX)
+    deadline = time.time() + lock_ttl
+    while True:
+        # None means the cache failed, so don't wait for anyone
+        locked = yield Task(cache.add, lock, '1', lock_ttl, False)
+        if locked is not False:
+            break
+        if envelope is not None:
+            callback and callback(envelope.value)
+            return
+        if time.time() >= deadline:
+            break
+        yield Task(cache._ioloop.add_timeout, time.time() + retry_delay)
+        cached = yield Task(cache.get, key)
+        if cached is not None:
+            callback and callback(cached)
+            return
+
+    started = time.time()
+    try:
+        value = yield Task(producer)
+    except Exception:
+        # let others compute it rather than wait for the lock to expire
+        locked and cache.delete(lock)
+        raise
+    now = time.time()
+    grace = ttl if grace is None else grace
+    envelope = Envelope(value, now - started, now + ttl)
+    yield Task(cache.set, key, envelope, ttl + grace, False)
+    locked and cache.delete(lock)
+    callback and callback(value)
+
 
 class MemcacheError(Exception):
     "Base exception class"
@@ -71,6 +312,10 @@ class MemcacheTimeoutError(MemcacheError):
     """Timeout when connecting or running and operation"""
 
 
+class MemcacheBackpressureError(MemcacheError):
+    """Raised when a command is shed because a server has too much load"""
+
+
 class MemcacheClientError(MemcacheError):
     """Raised when memcached fails to parse the arguments to a request, likely
     due to a malformed key and/or value, a bug in this library, or a version
@@ -102,8 +347,200 @@ class MemcacheUnexpectedCloseError(MemcacheServerError):
     "Raised when the connection with memcached closes unexpectedly."
 
 
+def encode_key(key, hash_long=False):
+    """
+    Key as sent to memcached.
+
+    Args:
+      key: bytes, ascii text or any object converted with str().
+      hash_long: optional bool, shorten keys longer than MAX_KEY_LENGTH
+                 to a prefix of them and their md5 instead of failing.
+
+    Raises:
+      MemcacheIllegalInputError if the key is empty, too long or contains
+      whitespace or control characters.
+    """
+    if not isinstance(key, bytes):
+        if not isinstance(key, text_type):
+            key = str(key)
+        if not isinstance(key, bytes):
+            try:
+                key = key.encode('ascii')
+            except UnicodeEncodeError as e:
+                raise MemcacheIllegalInputError(str(e))
+    if not key or _INVALID_KEY.search(key):
+        error = "Key contains spaces or control characters: {0!r}"
+        raise MemcacheIllegalInputError(error.format(key))
+    if len(key) > MAX_KEY_LENGTH:
+        if not hash_long:
+            error = "Key is longer than {0} bytes: {1!r}..."
+            raise MemcacheIllegalInputError(
+                error.format(MAX_KEY_LENGTH, key[:32]))
+        digest = _ascii(hashlib.md5(key).hexdigest())
+        key = key[:MAX_KEY_LENGTH - len(digest) - 1] + b':' + digest
+    return key
+
+
+def encode_value(data):
+    """Value as sent to memcached. Text must be ascii"""
+    if isinstance(data, bytes):
+        return data
+    if not isinstance(data, text_type):
+        data = str(data)
+        if isinstance(data, bytes):
+            return data
+    try:
+        return data.encode('ascii')
+    except UnicodeEncodeError as e:
+        raise MemcacheIllegalInputError(str(e))
+
+
+class CommandTrace(object):
+    """
+    Lifecycle of a single command, as reported to hooks.
+
+    Timings are wall clock timestamps keyed by event name. Events not
+    reached yet (or never reached, like 'first_byte' for noreply
+    commands) are missing from the dict.
+    """
+
+    __slots__ = ('hooks', 'name', 'server', 'keys', 'size',
+                 'timings', 'error')
+
+    def __init__(self, hooks, name, server, keys, size):
+        self.hooks = hooks
+        self.name = name
+        self.server = server
+        self.keys = keys
+        self.size = size
+        self.timings = {}
+        self.error = None
+
+    def elapsed(self, event, since='enqueue'):
+        """Seconds between two events, or None if any is missing"""
+        try:
+            return self.timings[event] - self.timings[since]
+        except KeyError:
+            return None
+
+    def fire(self, event, error=None):
+        """Record event and notify registered hooks"""
+        self.timings[event] = time.time()
+        if error is not None:
+            self.error = error
+        self.hooks.fire(event, self)
+
+
+class Hooks(object):
+    """
+    Registry of command lifecycle hooks shared by connections.
+
+    A hook is a callable invoked as hook(event, trace) where event is
+    one of HOOK_EVENTS and trace a CommandTrace instance. When no hooks
+    are registered, connections don't even build a trace.
+    """
+
+    def __init__(self):
+        self._hooks = dict((event, []) for event in HOOK_EVENTS)
+        self._count = 0
+
+    def __nonzero__(self):
+        return self._count > 0
+    __bool__ = __nonzero__
+
+    def add(self, event, hook):
+        """Register hook for event"""
+        if event not in self._hooks:
+            raise ValueError("Unknown hook event: {0}".format(event))
+        self._hooks[event].append(hook)
+        self._count += 1
+
+    def remove(self, event, hook):
+        """Unregister a previously added hook"""
+        self._hooks[event].remove(hook)
+        self._count -= 1
+
+    def trace(self, name, server, keys, size):
+        """Start tracing a command. Returns None if there are no hooks"""
+        if not self._count:
+            return None
+        trace = CommandTrace(self, name, server, keys, size)
+        trace.fire('enqueue')
+        return trace
+
+    def fire(self, event, trace):
+        for hook in self._hooks[event]:
+            try:
+                hook(event, trace)
+            except Exception:
+                logging.exception("Error on '%s' hook %r", event, hook)
+
+
+class Batches(object):
+    """
+    Results of a multi-get, delivered as they arrive.
+
+    next() returns a Future resolved with the next dict of values, or
+    with None once every batch was consumed, so coroutines can loop:
+
+      batches = client.iter_many(keys, deadline=ioloop.time() + 0.05)
+      while True:
+          batch = yield batches.next()
+          if batch is None:
+              break
+          render(batch)
+    """
+
+    def __init__(self):
+        self._batches = collections.deque()
+        self._waiter = None
+        self._closed = False
+
+    def _push(self, batch):
+        if self._waiter is not None:
+            waiter, self._waiter = self._waiter, None
+            waiter.set_result(batch)
+        else:
+            self._batches.append(batch)
+
+    def _close(self, result=None):
+        self._closed = True
+        if self._waiter is not None:
+            waiter, self._waiter = self._waiter, None
+            waiter.set_result(None)
+
+    def next(self):
+        """A Future for the next batch, or for None after the last one"""
+        future = TracebackFuture()
+        if self._batches:
+            future.set_result(self._batches.popleft())
+        elif self._closed:
+            future.set_result(None)
+        else:
+            self._waiter = future
+        return future
+
+
 class ClientPool(object):
-    """A Pool of clients"""
+    """
+    A Pool of clients.
+
+    Args:
+      servers: servers, see _parse_servers for supported forms.
+      size: optional int, max number of clients, or 0 for no limit.
+      min_size: optional int, clients kept even if they are idle.
+      idle_timeout: optional float, seconds a client may stay unused
+                    before its connections are closed.
+      max_lifetime: optional float, seconds after which a client is
+                    replaced by a new one, once it's idle.
+      lifetime_jitter: optional float, fraction of max_lifetime cut at
+                       random from every client lifetime, so they aren't
+                       all recycled at once.
+      prewarm: optional int, clients connected to every server right
+               away, so first requests don't wait for connects.
+
+    Other arguments are passed to every Client.
+    """
 
     class _BroadCast(object):
         """
@@ -132,13 +569,44 @@ class ClientPool(object):
                 func = functools.partial(getattr(self.pool, cmd), host)
                 func(*args, **kwargs)
 
-    def __init__(self, servers, size=0, **kwargs):
+    def __init__(self, servers, size=0, min_size=0, idle_timeout=None,
+                 max_lifetime=None, lifetime_jitter=0.1, prewarm=0,
+                 **kwargs):
         self._servers = self._parse_servers(servers)
         self._size = size
         self._used = collections.deque()
+        # idle clients, the most recently used last
         self._clients = collections.deque()
-        # Client arguments
+        # Client arguments. Hooks and limits are shared by all clients
         self._kwargs = kwargs
+        self._ioloop = kwargs['ioloop'] = \
+            kwargs.get('ioloop') or IOLoop.instance()
+        self._hooks = kwargs.setdefault('hooks', Hooks())
+        self._limits = kwargs.get('limits')
+        # With limits, commands wait for a free client instead of failing
+        self._limiter = None
+        if size > 0 and self._limits is not None:
+            self._limiter = Limiter(
+                size, self._limits.max_queue, self._limits.policy,
+                self._limits.timeout, self._ioloop)
+
+        # Pool sizing. Clients map to [expiry, idle since] times
+        self._min_size = min_size
+        self._idle_timeout = idle_timeout
+        self._max_lifetime = max_lifetime
+        self._lifetime_jitter = lifetime_jitter
+        self._ages = {}
+        self._counters = dict.fromkeys(('created', 'reaped', 'recycled'), 0)
+        self._reaper = None
+        periods = [period for period in (idle_timeout, max_lifetime) if period]
+        if periods:
+            self._reaper = PeriodicCallback(
+                self._reap, min(periods) * 500, self._ioloop)
+            self._reaper.start()
+        clients = self._create_clients(max(min_size, prewarm))
+        for client in clients[:prewarm]:
+            self._warm(client)
+        self._clients.extend(clients)
 
     @staticmethod
     def _parse_servers(servers):
@@ -175,31 +643,266 @@ class ClientPool(object):
                 host = "{0}:{1}".format(*candidate[4])
                 weight = retval.get(host, weight - 1)
                 retval[host] = weight + 1
-        # Return well formatted list of servers
-        return retval.items()
+        # Return well formatted list of servers. Sort them so every
+        # process builds the same routing table
+        return sorted(retval.items())
 
     def _create_clients(self, n):
-        return [Client(self._servers, **self._kwargs) for x in xrange(n)]
+        clients = [Client(self._servers, **self._kwargs) for x in range(n)]
+        now = time.time()
+        for client in clients:
+            expiry = None
+            if self._max_lifetime:
+                jitter = 1 - self._lifetime_jitter * random.random()
+                expiry = now + self._max_lifetime * jitter
+            self._ages[client] = [expiry, now]
+        self._counters['created'] += n
+        return clients
+
+    @staticmethod
+    def _warm(client):
+        """Open the connections of client"""
+        for server in client._servers:
+            try:
+                server.connect()
+            except MemcacheClientError:
+                # dead, it will be retried on use
+                pass
+
+    def _retire(self, client, reason):
+        """Close client once the commands queued on it are done"""
+        del self._ages[client]
+        self._counters[reason] += 1
+        for server in client._servers:
+            server.drain()
+
+    def _reap(self):
+        """Close idle and expired clients, keeping min_size of them"""
+        now = time.time()
+        # least recently used first
+        for client in list(self._clients):
+            expiry, idle_since = self._ages[client]
+            total = len(self._clients) + len(self._used)
+            if expiry is not None and now >= expiry:
+                reason = 'recycled'
+            elif self._idle_timeout and total > self._min_size and \
+                    now - idle_since >= self._idle_timeout:
+                reason = 'reaped'
+            else:
+                continue
+            self._clients.remove(client)
+            self._retire(client, reason)
+        # replacements are connected in advance
+        missing = self._min_size - len(self._clients) - len(self._used)
+        if missing > 0:
+            clients = self._create_clients(missing)
+            for client in clients:
+                self._warm(client)
+            self._clients.extendleft(clients)
 
     def _invoke(self, cmd, *args, **kwargs):
-        def on_finish(response, c, _cb, **kwargs):
-            self._used.remove(c)
-            self._clients.append(c)
-            _cb and _cb(response, **kwargs)
+        if self._limiter is not None:
+            self._limiter.acquire(stack_context.wrap(
+                functools.partial(self._dispatch, cmd, args, kwargs)))
+            return
         if not self._clients:
             # Add a new client
             total_clients = len(self._clients) + len(self._used)
             if self._size > 0 and total_clients >= self._size:
                 error = "Max of %d clients is already reached" % self._size
                 raise MemcachePoolError(error)
-            self._clients.append(*self._create_clients(1))
-        # fetch available one
-        client = self._clients.popleft()
+        self._dispatch(cmd, args, kwargs, True)
+
+    def _dispatch(self, cmd, args, kwargs, admitted):
+        def on_finish(response, c, _cb, **kwargs):
+            self._checkin(c)
+            _cb and _cb(response, **kwargs)
+
+        cb = kwargs.get('callback')
+        if not admitted:
+            # shed, degrade to a miss
+            cb and cb(REJECTED_RESULTS.get(cmd, lambda: None)())
+            return
+        if not self._clients:
+            self._clients.extend(self._create_clients(1))
+        # fetch the most recently used, so extra clients go idle
+        client = self._clients.pop()
         self._used.append(client)
         # override used callback to
-        cb = kwargs.get('callback')
         kwargs['callback'] = functools.partial(on_finish, c=client, _cb=cb)
-        getattr(client, cmd)(*args, **kwargs)
+        try:
+            getattr(client, cmd)(*args, **kwargs)
+        except Exception:
+            # failed before being sent, like on illegal keys
+            client in self._used and self._checkin(client)
+            raise
+
+    def _checkin(self, client):
+        self._used.remove(client)
+        ages = self._ages[client]
+        now = time.time()
+        if ages[0] is not None and now >= ages[0]:
+            self._retire(client, 'recycled')
+        else:
+            ages[1] = now
+            self._clients.append(client)
+        self._limiter and self._limiter.release()
+
+    def pool_stats(self):
+        """
+        Size of the pool.
+
+        Returns:
+          A dict with the number of idle and used clients, and counters of
+          clients created, reaped for being idle and recycled for being
+          too old.
+        """
+        return dict(self._counters, idle=len(self._clients),
+                    used=len(self._used))
+
+    def close(self):
+        """Stop reaping and close idle clients once they are done"""
+        self._reaper and self._reaper.stop()
+        while self._clients:
+            self._retire(self._clients.pop(), 'reaped')
+
+    def backpressure_stats(self):
+        """
+        Load shedding counters, see Client.backpressure_stats.
+
+        Commands waiting for a free client of the pool are reported
+        under the 'pool' entry.
+        """
+        retval = self._limits.stats() if self._limits is not None else {}
+        if self._limiter is not None:
+            retval['pool'] = dict(self._limiter.stats,
+                                  inflight=self._limiter.inflight,
+                                  waiting=self._limiter.waiting)
+        return retval
+
+    def _rounds(self, keys):
+        """
+        Keys of a multi-get in groups holding at most one command worth
+        of keys per server, according to max_get_keys and max_get_bytes.
+        """
+        client = self._sample()
+        if client._max_get_keys is None and client._max_get_bytes is None:
+            return [keys]
+        # keys with a forced placement are routed as given
+        originals = dict(
+            (key[1], key) for key in keys if isinstance(key, tuple))
+        rounds, seen = [], {}
+        for server, chunk in client._split(keys):
+            i = seen[server] = seen.get(server, -1) + 1
+            if i == len(rounds):
+                rounds.append([])
+            rounds[i].extend(originals.get(key, key) for key in chunk)
+        return rounds
+
+    def get_many(self, keys, callback, deadline=None, on_batch=None):
+        """
+        The memcached "get" command, see Client.get_many.
+
+        Multi-gets over the max_get_keys or max_get_bytes limits are split
+        and the chunks of a server are run in parallel on different
+        clients of the pool, up to its size, or MAX_PARALLEL_GETS for
+        pools without one.
+        """
+        def on_response(result):
+            retval.update(result)
+            pending[0] -= 1
+            if not pending[0]:
+                callback(retval)
+
+        rounds = self._rounds(keys) if keys else [keys]
+        slots = len(rounds)
+        if self._size > 0:
+            slots = max(1, min(slots, self._size - len(self._used)))
+        else:
+            slots = min(slots, MAX_PARALLEL_GETS)
+        if slots == 1:
+            self._invoke('get_many', keys, callback=callback,
+                         deadline=deadline, on_batch=on_batch)
+            return
+        # extra rounds share clients, which run them one after the other
+        retval, pending = dict(), [slots]
+        cb = stack_context.wrap(on_response)
+        for i in range(slots):
+            group = [key for chunk in rounds[i::slots] for key in chunk]
+            self._invoke('get_many', group, callback=cb, deadline=deadline,
+                         on_batch=on_batch)
+
+    def oversized_stats(self):
+        """Values skipped by the clients of the pool, see Client"""
+        retval = {}
+        for client in list(self._clients) + list(self._used):
+            for server, stats in client.oversized_stats().items():
+                totals = retval.setdefault(server, dict.fromkeys(stats, 0))
+                for name, count in stats.items():
+                    totals[name] += count
+        return retval
+
+    def iter_many(self, keys, deadline=None):
+        """Per-server batches of values, see Client.iter_many"""
+        batches = Batches()
+        self.get_many(keys, callback=batches._close, deadline=deadline,
+                      on_batch=batches._push)
+        return batches
+
+    def update_servers(self, servers, callback=None):
+        """
+        Switch every client of the pool to a new list of servers.
+
+        Args:
+          servers: servers in any form accepted by the constructor.
+
+        Returns:
+          The addresses of the removed servers. See Client.update_servers
+        """
+        def on_updated(removed):
+            retval.update(removed)
+            pending[0] -= 1
+            if not pending[0]:
+                callback and callback(sorted(retval))
+
+        self._servers = self._parse_servers(servers)
+        retval, clients = set(), list(self._clients) + list(self._used)
+        pending = [len(clients)]
+        if not clients:
+            callback and callback([])
+        for client in clients:
+            client.update_servers(self._servers, callback=on_updated)
+
+    def _sample(self):
+        """A client of the pool, for work that doesn't send commands"""
+        if not self._clients and not self._used:
+            self._clients.extend(self._create_clients(1))
+        return (self._clients or self._used)[-1]
+
+    def hot_keys(self, n=None):
+        """Hottest keys seen by the pool, see Client.hot_keys"""
+        return self._sample().hot_keys(n)
+
+    def address_of(self, key):
+        """Address of the server of key, see Client.address_of"""
+        return self._sample().address_of(key)
+
+    def get_or_compute(self, key, producer, ttl, beta=1.0, lock_ttl=5,
+                       grace=None, retry_delay=0.05, callback=None):
+        """
+        See Client.get_or_compute. Every command goes through the pool, so
+        no client is held while producer runs or the lock is polled.
+        """
+        _get_or_compute(self, key, producer, ttl, beta, lock_ttl, grace,
+                        retry_delay, callback)
+
+    def add_hook(self, event, hook):
+        """Register a command lifecycle hook on every client of the pool"""
+        self._hooks.add(event, hook)
+
+    def remove_hook(self, event, hook):
+        """Unregister a command lifecycle hook"""
+        self._hooks.remove(event, hook)
 
     def __getattr__(self, name):
         if hasattr(Client, name):
@@ -221,13 +924,26 @@ class Client(object):
                  serializer=None, deserializer=None,
                  connect_timeout=5, timeout=1, no_delay=True,
                  ignore_exc=True, dead_retry=30,
-                 server_retries=10):
+                 server_retries=10, hooks=None, hasher='crc32',
+                 hotkeys=None, limits=None, hash_long_keys=False,
+                 deserialize_many=None, executor=None,
+                 executor_threshold=65536, max_get_keys=None,
+                 max_get_bytes=None, max_value_size=None,
+                 max_response_size=None,
+                 max_buffer_size=DEFAULT_MAX_BUFFER_SIZE):
 
         # Watcher to destroy client when ioloop expires
         self._ioloop = ioloop or IOLoop.instance()
         self.CLIENTS[self._ioloop] = self
 
+        self._hooks = Hooks() if hooks is None else hooks
+        self._hasher = hashing.get_hasher(hasher)
+        self._hotkeys = hotkeys
+        self._limits = limits
         self._server_retries = server_retries
+        # Multi-gets over these limits are split in several commands
+        self._max_get_keys = max_get_keys
+        self._max_get_bytes = max_get_bytes
         self._server_args = {
             'ioloop': self._ioloop,
             'serializer': serializer,
@@ -236,22 +952,107 @@ class Client(object):
             'timeout': timeout,
             'no_delay': no_delay,
             'ignore_exc': ignore_exc,
-            'dead_retry': dead_retry
+            'dead_retry': dead_retry,
+            'hooks': self._hooks,
+            'limits': limits,
+            'hash_long_keys': hash_long_keys,
+            'deserialize_many': deserialize_many,
+            'executor': executor,
+            'executor_threshold': executor_threshold,
+            'max_value_size': max_value_size,
+            'max_response_size': max_response_size,
+            'max_buffer_size': max_buffer_size,
         }
 
         # servers
         self._servers = []
         self._buckets = []
-        # Servers can be passed in two forms:
-        #    1. Strings of the form C{"host:port"}, which implies a
-        #    default weight of 1.
-        #    2. Tuples of the form C{("host:port", weight)}, where C{weight} is
-        #    an integer weight value.
-        for server in servers:
-            server = Connection(server, **self._server_args)
-            for i in xrange(server.weight):
-                self._buckets.append(server)
-            self._servers.append(server)
+        self.update_servers(servers)
+
+    def update_servers(self, servers, callback=None):
+        """
+        Switch to a new list of servers at runtime.
+
+        Connections to servers still listed are kept, and the routing
+        table is replaced at once. Removed servers are closed once the
+        commands already queued on them are done.
+
+        Args:
+          servers: servers in two forms. Strings of the form "host:port",
+                   which implies a default weight of 1, or tuples of the
+                   form ("host:port", weight), where weight is an integer.
+
+        Returns:
+          A list with the addresses of the removed servers, once all of
+          them are closed.
+        """
+        def on_drained(server):
+            pending.remove(server)
+            if not pending:
+                callback and callback([server.address for server in removed])
+
+        current = dict((server.address, server) for server in self._servers)
+        servers_, buckets = [], []
+        for host in servers:
+            ip, port, weight = _parse_host(host)
+            server = current.pop('%s:%d' % (ip, port), None)
+            if server is None:
+                server = Connection(host, **self._server_args)
+            server.weight = weight
+            buckets.extend([server] * weight)
+            servers_.append(server)
+        # swap the routing table
+        self._servers, self._buckets = servers_, buckets
+
+        removed = sorted(current.values(), key=lambda server: server.address)
+        pending = list(removed)
+        if not removed:
+            callback and callback([])
+        for server in removed:
+            server.drain(on_drained)
+
+    def add_hook(self, event, hook):
+        """
+        Register a command lifecycle hook.
+
+        Args:
+          event: str, one of HOOK_EVENTS: 'enqueue' when the command is
+                 issued, 'write' when it has been written to the socket,
+                 'first_byte' when the first response line arrives and
+                 'complete' when the command finishes, even on error.
+          hook: callable invoked as hook(event, trace), where trace is a
+                CommandTrace with the command name, server, key count,
+                payload size and timings.
+        """
+        self._hooks.add(event, hook)
+
+    def remove_hook(self, event, hook):
+        """Unregister a command lifecycle hook"""
+        self._hooks.remove(event, hook)
+
+    def backpressure_stats(self):
+        """
+        Load shedding counters of every server, if limits are set.
+
+        Returns:
+          A dict of server to its admitted, queued, rejected, dropped
+          and expired command counts, plus the current inflight and
+          waiting ones.
+        """
+        if self._limits is None:
+            return {}
+        return self._limits.stats()
+
+    def oversized_stats(self):
+        """
+        Values skipped for going over max_value_size or max_response_size.
+
+        Returns:
+          A dict of server to the count of skipped values and the bytes
+          drained for them.
+        """
+        return dict((str(server), dict(server._oversized))
+                    for server in self._servers)
 
     def _find_server(self, value):
         """Find a server from a string"""
@@ -270,10 +1071,68 @@ class Client(object):
         if isinstance(key, tuple):
             serverhash, key = key[:2]
         elif len(self._buckets) > 1:
-            serverhash = hash(key)
+            serverhash = self._hasher(key)
         # get pair server, key
         return (self._buckets[serverhash % len(self._buckets)], key)
 
+    def _route(self, keys):
+        """Group keys by their server in a single pass"""
+        return hashing.partition(keys, self._buckets, self._hasher)
+
+    def _split(self, keys):
+        """
+        Route keys of a multi-get, in chunks of at most max_get_keys keys
+        and max_get_bytes bytes of keys. Returns (server, keys) pairs.
+        """
+        servers = self._route(keys)
+        if self._max_get_keys is None and self._max_get_bytes is None:
+            return list(servers.items())
+        return [(server, chunk) for server, names in servers.items()
+                for chunk in _chunks(names, self._max_get_keys,
+                                     self._max_get_bytes)]
+
+    def address_of(self, key):
+        """
+        Address of the server key is routed to, or None if there are no
+        servers.
+
+        Raises:
+          MemcacheIllegalInputError if the key can't be sent.
+        """
+        if not self._buckets:
+            return None
+        server, key = self._get_server(key)
+        server.encode_key(key)
+        return str(server)
+
+    def _record_hot(self, keys, found):
+        """Account keys access, moving locally pinned values into found"""
+        hot, missing = self._hotkeys, []
+        for key in keys:
+            name = key[1] if isinstance(key, tuple) else key
+            hot.record(name)
+            value = hot.pinned(name)
+            if value is None:
+                missing.append(key)
+            else:
+                found[name] = value
+        return missing
+
+    def hot_keys(self, n=None):
+        """
+        Hottest keys seen by this client, if hot key tracking is enabled.
+
+        Args:
+          n: optional int, max number of keys to return.
+
+        Returns:
+          A list of (key, estimated accesses, server) tuples, hottest first.
+        """
+        if self._hotkeys is None:
+            return []
+        return [(key, count, str(self._get_server(key)[0]))
+                for key, count in self._hotkeys.top(n)]
+
     def set(self, key, value, expire=0, noreply=True, callback=None):
         """
         The memcached "set" command.
@@ -292,6 +1151,7 @@ class Client(object):
         """
         # Fetch memcached connection
         server, key = self._get_server(key)
+        self._hotkeys and self._hotkeys.invalidate(key)
         if not server:
             callback and callback(None)
             return
@@ -325,17 +1185,11 @@ class Client(object):
         # shortcut
         if not values:
             callback and callback({})
+            return
 
-        # init vars
-        retval, servers = dict(), dict()
-        for key, value in values.iteritems():
-            server, key = self._get_server(key)
-            servers[key] = server
         # set it
-        for key, server in servers.iteritems():
-            if server is None:
-                on_response(key, False)
-                continue
+        retval = dict()
+        for key, value in values.items():
             cb = stack_context.wrap(functools.partial(on_response, key))
             self.set(key, value, expire, noreply, callback=cb)
 
@@ -363,6 +1217,22 @@ class Client(object):
         # invoke
         server.store_cmd('add', key, expire, noreply, value, None, callback)
 
+    def add_many(self, values, expire=0, callback=None):
+        """
+        Pipeline "add" commands, in a single write per server.
+
+        Args:
+          values: dict of key to value, see class docs for details.
+          expire: optional int, number of seconds until the items are
+                  expired from the cache, or zero for no expiry.
+
+        Returns:
+          A dict of key name to True if it was stored, or False if the key
+          already existed. Keys of servers that failed are missing.
+        """
+        updates = dict((key, (value, None)) for key, value in values.items())
+        self._store_many_cas(updates, expire, callback)
+
     def replace(self, key, value, expire=0, noreply=True, callback=None):
         """
         The memcached "replace" command.
@@ -381,6 +1251,7 @@ class Client(object):
         """
         # Fetch memcached connection
         server, key = self._get_server(key)
+        self._hotkeys and self._hotkeys.invalidate(key)
         if not server:
             callback and callback(None)
             return
@@ -403,6 +1274,7 @@ class Client(object):
         """
         # Fetch memcached connection
         server, key = self._get_server(key)
+        self._hotkeys and self._hotkeys.invalidate(key)
         if not server:
             callback and callback(None)
             return
@@ -424,6 +1296,7 @@ class Client(object):
           True.
         """
         server, key = self._get_server(key)
+        self._hotkeys and self._hotkeys.invalidate(key)
         if not server:
             callback and callback(None)
             return
@@ -448,6 +1321,7 @@ class Client(object):
           value and True if it existed and was changed.
         """
         server, key = self._get_server(key)
+        self._hotkeys and self._hotkeys.invalidate(key)
         if not server:
             callback and callback(None)
             return
@@ -469,15 +1343,35 @@ class Client(object):
             callback(None)
             return
 
-        cb = lambda x: callback(x.get(key, None))
-        server.fetch_cmd('get', [key], False, callback=cb)
+        hot = self._hotkeys
+        if hot is None:
+            cb = callback
+        else:
+            hot.record(key)
+            value = hot.pinned(key)
+            if value is not None:
+                callback(value)
+                return
 
-    def get_many(self, keys, callback):
+            def cb(value):
+                callback(hot.pin(key, value))
+        server.fetch_cmd('get', [key], False, cb, single=True)
+
+    def get_many(self, keys, callback, deadline=None, on_batch=None,
+                 envelopes=False):
         """
         The memcached "get" command.
 
         Args:
           keys: list(str), see class docs for details.
+          deadline: optional float, IOLoop time at which to call back with
+                    the values received so far. Keys of servers that
+                    didn't answer yet are reported as misses.
+          on_batch: optional callable, invoked with a dict of the values
+                    of every server reply as it arrives.
+          envelopes: optional bool, keep the metadata of values stored by
+                     get_or_compute, see get_envelope. Such values aren't
+                     pinned as hot keys.
 
         Returns:
           A dict in which the keys are elements of the "keys" argument list
@@ -485,31 +1379,59 @@ class Client(object):
           some or none of the given keys.
         """
         # response handler
-        def on_response(server, result):
+        def on_response(chunk, result):
+            if not pending:
+                # arrived after the deadline
+                return
+            if hot is not None:
+                for key, value in result.items():
+                    hot.pin(key, value)
             retval.update(result)
-            pending.remove(server)
+            on_batch and on_batch(result)
+            pending.remove(chunk)
             if len(pending) == 0:
-                callback(retval)
+                on_done()
+
+        def on_done():
+            timeout and self._ioloop.remove_timeout(timeout)
+            del pending[:]
+            callback(retval)
 
         # shortcut
-        if not keys:
+        if not keys or not self._buckets:
             callback({})
+            return
 
         # init vars
-        retval, servers = dict(), dict()
-        for key in keys:
-            server, key = self._get_server(key)
-            servers.setdefault(server, [])
-            servers[server].append(key)
+        retval, hot = dict(), None if envelopes else self._hotkeys
+        if hot is not None:
+            keys = self._record_hot(keys, retval)
+            if retval and on_batch:
+                on_batch(dict(retval))
+            if not keys:
+                callback(retval)
+                return
+        chunks = self._split(keys)
         # set it
-        pending = servers.keys()
-        for server, keys in servers.iteritems():
-            if server is None:
-                result = itertools.izip_longest(keys, [], fillvalue=None)
-                on_response(server, result)
-                continue
-            cb = stack_context.wrap(functools.partial(on_response, server))
-            server.fetch_cmd('get', keys, False, callback=cb)
+        pending, timeout = list(range(len(chunks))), None
+        if deadline is not None:
+            timeout = self._ioloop.add_timeout(deadline, on_done)
+        for chunk, (server, keys) in enumerate(chunks):
+            cb = stack_context.wrap(functools.partial(on_response, chunk))
+            server.fetch_cmd('get', keys, False, callback=cb,
+                             envelopes=envelopes)
+
+    def iter_many(self, keys, deadline=None):
+        """
+        Values of keys, in per-server batches as replies arrive.
+
+        Returns:
+          A Batches instance. See get_many for the deadline argument.
+        """
+        batches = Batches()
+        self.get_many(keys, callback=batches._close, deadline=deadline,
+                      on_batch=batches._push)
+        return batches
 
     def gets(self, key, callback):
         """
@@ -525,9 +1447,8 @@ class Client(object):
         if not server:
             callback((None, None))
             return
-
-        cb = lambda x: callback(x.get(key, (None, None)))
-        server.fetch_cmd('gets', [key], True, callback=cb)
+        self._hotkeys and self._hotkeys.record(key)
+        server.fetch_cmd('gets', [key], True, callback, single=True)
 
     def gets_many(self, keys, callback):
         """
@@ -542,70 +1463,305 @@ class Client(object):
           contain all, some or none of the given keys.
         """
         # response handler
-        def on_response(server, result):
+        def on_response(chunk, result):
             retval.update(result)
-            pending.remove(server)
+            pending.remove(chunk)
             if len(pending) == 0:
                 callback(retval)
 
         # shortcut
-        if not keys:
+        if not keys or not self._buckets:
             callback({})
+            return
 
         # init vars
-        responses, retval, servers = [], dict(), dict()
-        for key in keys:
-            server, key = self._get_server(key)
-            servers.setdefault(server, [])
-            servers[server].append(key)
+        retval, chunks = dict(), self._split(keys)
+        if self._hotkeys is not None:
+            for key in keys:
+                self._hotkeys.record(key[1] if isinstance(key, tuple) else key)
         # set it
-        pending = servers.keys()
-        for server, keys in servers.iteritems():
-            if server is None:
-                result = itertools.izip_longest(keys, [], fillvalue=None)
-                on_response(server, result)
-                continue
-            cb = stack_context.wrap(functools.partial(on_response, server))
+        pending = list(range(len(chunks)))
+        for chunk, (server, keys) in enumerate(chunks):
+            cb = stack_context.wrap(functools.partial(on_response, chunk))
             server.fetch_cmd('gets', keys, True, callback=cb)
 
-    def delete(self, key, time=0, noreply=True, callback=None):
+    def gat(self, key, expire, callback):
         """
-        The memcached "delete" command.
+        The memcached "gat" command: get a value and touch it.
 
         Args:
           key: str, see class docs for details.
+          expire: int, number of seconds until the item is expired from
+                  the cache, or zero for no expiry.
 
         Returns:
-          If noreply is True, always returns True. Otherwise returns True if
-          the key was deleted, and False if it wasn't found.
+          The value for the key, or None if the key wasn't found.
         """
-        def on_response(data):
-            callback(data.startswith('DELETED'))
-
-        # Fetch memcached connection
         server, key = self._get_server(key)
         if not server:
-            callback and callback(None)
+            callback(None)
             return
-        # compute command
-        timearg = ' {0}'.format(time) if time else ''
-        replarg = ' noreply' if noreply else ''
-        cmd = 'delete {0}{1}{2}\r\n'.format(key, timearg, replarg)
-
-        # invoke
-        cb = callback if noreply else stack_context.wrap(on_response)
-        server.misc_cmd(cmd, 'delete', noreply, callback=cb)
+        self._hotkeys and self._hotkeys.record(key)
+        server.fetch_cmd('gat', [key], False, callback, single=True,
+                         expire=expire)
 
-    def delete_many(self, keys, noreply=True, callback=None):
+    def gats(self, key, expire, callback):
         """
-        A convenience function to delete multiple keys.
-
-        Args:
-          keys: list(str), the list of keys to delete.
+        The memcached "gats" command: gets and touch a single key.
 
         Returns:
-          True. If an exception is raised then all, some or none of the keys
-          may have been deleted. Otherwise all the keys have been sent to
+          A tuple of (value, cas), or (None, None) if the key wasn't found.
+        """
+        server, key = self._get_server(key)
+        if not server:
+            callback((None, None))
+            return
+        self._hotkeys and self._hotkeys.record(key)
+        server.fetch_cmd('gats', [key], True, callback, single=True,
+                         expire=expire)
+
+    def gat_many(self, keys, expire, callback):
+        """
+        Get many values and extend their expiry, with a single "gat"
+        command per server.
+
+        Args:
+          keys: list(str), see class docs for details.
+          expire: int, number of seconds until the items are expired from
+                  the cache, or zero for no expiry.
+
+        Returns:
+          A dict of the values found, like get_many.
+        """
+        # response handler
+        def on_response(server, result):
+            retval.update(result)
+            pending.remove(server)
+            if len(pending) == 0:
+                callback(retval)
+
+        # shortcut
+        if not keys or not self._buckets:
+            callback({})
+            return
+
+        # init vars
+        retval, servers = dict(), self._route(keys)
+        if self._hotkeys is not None:
+            for key in keys:
+                self._hotkeys.record(key[1] if isinstance(key, tuple) else key)
+        # set it
+        pending = list(servers)
+        for server, keys in servers.items():
+            cb = stack_context.wrap(functools.partial(on_response, server))
+            server.fetch_cmd('gat', keys, False, cb, expire=expire)
+
+    def get_or_compute(self, key, producer, ttl, beta=1.0, lock_ttl=5,
+                       grace=None, retry_delay=0.05, callback=None):
+        """
+        Read a value, recomputing it only once in the cluster when it's
+        missing or about to expire.
+
+        Values are stored as Envelopes holding how long producer took
+        (delta) and when the value logically expires. Readers refresh it
+        early with a probability that grows as expiry approaches (XFetch:
+        now - delta * beta * log(rand()) >= expiry), so usually a single
+        request recomputes a hot key before it expires. Recomputation is
+        guarded by an "add" lock: requests that don't get it serve the
+        stale value or, on a cold miss, wait for the lock holder.
+
+        Args:
+          key: str, see class docs for details.
+          producer: callable invoked as producer(callback), which calls
+                    back with the fresh value.
+          ttl: int, seconds the value is fresh. Must be positive.
+          beta: optional float, values above 1 favour earlier refreshes.
+          lock_ttl: optional int, seconds the lock is held at most. A
+                    cold miss waits for the holder at most that long
+                    before computing the value itself.
+          grace: optional int, seconds stale values are kept after ttl,
+                 to be served while they are recomputed. Defaults to ttl.
+          retry_delay: optional float, seconds between reads while
+                       waiting for the lock holder.
+
+        Returns:
+          The cached or computed value. Errors of producer release the
+          lock and are raised to the caller's stack context.
+        """
+        _get_or_compute(self, key, producer, ttl, beta, lock_ttl, grace,
+                        retry_delay, callback)
+
+    def get_envelope(self, key, callback):
+        """
+        The memcached "get" command, keeping the metadata of values stored
+        by get_or_compute. Other reads return the bare value.
+
+        Args:
+          key: str, see class docs for details.
+
+        Returns:
+          An Envelope for values stored by get_or_compute, the value for
+          other keys, or None if the key wasn't found.
+        """
+        server, key = self._get_server(key)
+        if not server:
+            callback(None)
+            return
+        server.fetch_cmd('get', [key], False, callback, single=True,
+                         envelopes=True)
+
+    @engine
+    def update_many(self, keys, fn, expire=0, attempts=3, callback=None):
+        """
+        Read, modify and write keys with optimistic locking.
+
+        Values are read with a "gets" per server, fn is applied to them
+        and the results are written back with "cas" commands pipelined
+        per server, or "add" for missing keys. Only keys modified or
+        deleted by someone else meanwhile are read and written again.
+
+        Args:
+          keys: list(str), see class docs for details.
+          fn: callable invoked as fn(key, value) with the key name and
+              its current value, or None if the key is missing. Returns the new value, or
+              None to leave the key alone.
+          expire: optional int, number of seconds until the items are
+                  expired from the cache, or zero for no expiry.
+          attempts: optional int, rounds at most before giving up on
+                    contended keys.
+
+        Returns:
+          A dict of key name to the value stored. Keys skipped by fn,
+          still contended after all attempts or that failed are missing.
+        """
+        # replies are keyed by name, while server pinned keys are routed
+        # by their (hash, name) tuple
+        keys = dict((key[1] if isinstance(key, tuple) else key, key)
+                    for key in keys)
+        retval, pending = {}, list(keys)
+        for attempt in range(attempts):
+            if not pending:
+                break
+            found = yield Task(self.gets_many,
+                               [keys[name] for name in pending])
+            updates = {}
+            for name in pending:
+                value, cas = found.get(name, (None, None))
+                value = fn(name, value)
+                if value is not None:
+                    updates[keys[name]] = (value, cas)
+            results = yield Task(self._store_many_cas, updates, expire)
+            # False means EXISTS, or NOT_STORED for a racing add, and None
+            # NOT_FOUND for a key deleted since it was read
+            pending = []
+            for name, stored in results.items():
+                if stored:
+                    retval[name] = updates[keys[name]][0]
+                else:
+                    pending.append(name)
+        callback and callback(retval)
+
+    def _store_many_cas(self, updates, expire, callback=None):
+        """Pipeline cas, or add if there's no cas, of {key: (value, cas)}"""
+        def on_response(server, result):
+            retval.update(result)
+            pending.remove(server)
+            if len(pending) == 0:
+                callback and callback(retval)
+
+        if not updates or not self._buckets:
+            callback and callback({})
+            return
+
+        # updates by key name, as routing drops forced placements
+        names = dict((key[1] if isinstance(key, tuple) else key, update)
+                     for key, update in updates.items())
+        retval, servers = dict(), self._route(list(updates))
+        if self._hotkeys is not None:
+            for name in names:
+                self._hotkeys.invalidate(name)
+        pending = list(servers)
+        for server, keys in servers.items():
+            items = [('add' if names[key][1] is None else 'cas', key,
+                      names[key][0], names[key][1]) for key in keys]
+            cb = stack_context.wrap(functools.partial(on_response, server))
+            server.store_many_cmd(items, expire, callback=cb)
+
+    def pipeline(self, ops, callback=None):
+        """
+        Send storage and delete commands with noreply, in a single write
+        per server.
+
+        Args:
+          ops: list of (name, key, value, expire) tuples, where name is a
+               storage command like 'set', or 'delete', for which value
+               and expire are ignored.
+
+        Returns:
+          A dict of server address to True once its commands have been
+          written, or None if they couldn't be.
+        """
+        def on_response(server, result):
+            retval[str(server)] = result
+            pending.remove(server)
+            if len(pending) == 0:
+                callback and callback(retval)
+
+        if not ops or not self._buckets:
+            callback and callback({})
+            return
+
+        batches = {}
+        for name, key, value, expire in ops:
+            server, key = self._get_server(key)
+            self._hotkeys and self._hotkeys.invalidate(key)
+            if name == 'delete':
+                cmd = b'delete ' + server.encode_key(key) + _NOREPLY
+            else:
+                cmd, _ = server.build_store(name, key, expire, True, value)
+            batches.setdefault(server, []).append(cmd)
+        retval, pending = dict(), list(batches)
+        for server, cmds in batches.items():
+            cb = stack_context.wrap(functools.partial(on_response, server))
+            server.misc_cmd(b''.join(cmds), 'pipeline', True, callback=cb,
+                            keys=len(cmds))
+
+    def delete(self, key, time=0, noreply=True, callback=None):
+        """
+        The memcached "delete" command.
+
+        Args:
+          key: str, see class docs for details.
+
+        Returns:
+          If noreply is True, always returns True. Otherwise returns True if
+          the key was deleted, and False if it wasn't found.
+        """
+        # Fetch memcached connection
+        server, key = self._get_server(key)
+        self._hotkeys and self._hotkeys.invalidate(key)
+        if not server:
+            callback and callback(None)
+            return
+        # compute command
+        cmd = b''.join((
+            b'delete ', server.encode_key(key),
+            _ascii(' %d' % time) if time else b'',
+            _NOREPLY if noreply else _CRLF))
+
+        # invoke
+        server.misc_cmd(cmd, 'delete', noreply, callback, reply=_is_deleted)
+
+    def delete_many(self, keys, noreply=True, callback=None):
+        """
+        A convenience function to delete multiple keys.
+
+        Args:
+          keys: list(str), the list of keys to delete.
+
+        Returns:
+          True. If an exception is raised then all, some or none of the keys
+          may have been deleted. Otherwise all the keys have been sent to
           memcache for deletion and if noreply is False, they have been
           acknowledged by memcache.
         """
@@ -617,19 +1773,13 @@ class Client(object):
 
         if not keys:
             callback and callback({})
+            return
 
-        # init vars
-        retval, servers = dict(), dict()
+        # delete them
+        retval = dict()
         for key in keys:
-            server, key = self._get_server(key)
-            servers[key] = server
-        # set it
-        for key, server in servers.iteritems():
-            if server is None:
-                on_response(key, False)
-                continue
             cb = stack_context.wrap(functools.partial(on_response, key))
-            self.delete(key, noreply, callback=cb)
+            self.delete(key, noreply=noreply, callback=cb)
 
     def incr(self, key, value, noreply=False, callback=None):
         """
@@ -644,22 +1794,19 @@ class Client(object):
           If noreply is True, always returns None. Otherwise returns the new
           value of the key, or False if the key wasn't found.
         """
-        def on_response(data):
-            result = False if data.startswith('NOT_FOUND') else int(data)
-            callback and callback(result)
-
         # Fetch memcached connection
         server, key = self._get_server(key)
+        self._hotkeys and self._hotkeys.invalidate(key)
         if not server:
             callback and callback(None)
             return
 
-        replarg = ' noreply' if noreply else ''
-        cmd = "incr {0} {1}{2}\r\n".format(key, str(value), replarg)
+        cmd = b''.join((b'incr ', server.encode_key(key),
+                        _ascii(' %s' % value),
+                        _NOREPLY if noreply else _CRLF))
 
         # invoke
-        cb = callback if noreply else stack_context.wrap(on_response)
-        server.misc_cmd(cmd, 'incr', noreply, callback=cb)
+        server.misc_cmd(cmd, 'incr', noreply, callback, reply=_counter)
 
     def decr(self, key, value, noreply=False, callback=None):
         """
@@ -674,22 +1821,60 @@ class Client(object):
           If noreply is True, always returns None. Otherwise returns the new
           value of the key, or False if the key wasn't found.
         """
-        def on_response(data):
-            result = False if data.startswith('NOT_FOUND') else int(data)
-            callback and callback(result)
-
         # Fetch memcached connection
         server, key = self._get_server(key)
+        self._hotkeys and self._hotkeys.invalidate(key)
         if not server:
             callback and callback(None)
             return
 
-        replarg = ' noreply' if noreply else ''
-        cmd = "decr {0} {1}{2}\r\n".format(key, str(value), replarg)
+        cmd = b''.join((b'decr ', server.encode_key(key),
+                        _ascii(' %s' % value),
+                        _NOREPLY if noreply else _CRLF))
 
         # invoke
-        cb = callback if noreply else stack_context.wrap(on_response)
-        server.misc_cmd(cmd, 'decr', noreply, callback=cb)
+        server.misc_cmd(cmd, 'decr', noreply, callback, reply=_counter)
+
+    def incr_many(self, deltas, callback=None):
+        """
+        Pipeline "incr" and "decr" commands, in a single write per server.
+
+        Args:
+          deltas: dict of key to int, the amount to add to the key.
+                  Negative amounts are sent as "decr", zero ones skipped.
+
+        Returns:
+          A dict of key name to its new value, False if the key wasn't
+          found, or None if memcached refused to change it, like when it
+          isn't a number. Keys of servers that failed are missing.
+        """
+        def on_response(server, names, replies):
+            if replies is not None:
+                retval.update(zip(names, replies))
+            pending.remove(server)
+            if len(pending) == 0:
+                callback and callback(retval)
+
+        names = dict((key[1] if isinstance(key, tuple) else key, delta)
+                     for key, delta in deltas.items() if delta)
+        if not names or not self._buckets:
+            callback and callback({})
+            return
+
+        retval = dict()
+        servers = self._route([key for key in deltas if deltas[key]])
+        pending = list(servers)
+        for server, keys in servers.items():
+            cmds = []
+            for key in keys:
+                delta = names[key]
+                self._hotkeys and self._hotkeys.invalidate(key)
+                cmds.append(b''.join((
+                    b'incr ' if delta > 0 else b'decr ',
+                    server.encode_key(key), _ascii(' %d\r\n' % abs(delta)))))
+            cb = stack_context.wrap(
+                functools.partial(on_response, server, keys))
+            server.counter_many_cmd(cmds, callback=cb)
 
     def touch(self, key, expire=0, noreply=True, callback=None):
         """
@@ -705,21 +1890,18 @@ class Client(object):
           True if the expiration time was updated, False if the key wasn't
           found.
         """
-        def on_response(data):
-            callback and callback(data.startswith('TOUCHED'))
-
         # Fetch memcached connection
         server, key = self._get_server(key)
         if not server:
             callback and callback(None)
             return
 
-        replarg = ' noreply' if noreply else ''
-        cmd = "touch {0} {1}{2}\r\n".format(key, expire, replarg)
+        cmd = b''.join((b'touch ', server.encode_key(key),
+                        _ascii(' %d' % expire),
+                        _NOREPLY if noreply else _CRLF))
 
         # invoke
-        cb = callback if noreply else stack_context.wrap(on_response)
-        server.misc_cmd(cmd, 'touch', noreply, callback=cb)
+        server.misc_cmd(cmd, 'touch', noreply, callback, reply=_is_touched)
 
     def stats(self, server, *args, **kwargs):
         """
@@ -738,8 +1920,8 @@ class Client(object):
         """
         def on_response(data):
             result = {}
-            for key, value in data.iteritems():
-                converter = STAT_TYPES.get(key, int)
+            for key, value in data.items():
+                converter = types.get(key, int)
                 try:
                     result[key] = converter(value)
                 except Exception:
@@ -753,9 +1935,99 @@ class Client(object):
             return
 
         # invoke
+        types = STAT_TYPES_BY_KIND.get(args[0] if args else 'general', {})
         cb = stack_context.wrap(on_response)
         server.fetch_cmd('stats', args, False, callback=cb)
 
+    def cluster_stats(self, kinds=('general', 'slabs', 'items', 'settings'),
+                      callback=None):
+        """
+        Structured stats of every server.
+
+        Runs the requested "stats" variants on each server and parses
+        them into nested structures (slab classes, item classes) that are
+        also aggregated across the cluster.
+
+        Args:
+          kinds: optional list of 'general', 'slabs', 'items' and
+                 'settings'.
+
+        Returns:
+          A torncache.stats.Snapshot. Call snapshot.rates(previous) to
+          get per second deltas between two of them.
+        """
+        @engine
+        def fetch(server):
+            result = {}
+            # one command at a time per connection
+            for kind in kinds:
+                args = () if kind == 'general' else (kind,)
+                result[kind] = yield Task(self.stats, server, *args)
+            on_response(server, result)
+
+        def on_response(server, result):
+            retval[str(server)] = result
+            if len(retval) == len(self._servers):
+                callback(mcstats.Snapshot(retval, timestamp))
+
+        for kind in kinds:
+            if kind not in mcstats.PARSERS:
+                raise ValueError("Unknown stats kind: {0}".format(kind))
+        retval, timestamp = {}, time.time()
+        if not self._servers:
+            callback(mcstats.Snapshot(retval, timestamp))
+            return
+        for server in self._servers:
+            fetch(server)
+
+    def metadump(self, on_record, slabs='all', callback=None):
+        """
+        Stream the metadata of every cached key.
+
+        Sends "lru_crawler metadump" to all servers and parses the reply
+        incrementally, so the dump is never held in memory. Requires
+        memcached 1.4.31 or newer.
+
+        Args:
+          on_record: callable invoked with a KeyRecord (key, exp, la, cas,
+                     fetch, cls, size, server) for every key found. exp is
+                     an absolute timestamp or -1 for keys without expiry.
+                     It may return a Future to pause the dump of that
+                     server until the Future is done.
+          slabs: optional 'all' or a list of slab class ids.
+
+        Returns:
+          A dict of server to number of records streamed from it, or to
+          None if the dump failed on that server.
+        """
+        def on_line(server, line):
+            try:
+                record = _parse_metadump(_native(line), server)
+            except (KeyError, ValueError):
+                logging.warning("Unexpected metadump line: %r", line[:64])
+                return
+            return on_record(record)
+
+        def on_response(server, result):
+            retval[server] = result
+            if len(retval) == len(self._servers):
+                callback and callback(retval)
+
+        if not isinstance(slabs, basestring):
+            slabs = ','.join(str(slab) for slab in slabs)
+        cmd = _ascii("lru_crawler metadump {0}\r\n".format(slabs))
+
+        retval = {}
+        if not self._servers:
+            callback and callback(retval)
+            return
+        for server in self._servers:
+            line_cb = stack_context.wrap(
+                functools.partial(on_line, str(server)))
+            cb = stack_context.wrap(
+                functools.partial(on_response, str(server)))
+            server.stream_cmd(cmd, 'metadump', line_cb, callback=cb)
+
     def flush_all(self, server, delay=0, noreply=True, callback=None):
         """
         The memcached "flush_all" command.
@@ -768,21 +2040,17 @@ class Client(object):
         Returns:
           True.
         """
-        def on_response(data):
-            callback and callback(data.startswith('OK'))
-
         # Fetch memcached connection
         server = self._find_server(server)
         if not server:
             callback and callback(None)
             return
 
-        replarg = ' noreply' if noreply else ''
-        cmd = "flush_all {0} {1}\r\n".format(delay, replarg)
+        cmd = _ascii('flush_all %d' % delay) + (_NOREPLY if noreply else _CRLF)
 
         # invoke
-        cb = callback if noreply else stack_context.wrap(on_response)
-        server.misc_cmd(cmd, 'flush_all', noreply, callback=cb)
+        server.misc_cmd(cmd, 'flush_all', noreply, callback, keys=0,
+                        reply=_is_ok)
 
     def quit(self, server, callback=None):
         """
@@ -801,41 +2069,468 @@ class Client(object):
         if not server:
             raise MemcacheClientError("Unknown Server {0}".format(server))
 
-        cmd = "quit\r\n"
+        cmd = b"quit\r\n"
         cb = stack_context.wrap(on_response)
-        server.misc_cmd(cmd, 'quit', True, callback=cb)
+        server.misc_cmd(cmd, 'quit', True, callback=cb, keys=0)
+
+
+class Request(object):
+    """
+    A command in flight on a connection.
+
+    Steps are bound methods of this object rather than a coroutine, so
+    running a command allocates the request and few other objects. The
+    callback, and errors when ignore_exc is unset, are delivered in the
+    stack context the command was issued from. The wrapper restoring it
+    is only allocated for commands issued under a StackContext.
+    """
+
+    __slots__ = ('conn', 'name', 'cmd', 'noreply', 'trace', 'admitted',
+                 'callback', 'done')
+
+    # Kind of command, for timeout messages
+    kind = 'misc'
+    # Result on errors, if ignore_exc is set
+    default = None
+
+    def __init__(self, conn, name, cmd, noreply, callback, keys, size):
+        self.conn = conn
+        self.name = name
+        self.cmd = cmd
+        self.noreply = noreply
+        self.trace = conn._hooks.trace(name, conn, keys, size) \
+            if conn._hooks else None
+        self.admitted = False
+        self.callback = callback
+        self.done = stack_context.wrap(self._done) \
+            if _in_stack_context() else None
+
+    def __str__(self):
+        return "{0} '{1}'".format(self.kind, self.name)
+
+    def start(self):
+        self.conn._acquire(self.on_acquire)
+
+    def on_acquire(self, admitted):
+        conn = self.conn
+        self.admitted = admitted
+        if not admitted:
+            self.fail(MemcacheBackpressureError(str(conn)))
+            return
+        # Open connection if required
+        if not conn.closed():
+            self.on_connect(conn)
+            return
+        try:
+            conn.connect(self.on_connect)
+        except Exception as err:
+            self.fail(err)
+
+    def on_connect(self, conn):
+        if conn is None:
+            self.fail(self.conn._closed_error(self.name))
+            return
+        conn._add_timeout(self)
+        try:
+            conn._io(conn._stream.write, self.cmd, self.on_write)
+        except Exception as err:
+            self.fail(err)
+
+    def on_write(self, written):
+        if written is None:
+            self.fail(self.conn._closed_error(self.name))
+            return
+        self.trace and self.trace.fire('write')
+        if self.noreply:
+            self.finish(True)
+            return
+        try:
+            self.read_line()
+        except Exception as err:
+            self.fail(err)
 
+    def read_line(self):
+        conn = self.conn
+        conn._io(conn._stream.read_until, b'\r\n', self.on_line)
 
-class Connection:
+    def on_line(self, line):
+        try:
+            # strip the terminator, None means the stream closed
+            line = line and line[:-2]
+            self.conn._raise_errors(line, self.name)
+            result = self.parse(line)
+        except Exception as err:
+            self.fail(err)
+            return
+        # outside the try, so errors of the callback aren't ours
+        result is not _MORE and self.finish(result)
+
+    def parse(self, line):
+        """Result for a reply line, or _MORE once more is being read"""
+        raise NotImplementedError()
+
+    def finish(self, result):
+        self.trace and self.trace.fire('complete')
+        self.release()
+        self.deliver(result)
+
+    def fail(self, err):
+        self.conn._on_error(err, self.trace)
+        self.release()
+        self.deliver(self.default, err)
+
+    def release(self):
+        if self.admitted:
+            self.admitted = False
+            self.conn._clear_timeout()
+            self.conn._release()
+
+    def deliver(self, result, error=None):
+        if self.done is not None:
+            self.done(result, error)
+        elif _in_stack_context():
+            # issued outside of any context, so don't run in this one
+            with stack_context.NullContext():
+                self._done(result, error)
+        else:
+            self._done(result, error)
+
+    def _done(self, result, error=None):
+        if error is not None and not self.conn._ignore_exc:
+            raise error
+        self.callback and self.callback(result)
+
+
+class FetchRequest(Request):
+    """
+    A retrieval command, reading VALUE blocks until END.
+
+    If the connection has a deserialize_many hook, raw values are kept
+    until the reply is complete and then decoded at once, off the
+    IOLoop when the connection has an executor and the reply is large.
+
+    Values over the max_value_size of the connection, or that would take
+    the reply over its max_response_size, are drained without being
+    buffered and reported as misses.
+    """
+
+    __slots__ = ('names', 'expect_cas', 'single', 'envelopes', 'values',
+                 'items', 'size', 'key', 'flags', 'cas', 'left')
+
+    kind = 'fetch'
+
+    def __init__(self, conn, name, cmd, names, expect_cas, single, callback,
+                 envelopes=False):
+        Request.__init__(self, conn, name, cmd, False, callback,
+                         len(names), len(cmd))
+        self.names = names
+        self.expect_cas = expect_cas
+        self.single = single
+        self.envelopes = envelopes
+        self.values = {}
+        # raw (key, value, flags) items, in batch mode, and size of the
+        # values read
+        self.items = [] if conn._deserialize_many else None
+        self.size = 0
+        self.key = self.flags = self.cas = None
+        # bytes of the value being drained
+        self.left = 0
+
+    @property
+    def default(self):
+        if not self.single:
+            return {}
+        return (None, None) if self.expect_cas else None
+
+    def result(self):
+        if not self.single:
+            return self.values
+        values = self.values
+        return values.popitem()[1] if values else self.default
+
+    def oversized(self, size):
+        """Whether a value of size bytes must be drained, not kept"""
+        conn = self.conn
+        if conn._max_value_size is not None and size > conn._max_value_size:
+            return True
+        limit = conn._max_response_size
+        return limit is not None and self.size + size > limit
+
+    def parse(self, line):
+        trace = self.trace
+        if trace and 'first_byte' not in trace.timings:
+            trace.fire('first_byte')
+
+        if line == b'END':
+            if not self.items:
+                return self.result()
+            conn = self.conn
+            if conn._executor is None or self.size < conn._executor_threshold:
+                self.merge(conn._decode_many(self.items, self.envelopes))
+                return self.result()
+            # the reply is read, so let other commands use the stream
+            self.release()
+            future = conn._executor.submit(
+                conn._decode_many, self.items, self.envelopes)
+            conn._ioloop.add_future(future, self.on_decoded)
+        elif line.startswith(b'VALUE'):
+            if self.expect_cas:
+                _, key, flags, size, self.cas = line.split()
+            else:
+                _, key, flags, size = line.split()
+            self.key, self.flags, size = key, int(flags), int(size)
+            if size < 0:
+                raise MemcacheUnknownError(line[:32])
+            conn = self.conn
+            if self.oversized(size):
+                conn._oversized['values'] += 1
+                self.left = size + 2
+                self.drain()
+                return _MORE
+            # read also \r\n
+            conn._io(conn._stream.read_bytes, size + 2, self.on_value)
+        elif self.name == 'stats' and line.startswith(b'STAT'):
+            # values may contain spaces, like in "stats settings"
+            _, key, value = _native(line).split(' ', 2)
+            self.values[key] = value
+            self.read_line()
+        else:
+            raise MemcacheUnknownError(line[:32])
+        return _MORE
+
+    def on_value(self, value):
+        try:
+            if value is None:
+                raise self.conn._closed_error(self.name)
+            key = self.names.get(self.key, self.key)
+            self.size += len(value)
+            if self.items is not None:
+                self.items.append((key, value[:-2], self.flags))
+                # cas is kept until values are decoded
+                self.values[key] = self.cas
+            else:
+                value = self.conn._decode(
+                    key, value[:-2], self.flags, self.envelopes)
+                self.values[key] = (value, self.cas) if self.expect_cas \
+                    else value
+            self.read_line()
+        except Exception as err:
+            self.fail(err)
+
+    def drain(self):
+        """Read the next chunk of a skipped value, and drop it"""
+        conn = self.conn
+        conn._io(conn._stream.read_bytes, min(self.left, DRAIN_CHUNK_SIZE),
+                 self.on_drained)
+
+    def on_drained(self, data):
+        try:
+            if data is None:
+                raise self.conn._closed_error(self.name)
+            self.left -= len(data)
+            self.conn._oversized['bytes'] += len(data)
+            if self.left:
+                self.drain()
+            else:
+                self.read_line()
+        except Exception as err:
+            self.fail(err)
+
+    def merge(self, decoded):
+        values = self.values
+        if self.expect_cas:
+            for key, value in decoded.items():
+                values[key] = (value, values[key])
+        else:
+            values.update(decoded)
+
+    def on_decoded(self, future):
+        try:
+            self.merge(future.result())
+        except Exception as err:
+            self.fail(err)
+            return
+        self.finish(self.result())
+
+
+class StoreRequest(Request):
+    """A storage command, answered with a single status line"""
+
+    __slots__ = ()
+
+    kind = 'store'
+
+    def parse(self, line):
+        self.trace and self.trace.fire('first_byte')
+        if line not in VALID_STORE_RESULTS[self.name]:
+            raise MemcacheUnknownError(line[:32])
+        return STORE_RESULTS[line]
+
+
+class PipelineRequest(Request):
+    """Commands written at once and answered with a line each"""
+
+    __slots__ = ('count', 'replies')
+
+    kind = 'pipeline'
+
+    def __init__(self, conn, name, cmd, count, size, callback):
+        Request.__init__(self, conn, name, cmd, False, callback, count, size)
+        self.count = count
+        self.replies = []
+
+    def parse(self, line):
+        replies = self.replies
+        if self.trace and not replies:
+            self.trace.fire('first_byte')
+        replies.append(self.reply(line))
+        if len(replies) < self.count:
+            self.read_line()
+            return _MORE
+        return self.result()
+
+    def reply(self, line):
+        """Result for the reply line of the next command"""
+        return line
+
+    def result(self):
+        return self.replies
+
+    def fail(self, err):
+        # replies of the remaining commands would be read by others
+        if self.admitted and len(self.replies) < self.count:
+            self.conn.close()
+        Request.fail(self, err)
+
+
+class StoreManyRequest(PipelineRequest):
+    """
+    Pipelined storage commands.
+
+    Args:
+      items: list of (command name, key), in the order they were sent.
+    """
+
+    __slots__ = ('items',)
+
+    kind = 'store'
+
+    def __init__(self, conn, cmd, items, size, callback):
+        PipelineRequest.__init__(self, conn, 'store_many', cmd, len(items),
+                                 size, callback)
+        self.items = items
+
+    @property
+    def default(self):
+        return {}
+
+    def reply(self, line):
+        name, _ = self.items[len(self.replies)]
+        if line not in VALID_STORE_RESULTS[name]:
+            raise MemcacheUnknownError(line[:32])
+        return STORE_RESULTS[line]
+
+    def result(self):
+        return dict((key, result) for (_, key), result
+                    in zip(self.items, self.replies))
+
+
+class CounterManyRequest(PipelineRequest):
+    """
+    Pipelined "incr" and "decr" commands.
+
+    A counter memcached can't change, like one holding a non-numeric
+    value, is answered with CLIENT_ERROR. Its result is None, and the
+    other commands of the batch go on.
+    """
+
+    __slots__ = ()
+
+    def on_line(self, line):
+        if line is not None and line.startswith(b'CLIENT_ERROR'):
+            # only this command was refused, so replies are still in step
+            line = b'CLIENT_ERROR'
+            result = self.parse(line)
+            result is not _MORE and self.finish(result)
+            return
+        PipelineRequest.on_line(self, line)
+
+    def reply(self, line):
+        return None if line == b'CLIENT_ERROR' else _counter(line)
+
+
+class MiscRequest(Request):
+    """
+    A command answered with a single line.
+
+    Args:
+      reply: optional callable mapping the reply line to the result.
+    """
+
+    __slots__ = ('reply',)
+
+    def __init__(self, conn, name, cmd, noreply, callback, keys, reply):
+        Request.__init__(self, conn, name, cmd, noreply, callback,
+                         keys, len(cmd))
+        self.reply = reply
+
+    def parse(self, line):
+        self.trace and self.trace.fire('first_byte')
+        return line if self.reply is None else self.reply(line)
+
+
+class Connection(object):
     """ A Client connection to a Server"""
 
+    __slots__ = (
+        'weight', 'ip', 'port', '_ioloop', '_ignore_exc', '_hooks',
+        '_hash_long_keys', '_timeout', '_deadline', '_timeout_reason',
+        '_request_timeout', '_connect_timeout', '_serializer',
+        '_deserializer', '_stream', '_no_delay', '_dead_until', '_dead_retry',
+        '_connect_callbacks', '_busy', '_waiting', '_limiter', '_pending',
+        '_abort_error', '_on_io', '_on_timer', '_deserialize_many',
+        '_executor', '_executor_threshold', '_max_value_size',
+        '_max_response_size', '_max_buffer_size', '_oversized')
+
     def __init__(self, host, ioloop=None, serializer=None, deserializer=None,
                  connect_timeout=5, timeout=1, no_delay=True, ignore_exc=False,
-                 dead_retry=30):
+                 dead_retry=30, hooks=None, limits=None,
+                 hash_long_keys=False, deserialize_many=None, executor=None,
+                 executor_threshold=65536, max_value_size=None,
+                 max_response_size=None,
+                 max_buffer_size=DEFAULT_MAX_BUFFER_SIZE):
 
-        # Parse host conf and weight
-        self.weight = 1
-        if isinstance(host, tuple):
-            host, self.weight = host
-
-        # Parse host port
-        self.ip, self.port = host, 11211
-        if ":" in host:
-            self.ip, _, self.port = host.partition(":")
-            self.port = int(self.port)
+        # Parse host conf, port and weight
+        self.ip, self.port, self.weight = _parse_host(host)
 
         # Protected data
         self._ioloop = ioloop or IOLoop.instance()
         self._ignore_exc = ignore_exc
+        self._hooks = hooks
+        self._hash_long_keys = hash_long_keys
 
-        # Timeouts
+        # Timeouts. A single timer is kept on the IOLoop and moved only
+        # when it fires before the deadline of the operation in progress
         self._timeout = None
+        self._deadline = None
+        self._timeout_reason = None
         self._request_timeout = timeout
         self._connect_timeout = connect_timeout
 
-        # Data
+        # Data. Multi-get replies of executor_threshold bytes or more are
+        # decoded on the executor, if any
         self._serializer = serializer
         self._deserializer = deserializer
+        self._deserialize_many = deserialize_many
+        self._executor = executor
+        self._executor_threshold = executor_threshold
+
+        # Memory bounds. Values over the limits are skipped, and the
+        # stream is closed if its buffer grows over max_buffer_size
+        self._max_value_size = max_value_size
+        self._max_response_size = max_response_size
+        self._max_buffer_size = max_buffer_size
+        self._oversized = dict.fromkeys(('values', 'bytes'), 0)
 
         # Connections properites
         self._stream = None
@@ -844,41 +2539,176 @@ class Connection:
         self._dead_retry = dead_retry
         self._connect_callbacks = []
 
+        # Commands run one at a time on the stream. Slots to the server
+        # are shared with other connections through limits
+        self._busy = False
+        self._waiting = collections.deque()
+        self._limiter = limits.limiter(str(self)) if limits else None
+        # Callback of the stream operation in progress, and the error
+        # that made us close the stream, if any
+        self._pending = None
+        self._abort_error = None
+
+        # Bound once, as they are handed to the IOLoop on every command
+        self._on_io = self._io_done
+        self._on_timer = self._timer_fired
+
     def __str__(self):
-        retval = "%s:%d" % (self.ip, self.port)
+        retval = self.address
         if self._dead_until:
             retval += " (dead until %d)" % self._dead_until
         return retval
 
+    @property
+    def address(self):
+        """The "ip:port" of the server"""
+        return "%s:%d" % (self.ip, self.port)
+
     def _raise_errors(self, line, name):
-        if line.startswith('ERROR'):
+        if line is None:
+            raise self._closed_error(name)
+
+        if line.startswith(b'ERROR'):
             raise MemcacheUnknownCommandError(name)
 
-        if line.startswith('CLIENT_ERROR'):
-            error = line[line.find(' ') + 1:]
-            raise MemcacheClientError(error)
+        if line.startswith(b'CLIENT_ERROR'):
+            error = line[line.find(b' ') + 1:]
+            raise MemcacheClientError(_native(error))
 
-        if line.startswith('SERVER_ERROR'):
-            error = line[line.find(' ') + 1:]
-            raise MemcacheServerError(error)
+        if line.startswith(b'SERVER_ERROR'):
+            error = line[line.find(b' ') + 1:]
+            raise MemcacheServerError(_native(error))
 
-    def _add_timeout(self, reason):
-        """Add a timeout handler"""
-        def on_timeout():
-            self._timeout = None
-            self.mark_dead(reason)
-            raise MemcacheTimeoutError(reason)
+    def encode_key(self, key):
+        """Key as sent to this server. See encode_key"""
+        return encode_key(key, self._hash_long_keys)
 
-        if self._request_timeout:
-            self._clear_timeout()
-            self._timeout = self._ioloop.add_timeout(
-                time.time() + self._request_timeout,
-                stack_context.wrap(on_timeout))
+    def _closed_error(self, name):
+        """Error for a command interrupted by the stream closing"""
+        return self._abort_error or MemcacheUnexpectedCloseError(name)
 
-    def _clear_timeout(self):
+    def _on_error(self, err, trace):
+        trace and trace.fire('complete', err)
+        if isinstance(err, (IOError, OSError)):
+            self.mark_dead(str(err))
+        elif isinstance(err, MemcacheUnknownError):
+            # we lost track of the reply, so the stream is useless
+            self.close()
+
+    def _add_timeout(self, reason, timeout=None):
+        """
+        Time out the operation in progress.
+
+        Args:
+          reason: what is timing out, formatted in the error message.
+          timeout: optional float, seconds. Defaults to the request one.
+        """
+        timeout = timeout or self._request_timeout
+        if not timeout:
+            return
+        self._deadline = time.time() + timeout
+        self._timeout_reason = reason
         if self._timeout is not None:
+            if self._timeout.deadline <= self._deadline:
+                # fires early and gets moved
+                return
             self._ioloop.remove_timeout(self._timeout)
-            self._timeout = None
+        self._timeout = self._ioloop.add_timeout(
+            self._deadline, self._on_timer)
+
+    def _clear_timeout(self):
+        self._deadline = None
+
+    def _timer_fired(self):
+        self._timeout = None
+        if self._deadline is None:
+            return
+        if time.time() < self._deadline:
+            self._timeout = self._ioloop.add_timeout(
+                self._deadline, self._on_timer)
+            return
+        # Closing the stream fails the command waiting on it
+        self._deadline = None
+        reason = "Timeout on {0}".format(self._timeout_reason)
+        self._abort_error = MemcacheTimeoutError(reason)
+        self.mark_dead(reason)
+        self.close()
+
+    def _on_close(self, stream):
+        if stream is not self._stream:
+            return
+        self._clear_timeout()
+        if stream.error:
+            logging.error("Connection to %s closed: %s", self, stream.error)
+        callbacks, self._connect_callbacks = self._connect_callbacks, []
+        for callback in callbacks:
+            callback and callback(None)
+        pending, self._pending = self._pending, None
+        pending and pending(None)
+
+    def _acquire(self, callback):
+        """
+        Wait for a server slot and then for the stream to be idle.
+
+        Calls back with False if the limiter rejected the command.
+        """
+        if self._limiter is None:
+            self._on_slot(callback, True)
+        else:
+            self._limiter.acquire(functools.partial(self._on_slot, callback))
+
+    def _on_slot(self, callback, admitted):
+        if not admitted:
+            callback(False)
+        elif self._busy:
+            self._waiting.append(callback)
+        else:
+            self._busy = True
+            callback(True)
+
+    def _release(self, slot=True):
+        """
+        Hand the stream to the next command in line, and give back the
+        limiter slot of the command done, if it took one.
+        """
+        slot and self._limiter and self._limiter.release()
+        if self._waiting:
+            callback = self._waiting.popleft()
+            self._ioloop.add_callback(functools.partial(callback, True))
+        else:
+            self._busy = False
+
+    def _io(self, method, arg, callback):
+        """
+        Run a stream operation. Calls back with its data, True for
+        writes, or None if the stream closes before it completes.
+        """
+        method(arg, self._on_io)
+        self._pending = callback
+
+    def _io_done(self, data=True):
+        callback, self._pending = self._pending, None
+        callback(data)
+
+    def _readline(self, callback):
+        """Read a line without its terminator. See _io"""
+        self._io(self._stream.read_until, b"\r\n",
+                 lambda data: callback(data and data[:-2]))
+
+    def drain(self, callback=None):
+        """
+        Close the connection once the commands queued on it are done.
+
+        Calls back with the connection.
+        """
+        def on_idle(admitted):
+            self.close()
+            self._release(slot=False)
+            callback and callback(self)
+
+        # wait behind queued commands without a limiter slot, which could
+        # be refused and close the stream under them
+        self._on_slot(on_idle, True)
 
     def mark_dead(self, reason):
         """Quarintine MC server for a period of time"""
@@ -889,28 +2719,17 @@ class Connection:
             self.close()
 
     def connect(self, callback=None):
-        """Open a connection to MC server"""
-
-        def on_timeout(reason):
-            self._timeout = None
-            self.mark_dead(reason)
-            raise MemcacheTimeoutError(reason)
-
-        def on_close():
-            self._clear_timeout()
-            if self._stream and self._stream.error:
-                error = self._stream.error
-                self._stream = None
-                if self._connect_callbacks:
-                    self._connect_callbacks = None
-                    raise error
-                logging.error(self._stream.error)
+        """
+        Open a connection to MC server.
 
+        Calls back with the connection, or with None if it couldn't be
+        established.
+        """
         def on_connect():
             self._clear_timeout()
-            for callback in self._connect_callbacks:
+            callbacks, self._connect_callbacks = self._connect_callbacks, []
+            for callback in callbacks:
                 callback and callback(self)
-            self._connect_callbacks = None
 
         # Check if server is dead
         if self._dead_until > time.time():
@@ -919,206 +2738,219 @@ class Connection:
             raise MemcacheClientError(msg)
         self._dead_until = 0
 
-        # Check we are already connected
-        if self._connect_callbacks is None:
-            callback and callback(self)
+        # Check we are already connected, or connecting
+        if not self.closed():
+            if self._connect_callbacks:
+                self._connect_callbacks.append(callback)
+            else:
+                callback and callback(self)
             return
         self._connect_callbacks.append(callback)
-        if self._stream and not self._stream.closed():
-            return
-
-        # Connection closed. clean and start again
-        self.close()
+        self._abort_error = None
 
         # Set timeout
         if self._connect_timeout:
-            timeout_func = functools.partial(on_timeout, "Connection Timeout")
-            self._timeout = self._ioloop.add_timeout(
-                time.time() + self._connect_timeout,
-                stack_context.wrap(timeout_func))
+            self._add_timeout("connect", self._connect_timeout)
 
         # now connect
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         if self._no_delay:
             sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        self._stream = iostream.IOStream(sock, io_loop=self._ioloop)
-        self._stream.set_close_callback(on_close)
+        self._stream = iostream.IOStream(
+            sock, io_loop=self._ioloop, max_buffer_size=self._max_buffer_size)
+        self._stream.set_close_callback(
+            functools.partial(self._on_close, self._stream))
         self._stream.connect((self.ip, self.port), callback=on_connect)
 
     def send(self, cmd, callback):
         """Send a MC command"""
-        self._stream.write(cmd + "\r\n", callback)
-
-    @engine
-    def fetch_cmd(self, name, keys, expect_cas, callback):
-        # build command
-        try:
-            key_strs = []
-            for key in keys:
-                key = str(key)
-                if ' ' in key:
-                    error = "Key contains spaces: {0}".format(key)
-                    raise MemcacheIllegalInputError(error)
-                key_strs.append(key)
-        except UnicodeEncodeError as e:
-            raise MemcacheIllegalInputError(str(e))
+        self._stream.write(cmd + b"\r\n", callback)
 
-        try:
-            # Open connection if required
-            self.closed and (yield Task(self.connect))
+    def fetch_cmd(self, name, keys, expect_cas, callback, single=False,
+                  expire=None, envelopes=False):
+        """
+        Run a retrieval command.
 
-            # Add timeout for this request
-            self._add_timeout("Timeout on fetch '{0}'".format(name))
+        Calls back with a dict of the values found, keyed by the keys
+        given, or with the value of the only key if single is set. The
+        expire argument goes before the keys, as "gat" expects it.
+        Values stored as Envelopes are unwrapped unless envelopes is set.
+        """
+        names = {}
+        for key in keys:
+            names[self.encode_key(key)] = key
+        cmd = b''.join((
+            _command(name), b'' if expire is None else _ascii('%d ' % expire),
+            b' '.join(names), b'\r\n'))
+        FetchRequest(self, name, cmd, names, expect_cas, single,
+                     callback, envelopes).start()
+
+    def _decode(self, key, value, flags, envelopes=False):
+        """
+        Deserialize a value read from memcached. Its Envelope, if it has
+        one, is returned only if envelopes is set.
+        """
+        value, flags, envelope = _open_envelope(value, flags)
+        if self._deserializer:
+            value = self._deserializer(key, value, flags)
+        if envelopes and envelope is not None:
+            return Envelope(value, *envelope)
+        return value
+
+    def _decode_many(self, items, envelopes=False):
+        """
+        Deserialize the (key, value, flags) items of a reply with the
+        deserialize_many hook. Returns a dict of key to value, see _decode
+        for envelopes.
 
-            result = {}
-            # send command
+        It doesn't touch the connection state, so it's safe to run on
+        executor threads.
+        """
+        kept, batch = {}, []
+        for key, value, flags in items:
+            value, flags, envelope = _open_envelope(value, flags)
+            if envelopes and envelope is not None:
+                kept[key] = envelope
+            batch.append((key, value, flags))
+        retval = {}
+        for (key, _, _), value in zip(batch, self._deserialize_many(batch)):
+            if key in kept:
+                value = Envelope(value, *kept[key])
+            retval[key] = value
+        return retval
 
-            cmd = '{0} {1}\r\n'.format(name, ' '.join(key_strs))
-            _ = yield Task(self._stream.write, cmd)
-            # parse response
-            while True:
-                line = yield Task(self._stream.read_until, "\r\n")
-                line = line[:-2]
-                self._raise_errors(line, name)
+    def build_store(self, name, key, expire, noreply, data, cas=None):
+        """
+        Serialize a storage command. Returns (cmd, payload size)
 
-                if line == 'END':
-                    break
-                elif line.startswith('VALUE'):
-                    if expect_cas:
-                        _, key, flags, size, cas = line.split()
-                    else:
-                        _, key, flags, size = line.split()
-                    # read also \r\n
-                    value = yield Task(self._stream.read_bytes, int(size) + 2)
-                    value = value[:-2]
-                    if self._deserializer:
-                        value = self._deserializer(key, value, int(flags))
-                    if expect_cas:
-                        result[key] = (value, cas)
-                    else:
-                        result[key] = value
-                elif name == 'stats' and line.startswith('STAT'):
-                    _, key, value = line.split()
-                    result[key] = value
-                else:
-                    raise MemcacheUnknownError(line[:32])
-        except Exception as err:
-            if isinstance(err, (IOError, OSError)):
-                self.mark_dead(str(err))
-            if self._ignore_exc:
-                self._clear_timeout()
-                callback({})
-                return
-            raise
-        #return result
-        self._clear_timeout()
-        callback(result)
+        Envelope values are stored as '<delta> <expiry> <value>' with
+        ENVELOPE_FLAG set on top of the serializer flags.
+        """
+        wire_key = self.encode_key(key)
+        flags, header = 0, None
+        if isinstance(data, Envelope):
+            header = _ascii('%.6f %.3f ' % (data.delta, data.expiry))
+            data = data.value
+        if self._serializer:
+            data, flags = self._serializer(key, data)
+        data = encode_value(data)
+        if header is not None:
+            data, flags = header + data, flags | ENVELOPE_FLAG
+
+        # compute cmd. Only digits are allowed by memcached as cas
+        extra = _ascii(' %d %d %d' % (flags, expire, len(data)))
+        if cas is not None:
+            extra += b' ' + (cas if isinstance(cas, bytes) else _ascii(str(cas)))
+        cmd = b''.join((_command(name), wire_key, extra,
+                        _NOREPLY if noreply else _CRLF, data, _CRLF))
+        return cmd, len(data)
 
-    @engine
     def store_cmd(self, name, key, expire, noreply, data,
                   cas=None, callback=None):
-        try:
-            # process key
-            key = str(key)
-            if ' ' in key:
-                raise MemcacheIllegalInputError("Key contains spaces: %s", key)
-            # process cas. Only digits are allowed by memcached
-            # if cas is not None:
-            #     cas = str(cas)
-            #     if not cas.isdigit():
-            #         MemcacheIllegalInputError("Digit based cas was expected")
-            # process data
-            flags = 0
-            if self._serializer:
-                data, flags = self._serializer(key, data)
-            data = str(data)
-        except UnicodeEncodeError as e:
-            raise MemcacheIllegalInputError(str(e))
-
-        # compute cmd
-        if cas is not None and noreply:
-            extra = ' {0} noreply'.format(cas)
-        elif cas is not None and not noreply:
-            extra = ' {0}'.format(cas)
-        elif cas is None and noreply:
-            extra = ' noreply'
-        else:
-            extra = ''
+        cmd, size = self.build_store(name, key, expire, noreply, data, cas)
+        StoreRequest(self, name, cmd, noreply, callback, 1, size).start()
 
-        cmd = '{0} {1} {2} {3} {4}{5}\r\n{6}\r\n'.format(
-            name, key, flags, expire, len(data), extra, data)
+    def store_many_cmd(self, items, expire, callback=None):
+        """
+        Pipeline storage commands in a single write.
 
-        try:
-            # Open connection if required
-            self.closed and (yield Task(self.connect))
+        Args:
+          items: list of (command name, key, value, cas) tuples, with cas
+                 None for commands other than "cas". Keys must be unique.
 
-            # Add timeout for this request
-            self._add_timeout("Timeout on fetch '{0}'".format(name))
+        Calls back with a dict of key to result, as store_cmd returns
+        it, or an empty dict on errors.
+        """
+        cmds, names, size = [], [], 0
+        for name, key, value, cas in items:
+            cmd, length = self.build_store(name, key, expire, False, value,
+                                           cas)
+            cmds.append(cmd)
+            names.append((name, key))
+            size += length
+        StoreManyRequest(self, b''.join(cmds), names, size, callback).start()
+
+    def counter_many_cmd(self, cmds, callback=None):
+        """
+        Pipeline "incr" and "decr" commands.
 
-            yield Task(self._stream.write, cmd)
-            if noreply:
-                self._clear_timeout()
-                callback and callback(True)
-                return
+        Calls back with the list of results, see CounterManyRequest, or
+        None on errors.
+        """
+        cmd = b''.join(cmds)
+        CounterManyRequest(self, 'incr_many', cmd, len(cmds), len(cmd),
+                           callback).start()
 
-            line = yield Task(self._stream.read_until, "\r\n")
-            line = line[:-2]
-            self._raise_errors(line, name)
-            self._clear_timeout()
+    def misc_cmd(self, cmd, cmd_name, noreply, callback=None, keys=1,
+                 reply=None):
+        """
+        Run a command answered with a single line.
 
-            if line in VALID_STORE_RESULTS[name]:
-                if line == 'STORED':
-                    callback(True)
-                elif line == 'NOT_STORED':
-                    callback(False)
-                # only for cas related actions
-                elif line == 'NOT_FOUND':
-                    callback(None)
-                elif line == 'EXISTS':
-                    callback(False)
-            else:
-                raise MemcacheUnknownError(line[:32])
-        except Exception as err:
-            if isinstance(err, (IOError, OSError)):
-                self.mark_dead(str(err))
-            if self._ignore_exc:
-                self._clear_timeout()
-                callback and callback(None)
-                return
-            raise
+        Calls back with True for noreply commands, the reply line, or
+        what reply returns for it if given. None on errors.
+        """
+        MiscRequest(self, cmd_name, cmd, noreply, callback, keys,
+                    reply).start()
 
     @engine
-    def misc_cmd(self, cmd, cmd_name, noreply, callback=None):
+    def stream_cmd(self, cmd, cmd_name, on_line, callback=None):
+        """
+        Send cmd and feed every reply line to on_line until END.
 
+        If on_line returns a Future, reading stops until it's done.
+        """
+        trace = self._hooks.trace(cmd_name, self, 0, len(cmd)) \
+            if self._hooks else None
+
+        admitted = yield Task(self._acquire)
         try:
+            if not admitted:
+                raise MemcacheBackpressureError(str(self))
+
             # Open connection if required
-            self.closed and (yield Task(self.connect))
+            if self.closed() and not (yield Task(self.connect)):
+                raise self._closed_error(cmd_name)
 
             # Add timeout for this request
-            self._add_timeout("Timeout on misc '{0}'".format(cmd_name))
+            reason = "stream '{0}'".format(cmd_name)
+            self._add_timeout(reason)
 
             # send command
-            yield Task(self._stream.write, cmd)
-            if noreply:
-                self._clear_timeout()
-                callback and callback(True)
-                return
-
-            # wait for response
-            line = yield Task(self._stream.read_until, "\r\n")
-            self._raise_errors(line, cmd_name)
+            if not (yield Task(self._io, self._stream.write, cmd)):
+                raise self._closed_error(cmd_name)
+            trace and trace.fire('write')
 
+            count = 0
+            while True:
+                line = yield Task(self._readline)
+                if trace and not count:
+                    trace.fire('first_byte')
+                self._raise_errors(line, cmd_name)
+                if line == b'END':
+                    break
+                if line.startswith(b'BUSY'):
+                    raise MemcacheServerError(line)
+                # Streams may be long. Only time out if they stall
+                self._add_timeout(reason)
+                paused = on_line(line)
+                if paused is not None:
+                    # the caller is busy, not the server
+                    self._clear_timeout()
+                    yield paused
+                    self._add_timeout(reason)
+                count += 1
         except Exception as err:
-            if isinstance(err, (IOError, OSError)):
-                self.mark_dead(str(err))
-            if self._ignore_exc:
-                self._clear_timeout()
-                callback and callback(None)
-                return
-            raise
+            self._on_error(err, trace)
+            if not self._ignore_exc:
+                raise
+            count = None
+        else:
+            trace and trace.fire('complete')
+        finally:
+            self._clear_timeout()
+            admitted and self._release()
         # return result
-        self._clear_timeout()
-        callback and callback(line)
+        callback and callback(count)
 
     def read(self, rlen, callback):
         """Read operation"""
@@ -1126,7 +2958,7 @@ class Connection:
 
     def readline(self, callback):
         """Read a line"""
-        self._stream.read_until("\r\n", callback)
+        self._stream.read_until(b"\r\n", callback)
 
     def expect(self, text, callback):
         """Read a line and compare response with text"""
@@ -0,0 +1,222 @@
+# -*- mode: python; coding: utf-8 -*-
+
+"""
+Buffered counters
+
+Aggregates increments locally. Deltas are summed per key in memory and
+periodically sent as a single pipelined batch of "incr" and "decr"
+commands per server, so thousands of increments of a hot key cost one
+round trip. Counters missing in memcached are created with "add".
+"""
+
+import time
+import functools
+
+from tornado import stack_context
+
+
+def _name(key):
+    return key[1] if isinstance(key, tuple) else key
+
+
+class Counters(object):
+    """
+    Buffer increments of counters of a client.
+
+    Args:
+      client: a Client or a ClientPool.
+      interval: optional float, seconds deltas are held before being sent.
+      max_keys: optional int, keys with a pending delta. When reached,
+                every delta is flushed right away.
+      expire: optional int, expiry of counters created by a flush.
+
+    Counters are at most once: deltas of a batch that fails are dropped
+    and accounted in stats['lost'], as some of its commands may have been
+    applied. So are decrements of counters that don't exist, as memcached
+    counters can't go below zero, and deltas of keys that don't hold a
+    number, which don't hold back the other keys of the batch. Reads
+    wait for the deltas of their keys being sent, so they see them even
+    when a ClientPool runs them on another connection. Call close() on
+    shutdown to flush pending deltas.
+    """
+
+    def __init__(self, client, interval=1.0, max_keys=10000, expire=0,
+                 ioloop=None):
+        self._client = client
+        self._ioloop = ioloop or client._ioloop
+        self.interval = interval
+        self.max_keys = max_keys
+        self.expire = expire
+        # key name -> delta not sent yet
+        self._deltas = {}
+        # key name -> (hash, name) tuple of keys pinned to a server
+        self._pinned = {}
+        # key name -> number of flushes sending a delta of it
+        self._sending = {}
+        # reads waiting for those flushes
+        self._waiters = []
+        self._timeout = None
+        self.stats = dict.fromkeys(
+            ('increments', 'flushes', 'created', 'lost'), 0)
+
+    @property
+    def pending(self):
+        """Number of keys with a delta not sent yet"""
+        return len(self._deltas)
+
+    def _schedule(self):
+        if self._timeout is None:
+            self._timeout = self._ioloop.add_timeout(
+                time.time() + self.interval, stack_context.wrap(self.flush))
+
+    def _add(self, key, delta):
+        name = _name(key)
+        if name is not key:
+            self._pinned[name] = key
+        deltas = self._deltas
+        deltas[name] = deltas.get(name, 0) + delta
+
+    def incr(self, key, delta=1):
+        """Add delta to a counter. Negative deltas decrement it"""
+        # fail on illegal keys now rather than on flush
+        self._client.address_of(key)
+        self._add(key, delta)
+        self.stats['increments'] += 1
+        # flush as soon as the key table is full
+        if len(self._deltas) >= self.max_keys:
+            self.flush()
+        else:
+            self._schedule()
+
+    def decr(self, key, delta=1):
+        """Subtract delta from a counter"""
+        self.incr(key, -delta)
+
+    def _unsent(self, key):
+        return self._deltas.get(_name(key), 0)
+
+    def _when_sent(self, keys, callback):
+        """Call back once no delta of keys is being sent"""
+        if any(_name(key) in self._sending for key in keys):
+            self._waiters.append(
+                functools.partial(self._when_sent, keys, callback))
+        else:
+            callback()
+
+    def _sent(self, names):
+        for name in names:
+            count = self._sending.pop(name) - 1
+            if count:
+                self._sending[name] = count
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            waiter()
+
+    def get(self, key, callback):
+        """
+        Read a counter, including the deltas of this process not stored
+        in memcached yet.
+
+        Returns:
+          The counter as an int, or None if it doesn't exist.
+        """
+        def on_sent():
+            # deltas sent are in the stored value, the others are not
+            unsent = self._unsent(key)
+
+            def on_value(value):
+                if value is None:
+                    callback(unsent if unsent > 0 else None)
+                    return
+                callback(max(int(value) + unsent, 0))
+
+            self._client.get(key, callback=on_value)
+
+        self._when_sent([key], on_sent)
+
+    def get_many(self, keys, callback):
+        """Read many counters. See get"""
+        def on_sent():
+            unsent = dict((_name(key), self._unsent(key)) for key in keys)
+
+            def on_values(values):
+                retval = {}
+                for name, delta in unsent.items():
+                    value = values.get(name)
+                    if value is not None:
+                        retval[name] = max(int(value) + delta, 0)
+                    elif delta > 0:
+                        retval[name] = delta
+                callback(retval)
+
+            self._client.get_many(keys, callback=on_values)
+
+        self._when_sent(keys, on_sent)
+
+    def _create(self, missing, keys, callback):
+        def on_stored(result):
+            for name, delta in missing.items():
+                stored = result.get(name)
+                if stored is True:
+                    self.stats['created'] += 1
+                elif stored is False:
+                    # created by someone else meanwhile, increment it later
+                    self._add(keys[name], delta)
+                else:
+                    self.stats['lost'] += 1
+            if self._deltas:
+                self._schedule()
+            callback()
+
+        self._client.add_many(
+            dict((keys[name], str(delta)) for name, delta in missing.items()),
+            self.expire, callback=stack_context.wrap(on_stored))
+
+    def flush(self, callback=None):
+        """
+        Send every pending delta.
+
+        Returns:
+          True once memcached has answered every batch.
+        """
+        def on_replies(replies):
+            missing = {}
+            for name, delta in deltas.items():
+                reply = replies.get(name)
+                if reply is False and delta > 0:
+                    missing[name] = delta
+                elif reply is None or reply is False:
+                    # failed, not a number, or a decrement of a missing
+                    # counter
+                    self.stats['lost'] += 1
+            if not missing:
+                on_done()
+                return
+            self._create(missing, keys, on_done)
+
+        def on_done():
+            self._sent(deltas)
+            callback and callback(True)
+
+        if self._timeout is not None:
+            self._ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+        # routing keys, pinned to a server or not
+        keys = dict((name, self._pinned.pop(name, name))
+                    for name in self._deltas)
+        deltas = dict((name, delta) for name, delta in self._deltas.items()
+                      if delta)
+        self._deltas = {}
+        if not deltas:
+            callback and callback(True)
+            return
+        self.stats['flushes'] += 1
+        for name in deltas:
+            self._sending[name] = self._sending.get(name, 0) + 1
+        self._client.incr_many(
+            dict((keys[name], delta) for name, delta in deltas.items()),
+            callback=stack_context.wrap(on_replies))
+
+    def close(self, callback=None):
+        """Flush pending deltas. Call it on shutdown"""
+        self.flush(callback)
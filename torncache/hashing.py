@@ -0,0 +1,198 @@
+# -*- mode: python; coding: utf-8 -*-
+
+"""
+Key hashing and routing
+
+Stable hash functions used to map keys to servers, so every process
+(and the blocking client) routes a key to the same node regardless of
+interpreter hash randomization. partition() routes a whole list of keys
+in a single pass. With NumPy, big batches routed with fnv1a are hashed
+and bucketed as arrays; crc32 is already computed in C by zlib, so it
+stays on the scalar path. See torncache.benchmarks.routing.
+"""
+
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    text_type = unicode  # py2
+except NameError:
+    text_type = str  # py3
+
+# Batches smaller than this are routed in pure python even if NumPy is
+# present, as array setup would dominate
+NUMPY_THRESHOLD = 512
+
+_MASK = 0xffffffff
+
+
+def to_bytes(key):
+    """Bytes used to hash a key"""
+    if isinstance(key, bytes):
+        return key
+    if not isinstance(key, text_type):
+        key = str(key)
+        if isinstance(key, bytes):
+            return key
+    return key.encode('utf-8')
+
+
+def crc32(key):
+    """CRC-32 of key, as an unsigned int"""
+    return zlib.crc32(to_bytes(key)) & _MASK
+
+
+def fnv1a_32(key):
+    """32 bits FNV-1a hash of key"""
+    retval = 0x811c9dc5
+    for char in bytearray(to_bytes(key)):
+        retval = ((retval ^ char) * 0x01000193) & _MASK
+    return retval
+
+
+def murmur3_32(key, seed=0):
+    """32 bits MurmurHash3 (x86 variant) of key"""
+    data = bytearray(to_bytes(key))
+    length = len(data)
+    c1, c2 = 0xcc9e2d51, 0x1b873593
+    retval = seed
+    tail = length & ~3
+    for i in range(0, tail, 4):
+        k = data[i] | data[i + 1] << 8 | data[i + 2] << 16 | data[i + 3] << 24
+        k = (k * c1) & _MASK
+        k = ((k << 15) | (k >> 17)) & _MASK
+        retval ^= (k * c2) & _MASK
+        retval = ((retval << 13) | (retval >> 19)) & _MASK
+        retval = (retval * 5 + 0xe6546b64) & _MASK
+    k, rem = 0, length & 3
+    if rem == 3:
+        k ^= data[tail + 2] << 16
+    if rem >= 2:
+        k ^= data[tail + 1] << 8
+    if rem:
+        k ^= data[tail]
+        k = (k * c1) & _MASK
+        k = ((k << 15) | (k >> 17)) & _MASK
+        retval ^= (k * c2) & _MASK
+    # finalization mix
+    retval ^= length
+    retval ^= retval >> 16
+    retval = (retval * 0x85ebca6b) & _MASK
+    retval ^= retval >> 13
+    retval = (retval * 0xc2b2ae35) & _MASK
+    retval ^= retval >> 16
+    return retval
+
+
+HASHERS = {
+    'crc32': crc32,
+    'fnv1a': fnv1a_32,
+    'murmur3': murmur3_32,
+}
+
+
+def get_hasher(hasher):
+    """Resolve a hasher name or callable into a callable"""
+    if callable(hasher):
+        return hasher
+    try:
+        return HASHERS[hasher]
+    except KeyError:
+        raise ValueError("Unknown hasher: {0}".format(hasher))
+
+
+def _np_matrix(keys):
+    """Keys as a zero padded uint8 matrix plus their lengths"""
+    encoded = [key if key.__class__ is bytes else to_bytes(key)
+               for key in keys]
+    lengths = numpy.fromiter(map(len, encoded), dtype=numpy.intp,
+                             count=len(encoded))
+    width = int(lengths.max())
+    matrix = numpy.zeros((len(encoded), width), dtype=numpy.uint8)
+    matrix[numpy.arange(width) < lengths[:, None]] = numpy.frombuffer(
+        b''.join(encoded), dtype=numpy.uint8)
+    return matrix, lengths
+
+
+def np_fnv1a_32(keys):
+    """Vectorized fnv1a_32 of a list of keys"""
+    matrix, lengths = _np_matrix(keys)
+    prime = numpy.uint32(0x01000193)
+    retval = numpy.full(len(keys), 0x811c9dc5, dtype=numpy.uint32)
+    # one step per byte position, for all the keys that long at once
+    for column in range(matrix.shape[1]):
+        step = (retval ^ matrix[:, column]) * prime
+        retval = numpy.where(lengths > column, step, retval)
+    return retval
+
+
+# Hashers with a vectorized counterpart
+VECTORIZED = {
+    fnv1a_32: np_fnv1a_32,
+}
+
+
+def _np_partition(keys, buckets, vectorized):
+    # map every bucket to the position of its server
+    servers, owners, positions = [], [], {}
+    for server in buckets:
+        if server not in positions:
+            positions[server] = len(servers)
+            servers.append(server)
+        owners.append(positions[server])
+    # hash, bucket and group keys by server
+    owner = numpy.array(owners)[vectorized(keys) % len(buckets)]
+    order = numpy.argsort(owner, kind='mergesort')
+    counts = numpy.bincount(owner, minlength=len(servers))
+    retval, start = {}, 0
+    for position, count in enumerate(counts.tolist()):
+        if count:
+            chunk = order[start:start + count].tolist()
+            retval[servers[position]] = [keys[i] for i in chunk]
+            start += count
+    return retval
+
+
+def partition(keys, buckets, hasher=crc32):
+    """
+    Group keys by the server responsible for them.
+
+    Args:
+      keys: list of keys. A key may also be a tuple of (hash, key) to
+            force its placement, as accepted by Client.
+      buckets: list of servers, repeated according to their weight.
+      hasher: callable mapping a key to an unsigned int.
+
+    Returns:
+      A dict of server to the list of keys it owns, in the same order
+      they were given.
+    """
+    retval = {}
+    if not keys or not buckets:
+        return retval
+    if len(buckets) == 1:
+        retval[buckets[0]] = [k[1] if isinstance(k, tuple) else k
+                              for k in keys]
+        return retval
+    # Vectorized path for big batches without forced placements
+    vectorized = VECTORIZED.get(hasher)
+    if numpy is not None and vectorized and len(keys) >= NUMPY_THRESHOLD \
+            and not any(isinstance(key, tuple) for key in keys):
+        return _np_partition(keys, buckets, vectorized)
+    # pure python path
+    nbuckets = len(buckets)
+    for key in keys:
+        if isinstance(key, tuple):
+            serverhash, key = key[:2]
+        else:
+            serverhash = hasher(key)
+        server = buckets[serverhash % nbuckets]
+        try:
+            retval[server].append(key)
+        except KeyError:
+            retval[server] = [key]
+    return retval
@@ -0,0 +1,176 @@
+# -*- mode: python; coding: utf-8 -*-
+
+"""
+Hot key detection
+
+A count-min sketch plus a bounded top-k table estimate the most accessed
+keys with fixed memory and constant work per access. Counters decay
+periodically, on a callback of the IOLoop rather than in the access that
+finds them due, so that the ranking follows current traffic. The hottest
+keys can optionally be pinned into a small local cache, shielding the
+memcached node that owns them.
+"""
+
+import time
+import heapq
+import random
+import zlib
+import itertools
+from array import array
+
+from tornado.ioloop import IOLoop
+
+from torncache.hashing import to_bytes
+
+
+class CountMinSketch(object):
+    """
+    Approximate frequency counter.
+
+    Args:
+      width: int, counters per row. Error is about total / width.
+      depth: int, number of rows. Failure probability is about e ** -depth.
+    """
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('L', [0]) * width for _ in range(depth)]
+
+    def _indexes(self, key):
+        data = to_bytes(key)
+        h1 = zlib.crc32(data) & 0xffffffff
+        h2 = (zlib.crc32(data, h1) & 0xffffffff) | 1
+        width = self.width
+        return [(h1 + i * h2) % width for i in range(self.depth)]
+
+    def add(self, key, count=1):
+        """Count key and return its new estimate"""
+        retval = None
+        for row, index in zip(self.rows, self._indexes(key)):
+            value = row[index] + count
+            row[index] = value
+            if retval is None or value < retval:
+                retval = value
+        return retval
+
+    def estimate(self, key):
+        """Estimated number of times key was counted"""
+        return min(row[index]
+                   for row, index in zip(self.rows, self._indexes(key)))
+
+    def decay(self, factor=0.5):
+        """Scale down every counter"""
+        for i, row in enumerate(self.rows):
+            self.rows[i] = array('L', [int(v * factor) for v in row])
+
+
+class HotKeys(object):
+    """
+    Track the k most accessed keys.
+
+    Args:
+      size: int, number of hot keys to track.
+      sample: float, fraction of accesses counted, in (0, 1].
+      decay_interval: float, seconds between counter decays.
+      decay_factor: float, counters are multiplied by this on decay.
+      pin_ttl: optional float, if set, values of hot keys are cached
+               locally for this many seconds.
+      width, depth: count-min sketch dimensions.
+      ioloop: optional IOLoop decays run on. Defaults to the current one
+              when a decay is due.
+    """
+
+    def __init__(self, size=32, sample=1.0, decay_interval=60,
+                 decay_factor=0.5, pin_ttl=None, width=2048, depth=4,
+                 ioloop=None):
+        self.size = size
+        self.sample = sample
+        self.decay_interval = decay_interval
+        self.decay_factor = decay_factor
+        self.pin_ttl = pin_ttl
+        self.sketch = CountMinSketch(width, depth)
+        # top-k estimates, and a heap of (count, sequence, key) to find
+        # the coldest one. The sequence breaks ties, so keys are never
+        # compared. The heap may contain stale entries, skipped lazily
+        self._top = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._pinned = {}
+        self._ioloop = ioloop
+        self._next_decay = time.time() + decay_interval
+
+    def record(self, key):
+        """Account an access to key"""
+        if self.sample < 1 and random.random() >= self.sample:
+            return
+        now = time.time()
+        if now >= self._next_decay:
+            # decays touch every counter, keep them off the request path
+            self._next_decay = now + self.decay_interval
+            (self._ioloop or IOLoop.current()).add_callback(self.decay)
+        count = self.sketch.add(key)
+        top = self._top
+        if key in top or len(top) < self.size:
+            top[key] = count
+            self._push(count, key)
+        elif count > self._coldest():
+            evicted = heapq.heappop(self._heap)[2]
+            del top[evicted]
+            self._pinned.pop(evicted, None)
+            top[key] = count
+            self._push(count, key)
+        # Keep the heap bounded despite stale entries
+        if len(self._heap) > 4 * self.size:
+            self._rebuild()
+
+    def _push(self, count, key):
+        heapq.heappush(self._heap, (count, next(self._sequence), key))
+
+    def _coldest(self):
+        heap, top = self._heap, self._top
+        while heap and top.get(heap[0][2]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else 0
+
+    def _rebuild(self):
+        sequence = self._sequence
+        self._heap = [(count, next(sequence), key)
+                      for key, count in self._top.items()]
+        heapq.heapify(self._heap)
+
+    def decay(self):
+        """Age every counter so old traffic fades out"""
+        factor = self.decay_factor
+        self.sketch.decay(factor)
+        for key in self._top:
+            self._top[key] = int(self._top[key] * factor)
+        self._rebuild()
+
+    def top(self, n=None):
+        """List of (key, count) of hottest keys, hottest first"""
+        retval = sorted(self._top.items(), key=lambda x: -x[1])
+        return retval[:n] if n else retval
+
+    def is_hot(self, key):
+        return key in self._top
+
+    def pinned(self, key):
+        """Locally cached value of a hot key, or None"""
+        entry = self._pinned.get(key)
+        if entry is None:
+            return None
+        if entry[1] < time.time():
+            del self._pinned[key]
+            return None
+        return entry[0]
+
+    def pin(self, key, value):
+        """Cache value locally if pinning is enabled and key is hot"""
+        if self.pin_ttl and value is not None and key in self._top:
+            self._pinned[key] = (value, time.time() + self.pin_ttl)
+        return value
+
+    def invalidate(self, key):
+        """Forget a locally cached value"""
+        self._pinned.pop(key, None)
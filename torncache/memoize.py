@@ -0,0 +1,163 @@
+# -*- mode: python; coding: utf-8 -*-
+
+"""
+Memoization
+
+Caches results of tornado coroutines in memcached. Calls made within
+the same IOLoop iteration are looked up with a single multi-get, and
+concurrent calls with the same arguments share one lookup and, on a
+miss, one computation.
+"""
+
+import sys
+import hashlib
+import functools
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from tornado.concurrent import Future, TracebackFuture
+
+
+def make_key(prefix, args, kwargs):
+    """
+    Stable key for a call.
+
+    Arguments must have a repr that doesn't change across processes, like
+    strings, numbers and containers of them.
+    """
+    call = repr((args, sorted(kwargs.items())))
+    return '{0}:{1}'.format(prefix, hashlib.md5(call.encode('utf-8'))
+                            .hexdigest())
+
+
+def _has_serializer(client):
+    """Check if a Client or ClientPool serializes values itself"""
+    kwargs = getattr(client, '_kwargs', None)
+    if kwargs is None:
+        kwargs = client._server_args
+    return kwargs.get('serializer') is not None
+
+
+class Memoizer(object):
+    """
+    Memoize coroutines with a client.
+
+    Args:
+      client: a Client or ClientPool. Its serializer is used for values,
+              or pickle if it has none, so cached and computed results
+              are alike.
+
+    Use instances as decorators factories:
+
+      memoize = Memoizer(pool)
+
+      @memoize(ttl=60)
+      @gen.coroutine
+      def profile(user_id):
+          ...
+
+    Decorated functions return a Future. None results are not cached.
+    """
+
+    def __init__(self, client, ioloop=None):
+        self._client = client
+        self._ioloop = ioloop or client._ioloop
+        self._pickle = not _has_serializer(client)
+        # key -> futures of calls waiting for it
+        self._inflight = {}
+        # key -> call to run on a miss, for the next multi-get
+        self._batch = {}
+        self.stats = dict.fromkeys(('hits', 'misses', 'shared', 'lookups'), 0)
+
+    def __call__(self, ttl=0, prefix=None, key=None):
+        """
+        Build a decorator.
+
+        Args:
+          ttl: optional int, seconds results are cached, or zero for no
+               expiry (the default).
+          prefix: optional str, key prefix. Defaults to the module and
+                  name of the decorated function.
+          key: optional callable invoked with the call arguments that
+               returns the key to use, instead of make_key.
+        """
+        def decorator(func):
+            name = prefix or '{0}.{1}'.format(func.__module__, func.__name__)
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if key is None:
+                    cache_key = make_key(name, args, kwargs)
+                else:
+                    cache_key = key(*args, **kwargs)
+                return self._submit(cache_key, ttl, func, args, kwargs)
+            return wrapper
+        return decorator
+
+    def _submit(self, key, ttl, func, args, kwargs):
+        future = TracebackFuture()
+        if key in self._inflight:
+            self.stats['shared'] += 1
+            self._inflight[key].append(future)
+            return future
+        self._inflight[key] = [future]
+        self._batch[key] = (ttl, func, args, kwargs)
+        if len(self._batch) == 1:
+            self._ioloop.add_callback(self._lookup)
+        return future
+
+    def _lookup(self):
+        batch, self._batch = self._batch, {}
+        self.stats['lookups'] += 1
+        try:
+            self._client.get_many(
+                list(batch), callback=functools.partial(self._on_found, batch))
+        except Exception:
+            # like an illegal key, fail the calls rather than leave them
+            # waiting forever
+            exc_info = sys.exc_info()
+            for key in batch:
+                self._resolve(key, exc_info=exc_info)
+
+    def _on_found(self, batch, found):
+        for key, call in batch.items():
+            if found.get(key) is not None:
+                self.stats['hits'] += 1
+                value = found[key]
+                self._resolve(key, pickle.loads(value) if self._pickle
+                              else value)
+            else:
+                self.stats['misses'] += 1
+                self._compute(key, *call)
+
+    def _compute(self, key, ttl, func, args, kwargs):
+        def on_done(result):
+            try:
+                value = result.result()
+            except Exception:
+                self._resolve(key, exc_info=sys.exc_info())
+                return
+            if value is not None:
+                self._client.set(key, pickle.dumps(value, -1) if self._pickle
+                                 else value, expire=ttl)
+            self._resolve(key, value)
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            result = TracebackFuture()
+            result.set_exc_info(sys.exc_info())
+        if not isinstance(result, Future):
+            value, result = result, TracebackFuture()
+            result.set_result(value)
+        self._ioloop.add_future(result, on_done)
+
+    def _resolve(self, key, value=None, exc_info=None):
+        for future in self._inflight.pop(key, ()):
+            if exc_info is None:
+                future.set_result(value)
+            else:
+                future.set_exc_info(exc_info)
@@ -0,0 +1,165 @@
+# -*- mode: python; coding: utf-8 -*-
+
+"""
+Cache migration
+
+Warm up new nodes when the server list changes. Keys whose owner
+changes between the old and the new topology are read from their old
+server with pipelined multi-gets and written to their new one with
+noreply sets, keeping flags and expiration times, at a bounded rate.
+Keys are copied in batches as the key space is listed, pausing the
+listing while a batch is copied, so memory use doesn't grow with it.
+"""
+
+import time
+import logging
+
+from tornado.ioloop import IOLoop
+from tornado.gen import engine, Task
+from tornado.concurrent import TracebackFuture
+
+from torncache.client import Client, ClientPool
+
+
+def _raw_serializer(key, value):
+    # values are already (data, flags) pairs read from the old servers
+    return value
+
+
+def _raw_deserializer(key, value, flags):
+    return value, flags
+
+
+class Migration(object):
+    """
+    Copy keys that change owner from the old to the new topology.
+
+    Args:
+      old_servers: servers currently holding the data, in any form
+                   accepted by ClientPool.
+      new_servers: servers of the new topology.
+      batch: optional int, number of keys read per multi-get.
+      rate: optional int, max number of keys copied per second, or zero
+            for no limit (the default).
+      default_expire: optional int, seconds copies of keys whose TTL is
+                      unknown live, when an explicit key list is migrated,
+                      or zero for no expiry (the default).
+      **kwargs: extra Client arguments, like hasher or timeout. Both
+                topologies must use the same hasher than the application.
+    """
+
+    def __init__(self, old_servers, new_servers, batch=100, rate=0,
+                 default_expire=0, ioloop=None, **kwargs):
+        self._ioloop = ioloop or IOLoop.instance()
+        kwargs.update({
+            'ioloop': self._ioloop,
+            'serializer': _raw_serializer,
+            'deserializer': _raw_deserializer,
+        })
+        old_servers = ClientPool._parse_servers(old_servers)
+        self.old = Client(old_servers, **kwargs)
+        self.new = Client(ClientPool._parse_servers(new_servers), **kwargs)
+        # values are read on their own connections, as the listing holds
+        # the ones of self.old while it streams. Values of get_or_compute
+        # are read as Envelopes, so they are stored with their metadata
+        self.reader = Client(old_servers, **kwargs)
+        self.batch = batch
+        self.rate = rate
+        self.default_expire = default_expire
+        self.stats = dict.fromkeys(
+            ('scanned', 'moved', 'copied', 'missing', 'expired'), 0)
+
+    def owners(self, key):
+        """Old and new server addresses of key"""
+        return (str(self.old._get_server(key)[0]),
+                str(self.new._get_server(key)[0]))
+
+    def moves(self, key):
+        """Check if key changes owner"""
+        old, new = self.owners(key)
+        return old != new
+
+    @engine
+    def run(self, keys=None, callback=None):
+        """
+        Run the migration.
+
+        Args:
+          keys: optional list of keys to consider. If missing, the key
+                space is listed with "lru_crawler metadump" on the old
+                servers, which also provides the TTL of every key.
+
+        Returns:
+          A dict of counters: scanned, moved, copied, missing (moved
+          keys not found when read) and expired.
+        """
+        pending = []
+
+        def on_record(record):
+            self.stats['scanned'] += 1
+            if self.moves(record.key):
+                pending.append((record.key, record.exp))
+            if len(pending) < self.batch:
+                return None
+            # pause the listing of this server until the batch is copied
+            future = TracebackFuture()
+            self._flush(pending[:], callback=lambda: future.set_result(None))
+            del pending[:]
+            return future
+
+        if keys is None:
+            yield Task(self.old.metadump, on_record)
+        else:
+            # keep copies of keys with an unknown TTL for default_expire
+            expire = -1
+            if self.default_expire:
+                expire = int(time.time()) + self.default_expire
+            for key in keys:
+                self.stats['scanned'] += 1
+                if self.moves(key):
+                    pending.append((key, expire))
+                if len(pending) >= self.batch:
+                    yield Task(self._flush, pending[:])
+                    del pending[:]
+        if pending:
+            yield Task(self._flush, pending)
+
+        # A round trip per server to make sure every noreply set landed
+        for server in self.new._servers:
+            yield Task(server.misc_cmd, b"version\r\n", 'version', False,
+                       keys=0)
+        logging.info("Migration finished: %s", self.stats)
+        callback and callback(self.stats)
+
+    @engine
+    def _flush(self, batch, callback):
+        """Copy a batch, then wait as long as the rate requires"""
+        self.stats['moved'] += len(batch)
+        started = time.time()
+        yield Task(self._copy, batch)
+        if self.rate:
+            wait = float(len(batch)) / self.rate - time.time() + started
+            if wait > 0:
+                yield Task(self._ioloop.add_timeout, time.time() + wait)
+        callback()
+
+    def _copy(self, batch, callback):
+        """Copy a batch of (key, absolute expiration) pairs"""
+        def on_values(values):
+            now = time.time()
+            for key, exp in batch:
+                if key not in values:
+                    self.stats['missing'] += 1
+                    continue
+                if 0 <= exp <= now:
+                    self.stats['expired'] += 1
+                    continue
+                # memcached takes big exptimes as absolute timestamps,
+                # which keeps the original deadline as is
+                self.new.set(key, values[key], expire=max(exp, 0),
+                             noreply=True)
+                self.stats['copied'] += 1
+            callback()
+
+        self.reader.get_many([key for key, _ in batch], callback=on_values,
+                             envelopes=True)
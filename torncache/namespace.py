@@ -0,0 +1,164 @@
+# -*- mode: python; coding: utf-8 -*-
+
+"""
+Namespaces
+
+Groups keys under a prefix that embeds a generation number stored in
+memcached. Bumping the generation with a single "incr" makes every key
+of the namespace unreachable at once, and memcached evicts them as they
+age out. The generation is cached locally for a short time, so other
+processes see an invalidation after at most that delay.
+"""
+
+import time
+import functools
+
+from tornado import stack_context
+
+from torncache.client import _native
+
+# Prefix of the keys holding namespace generations
+GENERATION_PREFIX = 'ns:'
+
+
+class Namespace(object):
+    """
+    Keys of a client grouped for invalidation.
+
+    Args:
+      client: a Client or ClientPool.
+      name: str, the namespace, like 'user:42'. Must not contain spaces.
+      ttl: optional float, seconds the generation is cached locally.
+
+    get, get_many, set, set_many and delete take the same arguments and
+    return the same results than their Client counterparts, with keys
+    rewritten as '<name>:<generation>:<key>'.
+    """
+
+    def __init__(self, client, name, ttl=1.0):
+        self._client = client
+        self.name = name
+        self.ttl = ttl
+        self._key = GENERATION_PREFIX + name
+        self._generation = None
+        self._expires = 0
+        self._waiters = None
+
+    def key(self, key, generation):
+        """Key stored in memcached for a namespaced key"""
+        if isinstance(key, bytes):
+            # format() would render py3 bytes as b'...'
+            key = _native(key)
+        return '{0}:{1}:{2}'.format(self.name, generation, key)
+
+    def generation(self, callback):
+        """Current generation, fetching it at most once every ttl secs"""
+        if self._generation is not None and time.time() < self._expires:
+            callback(self._generation)
+            return
+        callback = stack_context.wrap(callback)
+        # lookups in flight are shared
+        if self._waiters is not None:
+            self._waiters.append(callback)
+            return
+        self._waiters = [callback]
+        self._lookup(self._client.get, self._key,
+                     callback=self._on_generation)
+
+    def _lookup(self, method, *args, **kwargs):
+        # a synchronous error would leave the waiters hanging and block
+        # every later lookup
+        try:
+            method(*args, **kwargs)
+        except Exception:
+            self._waiters = None
+            raise
+
+    def _on_generation(self, value):
+        if value is not None:
+            self._resolve(int(value))
+            return
+        # Missing or evicted. Start from the clock so keys of a lost
+        # generation are never reused
+        generation = int(time.time())
+        self._lookup(
+            self._client.add, self._key, str(generation), noreply=False,
+            callback=functools.partial(self._on_add, generation))
+
+    def _on_add(self, generation, stored):
+        if stored is False:
+            # another process created it first
+            self._lookup(
+                self._client.get, self._key,
+                callback=lambda value: self._resolve(
+                    generation if value is None else int(value)))
+            return
+        self._resolve(generation)
+
+    def _resolve(self, generation):
+        self._generation = generation
+        self._expires = time.time() + self.ttl
+        waiters, self._waiters = self._waiters or [], None
+        for callback in waiters:
+            callback(generation)
+
+    def invalidate(self, callback=None):
+        """
+        Drop every key of the namespace by bumping its generation.
+
+        Returns:
+          The new generation, or None if the namespace didn't exist yet.
+        """
+        def on_incr(value):
+            if value:
+                self._resolve(value)
+            else:
+                self._expires = 0
+                value = None
+            callback and callback(value)
+
+        self._client.incr(self._key, 1, callback=on_incr)
+
+    def get(self, key, callback):
+        """The memcached "get" command. See Client.get"""
+        self.generation(lambda generation: self._client.get(
+            self.key(key, generation), callback=callback))
+
+    def get_many(self, keys, callback):
+        """The memcached "get" command. See Client.get_many"""
+        def on_generation(generation):
+            names = dict((self.key(key, generation), key) for key in keys)
+            self._client.get_many(
+                list(names), callback=functools.partial(on_result, names))
+
+        def on_result(names, result):
+            callback(dict(
+                (names[key], value) for key, value in result.items()))
+
+        self.generation(on_generation)
+
+    def set(self, key, value, expire=0, noreply=True, callback=None):
+        """The memcached "set" command. See Client.set"""
+        self.generation(lambda generation: self._client.set(
+            self.key(key, generation), value, expire, noreply,
+            callback=callback))
+
+    def set_many(self, values, expire=0, noreply=True, callback=None):
+        """A convenience function for setting multiple values. See Client"""
+        def on_generation(generation):
+            names = dict((self.key(key, generation), key) for key in values)
+            items = dict((name, values[key]) for name, key in names.items())
+            self._client.set_many(
+                items, expire, noreply,
+                callback=functools.partial(on_result, names))
+
+        def on_result(names, result):
+            callback and callback(dict(
+                (names[key], value) for key, value in result.items()))
+
+        self.generation(on_generation)
+
+    def delete(self, key, noreply=True, callback=None):
+        """The memcached "delete" command. See Client.delete"""
+        self.generation(lambda generation: self._client.delete(
+            self.key(key, generation), noreply=noreply, callback=callback))
@@ -0,0 +1,137 @@
+# -*- mode: python; coding: utf-8 -*-
+
+"""
+Cluster statistics
+
+Turns the flat replies of "stats", "stats slabs", "stats items" and
+"stats settings" into nested structures, aggregates them across servers
+and computes per second rates between two snapshots.
+"""
+
+import time
+
+# Stats that describe a server or a slab class rather than count events.
+# They are not added up across servers nor turned into rates
+NON_ADDITIVE = frozenset([
+    'pid', 'uptime', 'time', 'version', 'libevent', 'pointer_size',
+    'threads', 'conn_yields', 'hash_power_level', 'chunk_size',
+    'chunks_per_page', 'age', 'evicted_time', 'active_slabs',
+])
+
+
+def parse_slabs(stats):
+    """
+    Parse "stats slabs" into {'total': {...}, 'classes': {id: {...}}}.
+
+    Keys of the form "<class>:<name>" are grouped by slab class, while
+    the rest, like active_slabs or total_malloced, go into total.
+    """
+    retval = {'total': {}, 'classes': {}}
+    for key, value in stats.items():
+        slab, sep, name = key.partition(':')
+        if sep and slab.isdigit():
+            retval['classes'].setdefault(int(slab), {})[name] = value
+        else:
+            retval['total'][key] = value
+    return retval
+
+
+def parse_items(stats):
+    """Parse "stats items" keys "items:<class>:<name>" into {id: {...}}"""
+    retval = {}
+    for key, value in stats.items():
+        parts = key.split(':', 2)
+        if len(parts) == 3 and parts[1].isdigit():
+            retval.setdefault(int(parts[1]), {})[parts[2]] = value
+    return retval
+
+
+PARSERS = {
+    'general': dict,
+    'settings': dict,
+    'slabs': parse_slabs,
+    'items': parse_items,
+}
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def merge(target, source):
+    """Add up numeric counters of source into target, recursively"""
+    for key, value in source.items():
+        if isinstance(value, dict):
+            merge(target.setdefault(key, {}), value)
+        elif key in NON_ADDITIVE or not _is_number(value):
+            if _is_number(value) and _is_number(target.get(key)):
+                target[key] = max(target[key], value)
+            else:
+                target.setdefault(key, value)
+        else:
+            target[key] = target.get(key, 0) + value
+    return target
+
+
+def _rates(previous, current, elapsed):
+    retval = {}
+    for key, value in current.items():
+        old = previous.get(key)
+        if isinstance(value, dict) and isinstance(old, dict):
+            retval[key] = _rates(old, value, elapsed)
+        elif key not in NON_ADDITIVE and _is_number(value) \
+                and _is_number(old):
+            retval[key] = (value - old) / elapsed
+    return retval
+
+
+class Snapshot(object):
+    """
+    Stats of every server at a point in time.
+
+    Attributes:
+      servers: dict of host to {kind: parsed stats}, where kind is one of
+               'general', 'settings', 'slabs' or 'items'.
+      total: the same structure aggregated across servers.
+      timestamp: float, when the snapshot was taken.
+    """
+
+    def __init__(self, servers, timestamp=None):
+        self.timestamp = timestamp or time.time()
+        self.servers = {}
+        for host, kinds in servers.items():
+            self.servers[host] = dict(
+                (kind, PARSERS[kind](stats or {}))
+                for kind, stats in kinds.items())
+        self.total = {}
+        for kinds in self.servers.values():
+            merge(self.total, kinds)
+
+    @property
+    def hit_ratio(self):
+        """Cluster get hit ratio, or None if there were no gets"""
+        general = self.total.get('general', {})
+        hits = general.get('get_hits', 0)
+        total = hits + general.get('get_misses', 0)
+        return float(hits) / total if total else None
+
+    def rates(self, previous):
+        """
+        Per second deltas of counters since a previous snapshot.
+
+        Returns:
+          A dict with 'servers' and 'total' entries shaped like the
+          snapshot itself. Servers missing from either snapshot are
+          skipped.
+        """
+        elapsed = self.timestamp - previous.timestamp
+        if elapsed <= 0:
+            raise ValueError("Snapshot is not newer than previous one")
+        servers = {}
+        for host, kinds in self.servers.items():
+            if host in previous.servers:
+                servers[host] = _rates(previous.servers[host], kinds, elapsed)
+        return {
+            'servers': servers,
+            'total': _rates(previous.total, self.total, elapsed),
+        }
@@ -14,6 +14,21 @@ from tornado.test.util import unittest
 TEST_MODULES = [
     'torncache.test.test_hello',
     'torncache.test.test_client',
+    'torncache.test.test_backpressure',
+    'torncache.test.test_benchmarks',
+    'torncache.test.test_blocking',
+    'torncache.test.test_counters',
+    'torncache.test.test_hashing',
+    'torncache.test.test_hotkeys',
+    'torncache.test.test_memoize',
+    'torncache.test.test_migrate',
+    'torncache.test.test_namespace',
+    'torncache.test.test_partial',
+    'torncache.test.test_pool',
+    'torncache.test.test_stats',
+    'torncache.test.test_threadsafe',
+    'torncache.test.test_topology',
+    'torncache.test.test_writebehind',
 ]
 
 
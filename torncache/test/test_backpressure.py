@@ -0,0 +1,142 @@
+#-*- mode: python; coding: utf-8 -*-
+
+"""
+Backpressure
+"""
+
+# tornado testing stuff
+from tornado import testing
+from torncache import client as memcache
+from torncache.backpressure import Limiter, Limits
+from torncache.test.util import ServerTestCase
+
+
+class LimiterTest(testing.AsyncTestCase):
+
+    def collect(self, limiter, n):
+        results = []
+        for i in range(n):
+            limiter.acquire(results.append)
+        return results
+
+    def test_fail(self):
+        limiter = Limiter(2, policy='fail', ioloop=self.io_loop)
+        self.assertEqual(self.collect(limiter, 3), [True, True, False])
+        self.assertEqual(limiter.stats['rejected'], 1)
+        limiter.release()
+        self.assertEqual(self.collect(limiter, 1), [True])
+
+    def test_wait(self):
+        limiter = Limiter(1, max_queue=1, policy='wait', ioloop=self.io_loop)
+        results = self.collect(limiter, 3)
+        self.assertEqual(results, [True, False])
+        limiter.release()
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+        self.assertEqual(results, [True, False, True])
+        self.assertEqual(limiter.inflight, 1)
+
+    def test_drop_oldest(self):
+        limiter = Limiter(1, max_queue=1, policy='drop_oldest',
+                          ioloop=self.io_loop)
+        first, second = [], []
+        limiter.acquire(lambda x: None)
+        limiter.acquire(first.append)
+        limiter.acquire(second.append)
+        limiter.release()
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+        self.assertEqual((first, second), ([False], [True]))
+        self.assertEqual(limiter.stats['dropped'], 1)
+
+    def test_expire(self):
+        limiter = Limiter(1, timeout=0.01, ioloop=self.io_loop)
+        limiter.acquire(lambda x: None)
+        limiter.acquire(self.stop)
+        self.assertFalse(self.wait())
+        self.assertEqual(limiter.stats['expired'], 1)
+        self.assertEqual(limiter.waiting, 0)
+
+
+class BackpressureTest(ServerTestCase):
+
+    def get_server_args(self):
+        return {'latency': 0.02}
+
+    def test_shed_to_misses(self):
+        limits = Limits(max_inflight=1, policy='fail', ioloop=self.io_loop)
+        pool = memcache.ClientPool(self.address, limits=limits,
+                                   ioloop=self.io_loop)
+        pool.set('key', 'value', noreply=False, callback=self.stop)
+        self.assertTrue(self.wait())
+        results = []
+        for i in range(3):
+            pool.get('key', callback=results.append)
+        # only the first one was sent
+        self.assertEqual(results, [None, None])
+        pool.get_many(['key'], callback=self.stop)
+        self.assertEqual(self.wait(), {})
+        self.io_loop.add_timeout(self.io_loop.time() + 0.05, self.stop)
+        self.wait()
+        self.assertEqual(results, [None, None, b'value'])
+        self.assertEqual(pool.backpressure_stats()[self.address], {
+            'admitted': 2, 'queued': 0, 'rejected': 3, 'dropped': 0,
+            'expired': 0, 'inflight': 0, 'waiting': 0})
+
+    def test_queue(self):
+        limits = Limits(max_inflight=1, ioloop=self.io_loop)
+        client = memcache.Client([self.address], limits=limits,
+                                 ioloop=self.io_loop)
+        results = []
+        client.set('key', 'value')
+        for i in range(2):
+            client.get('key', callback=results.append)
+        client.get('key', callback=self.stop)
+        self.assertEqual(self.wait(), b'value')
+        self.assertEqual(results, [b'value', b'value'])
+        stats = client.backpressure_stats()[self.address]
+        self.assertEqual(stats['admitted'], 4)
+        self.assertEqual(stats['queued'], 3)
+
+    def test_pool_waits_for_clients(self):
+        limits = Limits(max_queue=10, ioloop=self.io_loop)
+        pool = memcache.ClientPool(self.address, size=1, limits=limits,
+                                   ioloop=self.io_loop)
+        pool.set_many({'key1': 'a', 'key2': 'b'}, noreply=False)
+        pool.get_many(['key1', 'key2'], callback=self.stop)
+        self.assertEqual(self.wait(), {'key1': b'a', 'key2': b'b'})
+        stats = pool.backpressure_stats()['pool']
+        self.assertEqual(stats['queued'], 1)
+        self.assertEqual(stats['inflight'], 0)
+
+    def test_pool_sheds_with_a_full_queue(self):
+        limits = Limits(max_queue=1, ioloop=self.io_loop)
+        pool = memcache.ClientPool(self.address, size=1, limits=limits,
+                                   ioloop=self.io_loop)
+        pool.get('key', callback=lambda x: None)
+        pool.get('key', callback=lambda x: None)
+        pool.get_many(['key'], callback=self.stop)
+        self.assertEqual(self.wait(), {})
+        self.assertEqual(pool.backpressure_stats()['pool']['rejected'], 1)
+
+    def test_drain_with_limits(self):
+        limits = Limits(max_inflight=1, policy='fail', ioloop=self.io_loop)
+        client = memcache.Client([self.address], limits=limits,
+                                 ioloop=self.io_loop)
+        client.set('key', 'value', noreply=False, callback=self.stop)
+        self.assertTrue(self.wait())
+        results = []
+        client.get('key', callback=results.append)
+        server = client._servers[0]
+        server.drain(callback=self.stop)
+        self.assertIs(self.wait(), server)
+        # the command in flight completed before the stream was closed
+        self.assertEqual(results, [b'value'])
+        self.assertEqual(limits.stats()[self.address]['inflight'], 0)
+
+    def test_timeout_is_a_miss(self):
+        client = memcache.Client([self.address], timeout=0.005,
+                                 ioloop=self.io_loop)
+        client.get('key', callback=self.stop)
+        self.assertEqual(self.wait(), None)
+        self.assertIsNotNone(client._servers[0]._abort_error)
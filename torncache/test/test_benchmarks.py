@@ -0,0 +1,87 @@
+#-*- mode: python; coding: utf-8 -*-
+
+"""
+Benchmarks
+"""
+
+import time
+
+# tornado testing stuff
+from tornado import testing
+from tornado.test.util import unittest
+from torncache import client as memcache
+from torncache import hashing
+from torncache.benchmarks import alloc, routing, runner
+from torncache.benchmarks.server import start_server
+
+
+class ServerTest(testing.AsyncTestCase):
+
+    def setUp(self):
+        super(ServerTest, self).setUp()
+        self.server, address = start_server(io_loop=self.io_loop)
+        self.pool = memcache.ClientPool(address, ioloop=self.io_loop)
+
+    def tearDown(self):
+        self.server.stop()
+        super(ServerTest, self).tearDown()
+
+    def test_roundtrip(self):
+        self.pool.set('key', 'value', noreply=False, callback=self.stop)
+        self.assertTrue(self.wait())
+        self.pool.get('key', callback=self.stop)
+        self.assertEqual(self.wait(), b'value')
+
+    def test_gat(self):
+        self.pool.set('key', 'value', expire=1, noreply=False,
+                      callback=self.stop)
+        self.wait()
+        self.pool.gat_many(['key'], 100, callback=self.stop)
+        self.assertEqual(self.wait(), {'key': b'value'})
+        self.assertTrue(self.server.items[b'key'].expire > time.time() + 50)
+
+    def test_latency(self):
+        self.server.latency = 0.05
+        traces = []
+        self.pool.add_hook('complete', lambda event, trace: traces.append(trace))
+        self.pool.get('key', callback=self.stop)
+        self.wait()
+        self.assertTrue(traces[0].elapsed('first_byte') >= 0.05)
+
+
+class RunnerTest(testing.AsyncTestCase):
+
+    def test_percentile(self):
+        samples = list(range(101))
+        self.assertEqual(runner.percentile(samples, 50), 50)
+        self.assertEqual(runner.percentile(samples, 99), 99)
+        self.assertEqual(runner.percentile([], 99), 0.0)
+
+    def test_compare(self):
+        result = runner.Result('get', 100, 1.0, [0.001])
+        baseline = {'get': {'ops_per_sec': 200.0}}
+        self.assertEqual(len(runner.compare([result], baseline, 0.2)), 1)
+        self.assertEqual(runner.compare([result], baseline, 0.6), [])
+
+
+class MicrobenchmarkTest(testing.AsyncTestCase):
+
+    def test_scenarios(self):
+        results = dict((r.name, r) for r in alloc.scenarios(20))
+        self.assertIn('get_many 10', results)
+        for result in results.values():
+            self.assertTrue(result.usecs > 0)
+            self.assertTrue(result.allocs > 0)
+        # a stack context is captured by the pending command
+        self.assertTrue(
+            results['get in context'].allocs > results['get'].allocs)
+
+
+class RoutingTest(unittest.TestCase):
+
+    def test_scenarios(self):
+        results = [(r.name, r.path) for r in routing.scenarios(600, 4, 1)]
+        self.assertIn(('crc32', 'scalar'), results)
+        self.assertNotIn(('crc32', 'numpy'), results)
+        if hashing.numpy is not None:
+            self.assertIn(('fnv1a', 'numpy'), results)
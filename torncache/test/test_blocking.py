@@ -0,0 +1,113 @@
+#-*- mode: python; coding: utf-8 -*-
+
+"""
+Blocking client
+"""
+
+import json
+import threading
+
+from tornado.ioloop import IOLoop
+from tornado.test.util import unittest
+
+from torncache import client as memcache
+from torncache.blocking import BlockingClient
+from torncache.benchmarks.server import start_server
+
+
+def _ser(key, value):
+    if isinstance(value, dict):
+        return json.dumps(value), 4
+    return value, 0
+
+
+def _des(key, value, flags):
+    if flags == 4:
+        return json.loads(value)
+    return value
+
+
+class BlockingClientTest(unittest.TestCase):
+
+    def setUp(self):
+        # fake servers run on their own IOLoop thread
+        self.io_loop = IOLoop()
+        self.servers, self.addresses = [], []
+        for i in range(2):
+            server, address = start_server(io_loop=self.io_loop)
+            self.servers.append(server)
+            self.addresses.append(address)
+        self.thread = threading.Thread(target=self.io_loop.start)
+        self.thread.start()
+        self.client = BlockingClient(
+            ','.join(self.addresses), serializer=_ser, deserializer=_des)
+
+    def tearDown(self):
+        def stop():
+            for server in self.servers:
+                server.stop()
+            self.io_loop.stop()
+        self.client.close()
+        self.io_loop.add_callback(stop)
+        self.thread.join()
+        self.io_loop.close(all_fds=True)
+
+    def test_deserialize_many(self):
+        def _des_many(items):
+            batches.append(len(items))
+            return [_des(*item) for item in items]
+
+        batches = []
+        client = BlockingClient(self.addresses[0], serializer=_ser,
+                                deserialize_many=_des_many)
+        self.addCleanup(client.close)
+        client.set_many({'key': {'a': 'b'}, 'other': 'value'}, noreply=False)
+        self.assertEqual(client.get_many(['key', 'other', 'missing']),
+                         {'key': {'a': 'b'}, 'other': b'value'})
+        self.assertEqual(client.gets('key')[0], {'a': 'b'})
+        self.assertEqual(batches, [2, 1])
+
+    def test_routing(self):
+        async_client = memcache.Client(
+            memcache.ClientPool._parse_servers(','.join(self.addresses)),
+            ioloop=self.io_loop)
+        for i in range(100):
+            key = 'key{0}'.format(i)
+            self.assertEqual(str(self.client._get_server(key)[0]),
+                             str(async_client._get_server(key)[0]))
+
+    def test_set_get(self):
+        self.assertTrue(self.client.set('key', {'a': 1}, noreply=False))
+        self.assertEqual(self.client.get('key'), {'a': 1})
+        self.assertEqual(self.client.get('missing'), None)
+        self.assertFalse(self.client.add('key', 'value', noreply=False))
+
+    def test_many(self):
+        values = dict(('key{0}'.format(i), str(i).encode()) for i in range(50))
+        result = self.client.set_many(values, noreply=False)
+        self.assertEqual(result, dict.fromkeys(values, True))
+        self.assertEqual(self.client.get_many(list(values) + ['x']), values)
+        result = self.client.delete_many(['key1', 'x'], noreply=False)
+        self.assertEqual(result, {'key1': True, 'x': False})
+        self.assertEqual(self.client.get('key1'), None)
+
+    def test_cas_and_counters(self):
+        self.client.set('key', '1')
+        value, cas = self.client.gets('key')
+        self.assertEqual(value, b'1')
+        self.assertTrue(self.client.cas('key', '5', cas))
+        self.assertFalse(self.client.cas('key', '6', cas))
+        self.assertEqual(self.client.incr('key', 2), 7)
+        self.assertEqual(self.client.decr('key', 3), 4)
+        self.assertFalse(self.client.incr('missing', 1))
+        self.assertTrue(self.client.touch('key', 10, noreply=False))
+
+    def test_illegal_key(self):
+        with self.assertRaises(memcache.MemcacheIllegalInputError):
+            self.client.get('a key')
+
+    def test_dead_server(self):
+        client = BlockingClient('127.0.0.1:1', connect_timeout=0.1)
+        self.assertEqual(client.get('key'), None)
+        self.assertEqual(client.set_many({'a': 'b'}), {'a': None})
+        self.assertTrue(client._servers[0]._dead_until)
@@ -7,9 +7,13 @@ Client
 # common conde
 import os
 import json
+import time
 
 # tornado testing stuff
 from tornado import testing
+from tornado.concurrent import futures
+from tornado.test.util import unittest
+from tornado.stack_context import ExceptionStackContext, NullContext
 from torncache import client as memcache
 
 
@@ -61,6 +65,24 @@ class ClientTest(testing.AsyncTestCase):
         result = self.wait()
         self.assertTrue(result['key'])
 
+    def test_set_many_values(self):
+        values = {'many1': b'value1', 'many2': b'value2'}
+        self.pool.set_many(values, noreply=False, callback=self.stop)
+        self.assertEqual(self.wait(), {'many1': True, 'many2': True})
+        self.pool.get_many(['many1', 'many2'], callback=self.stop)
+        self.assertEqual(self.wait(), values)
+        self.pool.delete_many(list(values), noreply=False, callback=self.stop)
+        self.assertEqual(self.wait(), {'many1': True, 'many2': True})
+
+    def test_delete_many(self):
+        self.pool.set('many1', 'value', noreply=False, callback=self.stop)
+        self.wait()
+        self.pool.delete_many(['many1', 'many2'], noreply=False,
+                              callback=self.stop)
+        self.assertEqual(self.wait(), {'many1': True, 'many2': False})
+        self.pool.get('many1', callback=self.stop)
+        self.assertEqual(self.wait(), None)
+
     def test_add_stored(self):
         self.pool.add('key', 'value', noreply=False, callback=self.stop)
         result = self.wait()
@@ -84,7 +106,7 @@ class ClientTest(testing.AsyncTestCase):
         self.pool.set('key', 'value', noreply=False)
         self.pool.get('key', callback=self.stop)
         result = self.wait()
-        self.assertEqual(result, 'value')
+        self.assertEqual(result, b'value')
 
     def test_get_many_none_found(self):
         self.pool.get_many(['key1', 'key2'], callback=self.stop)
@@ -98,7 +120,7 @@ class ClientTest(testing.AsyncTestCase):
         result = self.wait()
         self.pool.delete('key1', noreply=False, callback=self.stop)
         self.wait()
-        self.assertEqual(result, {'key1': 'value1'})
+        self.assertEqual(result, {'key1': b'value1'})
 
     def test_get_many_all_found(self):
         self.pool.set('key1', 'value1', noreply=False, callback=self.stop)
@@ -109,12 +131,31 @@ class ClientTest(testing.AsyncTestCase):
         result = self.wait()
         self.pool.delete_many(['key1', 'key2'], noreply=False, callback=self.stop)
         self.wait()
-        self.assertEqual(result, {'key1': 'value1', 'key2': 'value2'})
+        self.assertEqual(result, {'key1': b'value1', 'key2': b'value2'})
 
     def test_get_unicode_key(self):
         with self.assertRaises(memcache.MemcacheIllegalInputError):
             self.pool.get(u'\u0FFF')
 
+    def test_illegal_keys(self):
+        for key in ('a key', 'a\nkey', '', 'k' * 251):
+            with self.assertRaises(memcache.MemcacheIllegalInputError):
+                memcache.encode_key(key)
+        self.assertEqual(memcache.encode_key(u'key'), b'key')
+        self.assertEqual(memcache.encode_key(42), b'42')
+
+    def test_hash_long_keys(self):
+        key = memcache.encode_key('k' * 300, hash_long=True)
+        self.assertEqual(len(key), memcache.MAX_KEY_LENGTH)
+        self.assertNotEqual(key, memcache.encode_key('k' * 301, hash_long=True))
+        self.assertEqual(memcache.encode_key('k' * 10, hash_long=True), b'k' * 10)
+
+    def test_bytes_keys(self):
+        self.pool.set_many({b'key1': b'value1'}, noreply=False, callback=self.stop)
+        self.wait()
+        self.pool.get_many([b'key1', b'key2'], callback=self.stop)
+        self.assertEqual(self.wait(), {b'key1': b'value1'})
+
     def test_delete_not_found(self):
         self.pool.delete('key_not_found', noreply=False, callback=self.stop)
         result = self.wait()
@@ -184,7 +225,7 @@ class ClientTest(testing.AsyncTestCase):
 
         self.pool.get('key', callback=self.stop)
         result = self.wait()
-        self.assertEqual(result, 'value1')
+        self.assertEqual(result, b'value1')
 
     def test_prepend_stored(self):
         self.pool.set('key', 'value', noreply=True, callback=self.stop)
@@ -196,7 +237,7 @@ class ClientTest(testing.AsyncTestCase):
 
         self.pool.get('key', callback=self.stop)
         result = self.wait()
-        self.assertEqual(result, '1value')
+        self.assertEqual(result, b'1value')
 
     def test_cas_stored(self):
         self.pool.set('key', 'value', noreply=True, callback=self.stop)
@@ -240,7 +281,7 @@ class ClientTest(testing.AsyncTestCase):
         result = self.wait()
         self.pool.delete('key', noreply=True, callback=self.stop)
         self.wait()
-        self.assertEqual(result[0], 'value')
+        self.assertEqual(result[0], b'value')
         self.assertTrue(result[1].isdigit())
 
     def test_gets_many_none_found(self):
@@ -256,7 +297,7 @@ class ClientTest(testing.AsyncTestCase):
         self.pool.delete('key1', noreply=False, callback=self.stop)
         self.wait()
         self.assertTrue('key1' in result and len(result) == 1)
-        self.assertTrue(len(result['key1']) == 2 and result['key1'][0] == 'value1')
+        self.assertTrue(len(result['key1']) == 2 and result['key1'][0] == b'value1')
 
     def test_gets_many_all_found(self):
         self.pool.set('key1', 'value1', noreply=False, callback=self.stop)
@@ -269,6 +310,135 @@ class ClientTest(testing.AsyncTestCase):
         self.wait()
         self.assertEqual(result.keys(), {'key1': 'value1', 'key2': 'value2'}.keys())
 
+    def test_gat(self):
+        self.pool.gat('key', 100, callback=self.stop)
+        self.assertIsNone(self.wait())
+        self.pool.set('key', 'value', expire=1, noreply=False,
+                      callback=self.stop)
+        self.wait()
+        self.pool.gat('key', 100, callback=self.stop)
+        self.assertEqual(self.wait(), b'value')
+        self.pool.gats('key', 100, callback=self.stop)
+        value, cas = self.wait()
+        self.assertEqual(value, b'value')
+        self.assertTrue(cas)
+        self.pool.gats('missing', 100, callback=self.stop)
+        self.assertEqual(self.wait(), (None, None))
+
+    def test_gat_many(self):
+        self.pool.set_many({'key': 'value', 'other': 'value2'},
+                           noreply=False, callback=self.stop)
+        self.wait()
+        self.pool.gat_many(['key', 'other', 'missing'], 100, callback=self.stop)
+        self.assertEqual(self.wait(), {'key': b'value', 'other': b'value2'})
+
+    def test_split_get_many(self):
+        client = memcache.Client(self.pool._servers, ioloop=self.io_loop,
+                                 max_get_keys=3, max_get_bytes=20)
+        values = dict(('split{0}'.format(i), str(i).encode()) for i in range(8))
+        client.set_many(values, noreply=False, callback=self.stop)
+        self.wait()
+        traces = []
+        client.add_hook('complete', lambda event, trace: traces.append(trace))
+        client.get_many(list(values), callback=self.stop)
+        self.assertEqual(self.wait(), values)
+        client.gets_many(list(values), callback=self.stop)
+        self.assertEqual(sorted(self.wait()), sorted(values))
+        # at most 3 keys, and 20 bytes of keys, per command
+        self.assertTrue(all(trace.keys <= 2 for trace in traces))
+        self.assertEqual(sum(trace.keys for trace in traces), 16)
+
+    def test_oversized_values(self):
+        client = memcache.Client(self.pool._servers, ioloop=self.io_loop,
+                                 max_value_size=100000,
+                                 max_response_size=100)
+        values = {'big': b'x' * 200000, 'small': b'y' * 60, 'other': b'z' * 60}
+        client.set_many(values, noreply=False, callback=self.stop)
+        self.wait()
+        client.get('big', callback=self.stop)
+        self.assertEqual(self.wait(), None)
+        # the second small value takes the reply over the limit
+        client.get_many(['big', 'small', 'other'], callback=self.stop)
+        result = self.wait()
+        self.assertEqual(len(result), 1)
+        self.assertTrue(set(result.items()) < set(values.items()))
+        stats = list(client.oversized_stats().values())
+        self.assertEqual(sum(s['values'] for s in stats), 3)
+        self.assertEqual(sum(s['bytes'] for s in stats), 2 * 200002 + 62)
+        # the stream is still usable
+        client.get('small', callback=self.stop)
+        self.assertEqual(self.wait(), b'y' * 60)
+
+    def test_max_buffer_size(self):
+        self.pool.set('key', 'x' * 200000, noreply=False, callback=self.stop)
+        self.wait()
+        client = memcache.Client(self.pool._servers, ioloop=self.io_loop,
+                                 max_buffer_size=65536)
+        client.get('key', callback=self.stop)
+        self.assertEqual(self.wait(), None)
+
+    def test_update_many(self):
+        def incr(key, value):
+            return str(int(value or 0) + 1)
+
+        self.pool.delete('other', noreply=False, callback=self.stop)
+        self.wait()
+        self.pool.set('key', '1', noreply=False, callback=self.stop)
+        self.wait()
+        self.pool.update_many(['key', 'other'], incr, callback=self.stop)
+        self.assertEqual(self.wait(), {'key': '2', 'other': '1'})
+        self.pool.get_many(['key', 'other'], callback=self.stop)
+        self.assertEqual(self.wait(), {'key': b'2', 'other': b'1'})
+
+    def test_update_many_conflicts(self):
+        def incr(key, value):
+            calls.append(value)
+            if len(calls) <= conflicts:
+                # queued on the connection before our cas
+                client.set(key, '10')
+            return str(int(value) + 1)
+
+        client = memcache.Client(self.pool._servers, ioloop=self.io_loop)
+        client.set('key', '1', noreply=False, callback=self.stop)
+        self.wait()
+        calls, conflicts = [], 1
+        client.update_many(['key'], incr, callback=self.stop)
+        self.assertEqual(self.wait(), {'key': '11'})
+        self.assertEqual(calls, [b'1', b'10'])
+        # gives up after the given attempts
+        calls, conflicts = [], 2
+        client.update_many(['key'], incr, attempts=2, callback=self.stop)
+        self.assertEqual(self.wait(), {})
+        self.assertEqual(len(calls), 2)
+
+    def test_update_many_deleted(self):
+        def incr(key, value):
+            calls.append(value)
+            if len(calls) == 1:
+                # queued on the connection before our cas
+                client.delete(key)
+            return str(int(value or 0) + 1)
+
+        client = memcache.Client(self.pool._servers, ioloop=self.io_loop)
+        client.set('key', '1', noreply=False, callback=self.stop)
+        self.wait()
+        calls = []
+        client.update_many(['key'], incr, callback=self.stop)
+        # the cas found nothing, so the key was added again
+        self.assertEqual(self.wait(), {'key': '1'})
+        self.assertEqual(calls, [b'1', None])
+
+    def test_update_many_pinned_keys(self):
+        def incr(key, value):
+            return str(int(value or 0) + 1)
+
+        self.pool.set((0, 'key'), '1', noreply=False, callback=self.stop)
+        self.wait()
+        self.pool.update_many([(0, 'key')], incr, callback=self.stop)
+        self.assertEqual(self.wait(), {'key': '2'})
+        self.pool.get((0, 'key'), callback=self.stop)
+        self.assertEqual(self.wait(), b'2')
+
     def test_touch_not_found(self):
         self.pool.touch('key', noreply=False, callback=self.stop)
         result = self.wait()
@@ -286,6 +456,28 @@ class ClientTest(testing.AsyncTestCase):
         result = self.wait()
         self.assertTrue(result)
 
+    def test_errors_in_caller_context(self):
+        def on_error(typ, value, tb):
+            self.stop(value)
+            return True
+
+        client = memcache.Client(self.pool._servers, ioloop=self.io_loop,
+                                 ignore_exc=False)
+        server = client._servers[0]
+        with ExceptionStackContext(on_error):
+            server.misc_cmd(b'bogus\r\n', 'bogus', False, callback=self.stop)
+        self.assertIsInstance(self.wait(), memcache.MemcacheUnknownCommandError)
+        # the connection is still usable
+        client.get('key', callback=self.stop)
+        self.assertIsNone(self.wait())
+
+    def test_callbacks_outside_stack_context(self):
+        client = memcache.Client(self.pool._servers, ioloop=self.io_loop,
+                                 ignore_exc=False)
+        with NullContext():
+            client.get('key', callback=self.stop)
+        self.assertIsNone(self.wait())
+
     def test_replace_stored(self):
         # store value
         self.pool.set('key', 'value', noreply=True, callback=self.stop)
@@ -311,6 +503,43 @@ class ClientTest(testing.AsyncTestCase):
         result = self.wait()
         self.assertEqual(result, dct)
 
+    def _batch_client(self, **kwargs):
+        def _des_many(items):
+            batches.append(len(items))
+            return [json.loads(value) if flags == 4 else value
+                    for key, value, flags in items]
+
+        batches = []
+        client = memcache.Client(self.pool._servers, ioloop=self.io_loop,
+                                 deserialize_many=_des_many, **kwargs)
+        self.pool.set_many({'key': {'a': 'b'}, 'other': 'value'},
+                           noreply=False, callback=self.stop)
+        self.wait()
+        return client, batches
+
+    def test_deserialize_many(self):
+        client, batches = self._batch_client()
+        client.get_many(['key', 'other', 'missing'], callback=self.stop)
+        self.assertEqual(self.wait(), {'key': {'a': 'b'}, 'other': b'value'})
+        self.assertEqual(batches, [2])
+        client.gets_many(['key', 'other'], callback=self.stop)
+        result = self.wait()
+        self.assertEqual(result['key'][0], {'a': 'b'})
+        self.assertTrue(result['other'][1])
+        client.get('missing', callback=self.stop)
+        self.assertIsNone(self.wait())
+        self.assertEqual(batches, [2, 2])
+
+    @unittest.skipIf(futures is None, "concurrent.futures is not available")
+    def test_deserialize_many_executor(self):
+        executor = futures.ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        client, batches = self._batch_client(executor=executor,
+                                             executor_threshold=0)
+        client.get_many(['key', 'other'], callback=self.stop)
+        self.assertEqual(self.wait(), {'key': {'a': 'b'}, 'other': b'value'})
+        self.assertEqual(batches, [2])
+
     def test_stats(self):
         self.pool.stats('key', callback=self.stop)
         result = self.wait()
@@ -326,7 +555,108 @@ class ClientTest(testing.AsyncTestCase):
         result = self.wait()
         self.assertTrue(len(result) > 0)
         self.assertTrue(isinstance(result, dict))
-        self.assertTrue(all(result.iteritems()))
+        self.assertTrue(all(result.items()))
 
     def test_broadcast_with_no_port(self):
         pass
+
+    def test_hooks(self):
+        def hook(event, trace):
+            events.append((event, trace.name))
+
+        events = []
+        for event in memcache.HOOK_EVENTS:
+            self.pool.add_hook(event, hook)
+        self.pool.get('key', callback=self.stop)
+        self.wait()
+        for event in memcache.HOOK_EVENTS:
+            self.pool.remove_hook(event, hook)
+        self.assertEqual(events, [(event, 'get') for event in memcache.HOOK_EVENTS])
+
+    def test_hooks_timings(self):
+        traces = []
+        self.pool.add_hook('complete', lambda event, trace: traces.append(trace))
+        self.pool.set('key', 'value', noreply=True, callback=self.stop)
+        self.wait()
+        trace = traces[0]
+        self.assertEqual((trace.name, trace.keys, trace.size), ('set', 1, 5))
+        self.assertTrue(trace.elapsed('complete') >= 0)
+        self.assertEqual(trace.elapsed('first_byte'), None)
+
+    def test_metadump(self):
+        self.pool.set('key', 'value', expire=60, noreply=False, callback=self.stop)
+        self.wait()
+        records = []
+        self.pool.metadump(records.append, callback=self.stop)
+        result = self.wait()
+        self.assertTrue(all(count is not None for count in result.values()))
+        record = [r for r in records if r.key == 'key'][0]
+        self.assertTrue(record.exp > 0 and record.size > 0)
+
+    def test_get_or_compute(self):
+        calls = []
+
+        def producer(callback):
+            calls.append(1)
+            callback({'value': len(calls)})
+
+        for i in range(2):
+            self.pool.get_or_compute('key', producer, 60, callback=self.stop)
+            self.assertEqual(self.wait(), {'value': 1})
+        self.assertEqual(len(calls), 1)
+        # metadata is stored along the value
+        self.pool.get_envelope('key', callback=self.stop)
+        envelope = self.wait()
+        self.assertEqual(envelope.value, {'value': 1})
+        self.assertTrue(envelope.expiry > time.time() + 50)
+        # but plain reads only see the value
+        self.pool.get('key', callback=self.stop)
+        self.assertEqual(self.wait(), {'value': 1})
+        self.pool.get_many(['key'], callback=self.stop)
+        self.assertEqual(self.wait(), {'key': {'value': 1}})
+
+    def test_get_or_compute_releases_client(self):
+        used = []
+
+        def producer(callback):
+            used.append(len(self.pool._used))
+            callback('value')
+
+        self.pool.get_or_compute('key', producer, 60, callback=self.stop)
+        self.assertEqual(self.wait(), 'value')
+        self.assertEqual(used, [0])
+
+    def test_get_or_compute_producer_error(self):
+        def producer(callback):
+            raise ValueError("boom")
+
+        self.pool.delete('key', noreply=False, callback=self.stop)
+        self.wait()
+        self.pool.get_or_compute('key', producer, 60, callback=self.stop)
+        with self.assertRaises(ValueError):
+            self.wait()
+        # the lock is released right away, by a noreply delete that may
+        # run on another connection than the next read
+        self.io_loop.add_timeout(self.io_loop.time() + 0.05, self.stop)
+        self.wait()
+        self.pool.get('key' + memcache.LOCK_SUFFIX, callback=self.stop)
+        self.assertIsNone(self.wait())
+        self.pool.get_or_compute('key', lambda callback: callback('value'),
+                                 60, lock_ttl=0.5, callback=self.stop)
+        self.assertEqual(self.wait(), 'value')
+
+    def test_get_or_compute_serves_stale(self):
+        expired = memcache.Envelope('stale', 0.1, time.time() - 1)
+        self.pool.set('key', expired, noreply=False, callback=self.stop)
+        self.wait()
+        # someone else is recomputing it
+        self.pool.add('key' + memcache.LOCK_SUFFIX, '1', 5, noreply=False,
+                      callback=self.stop)
+        self.wait()
+        self.pool.get_or_compute('key', lambda callback: callback('fresh'),
+                                 60, callback=self.stop)
+        result = self.wait()
+        self.pool.delete('key' + memcache.LOCK_SUFFIX, noreply=False,
+                         callback=self.stop)
+        self.wait()
+        self.assertEqual(result, b'stale')
@@ -0,0 +1,122 @@
+#-*- mode: python; coding: utf-8 -*-
+
+"""
+Buffered counters
+"""
+
+# tornado testing stuff
+from torncache import client as memcache
+from torncache.counters import Counters
+from torncache.test.util import ServerTestCase
+
+
+class CountersTest(ServerTestCase):
+
+    def setUp(self):
+        super(CountersTest, self).setUp()
+        self.counters = Counters(self.pool, interval=0.01)
+
+    def test_aggregate(self):
+        self.pool.set('hits', '10', noreply=False, callback=self.stop)
+        self.wait()
+        for i in range(100):
+            self.counters.incr('hits')
+        self.counters.decr('hits', 20)
+        self.counters.incr('new', 5)
+        self.assertEqual(self.counters.pending, 2)
+        self.counters.close(callback=self.stop)
+        self.assertTrue(self.wait())
+        self.assertEqual(self.counters.pending, 0)
+        self.assertEqual(self.counters.stats['flushes'], 1)
+        self.assertEqual(self.counters.stats['created'], 1)
+        self.pool.get_many(['hits', 'new'], callback=self.stop)
+        self.assertEqual(self.wait(), {'hits': b'90', 'new': b'5'})
+
+    def test_interval(self):
+        self.counters.incr('key', 3)
+        self.io_loop.add_timeout(self.io_loop.time() + 0.05, self.stop)
+        self.wait()
+        self.assertEqual(self.counters.pending, 0)
+        self.pool.get('key', callback=self.stop)
+        self.assertEqual(self.wait(), b'3')
+
+    def test_max_keys(self):
+        self.counters.max_keys = 3
+        self.counters.incr('key1')
+        self.counters.incr('key2')
+        self.assertEqual(self.counters.pending, 2)
+        self.counters.incr('key3')
+        self.assertEqual(self.counters.pending, 0)
+
+    def test_read_your_writes(self):
+        self.counters.incr('key', 2)
+        self.counters.flush(callback=self.stop)
+        self.wait()
+        self.counters.incr('key', 5)
+        self.counters.incr('other', 1)
+        self.counters.decr('gone', 1)
+        self.counters.get('key', callback=self.stop)
+        self.assertEqual(self.wait(), 7)
+        self.counters.get_many(['key', 'other', 'gone'], callback=self.stop)
+        self.assertEqual(self.wait(), {'key': 7, 'other': 1})
+        self.pool.get('key', callback=self.stop)
+        self.assertEqual(self.wait(), b'2')
+
+    def test_read_waits_for_flush(self):
+        self.counters.incr('key', 2)
+        self.counters.flush()
+        # may run on another connection of the pool than the flush
+        self.counters.get('key', callback=self.stop)
+        self.assertEqual(self.wait(), 2)
+        self.counters.incr('key', 1)
+        self.counters.flush()
+        self.counters.get_many(['key'], callback=self.stop)
+        self.assertEqual(self.wait(), {'key': 3})
+        self.assertEqual(self.counters._sending, {})
+
+    def test_not_a_number(self):
+        self.pool.set('text', 'abc', noreply=False, callback=self.stop)
+        self.wait()
+        self.counters.incr('text')
+        self.counters.incr('hits', 3)
+        self.counters.flush(callback=self.stop)
+        self.assertTrue(self.wait())
+        # only the bad key is dropped
+        self.assertEqual(self.counters.stats['lost'], 1)
+        self.assertEqual(self.counters.stats['created'], 1)
+        self.pool.get_many(['text', 'hits'], callback=self.stop)
+        self.assertEqual(self.wait(), {'text': b'abc', 'hits': b'3'})
+
+    def test_lost_decrements(self):
+        self.counters.decr('gone', 2)
+        self.counters.flush(callback=self.stop)
+        self.assertTrue(self.wait())
+        self.assertEqual(self.counters.stats['lost'], 1)
+        self.assertEqual(self.counters.stats['created'], 0)
+        self.pool.get('gone', callback=self.stop)
+        self.assertEqual(self.wait(), None)
+
+    def test_pinned_keys(self):
+        self.counters.incr((0, 'key'))
+        self.counters.incr('key')
+        self.assertEqual(self.counters.pending, 1)
+        self.counters.get((0, 'key'), callback=self.stop)
+        self.assertEqual(self.wait(), 2)
+        self.counters.flush(callback=self.stop)
+        self.wait()
+        self.pool.get((0, 'key'), callback=self.stop)
+        self.assertEqual(self.wait(), b'2')
+
+    def test_update_servers(self):
+        server, address = self.add_server()
+        self.pool.update_servers(address, callback=self.stop)
+        self.wait()
+        self.counters.incr('key', 3)
+        self.counters.close(callback=self.stop)
+        self.wait()
+        self.assertIn(b'key', server.items)
+
+    def test_illegal_key(self):
+        with self.assertRaises(memcache.MemcacheIllegalInputError):
+            self.counters.incr('a key')
+        self.assertEqual(self.counters.pending, 0)
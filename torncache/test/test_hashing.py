@@ -0,0 +1,64 @@
+#-*- mode: python; coding: utf-8 -*-
+
+"""
+Hashing
+"""
+
+import zlib
+
+from tornado.test.util import unittest
+from torncache import hashing
+
+
+class HashingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = ['key:{0}'.format(i) for i in range(2000)]
+        self.buckets = ['a', 'b', 'b', 'c']
+
+    def test_crc32(self):
+        self.assertEqual(hashing.crc32('key'), zlib.crc32(b'key') & 0xffffffff)
+
+    def test_fnv1a(self):
+        self.assertEqual(hashing.fnv1a_32(''), 0x811c9dc5)
+        self.assertEqual(hashing.fnv1a_32('a'), 0xe40c292c)
+        self.assertEqual(hashing.fnv1a_32('foobar'), 0xbf9cf968)
+
+    def test_murmur3(self):
+        self.assertEqual(hashing.murmur3_32(''), 0)
+        self.assertEqual(hashing.murmur3_32('', seed=1), 0x514e28b7)
+        self.assertEqual(hashing.murmur3_32('hello'), 0x248bfa47)
+        self.assertEqual(hashing.murmur3_32('hello, world'), 0x149bbb7f)
+
+    def test_get_hasher(self):
+        self.assertTrue(hashing.get_hasher('fnv1a') is hashing.fnv1a_32)
+        self.assertRaises(ValueError, hashing.get_hasher, 'md4')
+
+    def test_partition(self):
+        servers = hashing.partition(self.keys, self.buckets)
+        self.assertEqual(sorted(servers), ['a', 'b', 'c'])
+        for server, keys in servers.items():
+            for key in keys:
+                self.assertEqual(
+                    self.buckets[hashing.crc32(key) % 4], server)
+        self.assertEqual(sum(len(keys) for keys in servers.values()), 2000)
+
+    def test_partition_forced(self):
+        servers = hashing.partition([(3, 'key')], self.buckets)
+        self.assertEqual(servers, {'c': ['key']})
+
+    @unittest.skipIf(hashing.numpy is None, "numpy not installed")
+    def test_partition_vectorized(self):
+        hasher = hashing.fnv1a_32
+        keys = self.keys + [u'unicode', b'bytes', 42]
+        hashes = hashing.VECTORIZED[hasher](keys).tolist()
+        self.assertEqual(hashes, [hasher(key) for key in keys])
+        vectorized = hashing.partition(keys, self.buckets, hasher)
+        hashing.NUMPY_THRESHOLD, threshold = 10 ** 6, hashing.NUMPY_THRESHOLD
+        try:
+            scalar = hashing.partition(keys, self.buckets, hasher)
+        finally:
+            hashing.NUMPY_THRESHOLD = threshold
+        self.assertEqual(vectorized, scalar)
+        # zlib crc32 is faster than any NumPy version of it
+        self.assertNotIn(hashing.crc32, hashing.VECTORIZED)
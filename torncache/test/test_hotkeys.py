@@ -0,0 +1,99 @@
+#-*- mode: python; coding: utf-8 -*-
+
+"""
+Hot keys
+"""
+
+# tornado testing stuff
+from tornado.ioloop import IOLoop
+from tornado.test.util import unittest
+from torncache import client as memcache
+from torncache.hotkeys import CountMinSketch, HotKeys
+from torncache.test.util import ServerTestCase
+
+
+class SketchTest(unittest.TestCase):
+
+    def test_estimate(self):
+        sketch = CountMinSketch(width=256, depth=4)
+        for i in range(100):
+            sketch.add('hot')
+            sketch.add('key:{0}'.format(i))
+        self.assertTrue(sketch.estimate('hot') >= 100)
+        self.assertTrue(sketch.estimate('key:1') < 100)
+
+    def test_decay(self):
+        sketch = CountMinSketch(width=16, depth=2)
+        sketch.add('key', 10)
+        sketch.decay(0.5)
+        self.assertEqual(sketch.estimate('key'), 5)
+
+
+class HotKeysTest(unittest.TestCase):
+
+    def test_top(self):
+        hot = HotKeys(size=2)
+        for key, times in (('a', 5), ('b', 1), ('c', 3), ('d', 2)):
+            for _ in range(times):
+                hot.record(key)
+        self.assertEqual([key for key, _ in hot.top()], ['a', 'c'])
+        self.assertEqual(hot.top(1), [('a', 5)])
+
+    def test_decay_on_ioloop(self):
+        io_loop = IOLoop()
+        hot = HotKeys(size=2, ioloop=io_loop)
+        hot._next_decay = 0
+        for _ in range(4):
+            hot.record('key')
+        # due decays don't run inline
+        self.assertEqual(hot.top(), [('key', 4)])
+        io_loop.add_callback(io_loop.stop)
+        io_loop.start()
+        io_loop.close()
+        self.assertEqual(hot.top(), [('key', 2)])
+
+    def test_mixed_keys(self):
+        hot = HotKeys(size=2, decay_interval=60)
+        for key in (1, 'a', b'b', (2, 'c'), 'a', 3):
+            hot.record(key)
+        self.assertEqual(hot.top(1), [('a', 2)])
+
+    def test_pin(self):
+        hot = HotKeys(size=1, pin_ttl=60)
+        hot.pin('key', 'value')
+        self.assertEqual(hot.pinned('key'), None)
+        hot.record('key')
+        hot.pin('key', 'value')
+        self.assertEqual(hot.pinned('key'), 'value')
+        hot.invalidate('key')
+        self.assertEqual(hot.pinned('key'), None)
+
+
+class ClientHotKeysTest(ServerTestCase):
+
+    def get_pool(self):
+        self.hot = HotKeys(size=4, pin_ttl=60)
+        return memcache.ClientPool(
+            self.address, ioloop=self.io_loop, hotkeys=self.hot)
+
+    def test_hot_keys(self):
+        self.pool.get_many(['key1', 'key2', 'key1'], callback=self.stop)
+        self.wait()
+        keys = self.pool.hot_keys()
+        self.assertEqual(keys[0][:2], ('key1', 2))
+        self.assertEqual(keys[0][2], self.address)
+
+    def test_pinned_get(self):
+        self.pool.set('key', 'value', noreply=False, callback=self.stop)
+        self.wait()
+        self.pool.get('key', callback=self.stop)
+        self.assertEqual(self.wait(), b'value')
+        hits = self.server.stats['get_hits']
+        self.pool.get_many(['key'], callback=self.stop)
+        self.assertEqual(self.wait(), {'key': b'value'})
+        self.assertEqual(self.server.stats['get_hits'], hits)
+        # writes drop local copies
+        self.pool.set('key', 'other', noreply=False, callback=self.stop)
+        self.wait()
+        self.pool.get('key', callback=self.stop)
+        self.assertEqual(self.wait(), b'other')
@@ -0,0 +1,85 @@
+#-*- mode: python; coding: utf-8 -*-
+
+"""
+Memoization
+"""
+
+# tornado testing stuff
+from tornado import gen, testing
+from torncache import client as memcache
+from torncache.memoize import Memoizer, make_key
+from torncache.test.util import ServerTestCase
+
+
+class MemoizeTest(ServerTestCase):
+
+    def setUp(self):
+        super(MemoizeTest, self).setUp()
+        self.memoize = Memoizer(self.pool)
+        self.calls = []
+
+        @self.memoize(ttl=60)
+        @gen.coroutine
+        def square(x):
+            self.calls.append(x)
+            raise gen.Return(x * x)
+        self.square = square
+
+    def test_make_key(self):
+        self.assertEqual(make_key('f', (1,), {'a': 1, 'b': 2}),
+                         make_key('f', (1,), {'b': 2, 'a': 1}))
+        self.assertNotEqual(make_key('f', (1,), {}), make_key('g', (1,), {}))
+
+    @testing.gen_test
+    def test_cached(self):
+        # computed and cached results are alike
+        for i in range(2):
+            result = yield self.square(3)
+            self.assertEqual((result, type(result)), (9, int))
+        self.assertEqual(self.calls, [3])
+        self.assertEqual(self.memoize.stats['hits'], 1)
+
+    @testing.gen_test
+    def test_concurrent_calls(self):
+        results = yield [self.square(2), self.square(2), self.square(4)]
+        self.assertEqual(results, [4, 4, 16])
+        self.assertEqual(sorted(self.calls), [2, 4])
+        self.assertEqual(self.memoize.stats['lookups'], 1)
+        self.assertEqual(self.memoize.stats['shared'], 1)
+
+    @testing.gen_test
+    def test_serializer(self):
+        def _ser(key, value):
+            return str(value), 1
+
+        def _des(key, value, flags):
+            return int(value)
+
+        pool = memcache.ClientPool(self.pool._servers, serializer=_ser,
+                                   deserializer=_des, ioloop=self.io_loop)
+        memoize = Memoizer(pool)
+        double = memoize(ttl=60, key='double:{0}'.format)(lambda x: x * 2)
+        self.assertEqual((yield double(3)), 6)
+        self.assertEqual((yield double(3)), 6)
+        self.assertEqual(memoize.stats['hits'], 1)
+        # stored with the client serializer, not pickled
+        self.assertEqual((yield gen.Task(self.pool.get, 'double:3')), b'6')
+
+    @testing.gen_test
+    def test_illegal_key(self):
+        @self.memoize(key=lambda x: 'bad key {0}'.format(x))
+        def bad(x):
+            return x
+
+        with self.assertRaises(memcache.MemcacheIllegalInputError):
+            yield bad(1)
+        self.assertEqual(self.memoize._inflight, {})
+
+    @testing.gen_test
+    def test_errors(self):
+        @self.memoize()
+        def fail():
+            raise ValueError("boom")
+
+        with self.assertRaises(ValueError):
+            yield fail()
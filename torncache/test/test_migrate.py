@@ -0,0 +1,121 @@
+#-*- mode: python; coding: utf-8 -*-
+
+"""
+Migration
+"""
+
+import time
+
+# tornado testing stuff
+from tornado.concurrent import TracebackFuture
+from torncache import client as memcache
+from torncache.migrate import Migration
+from torncache.test.util import ServerTestCase
+
+
+class MigrationTest(ServerTestCase):
+
+    server_count = 3
+
+    def setUp(self):
+        super(MigrationTest, self).setUp()
+        self.keys = ['key:{0}'.format(i) for i in range(50)]
+        for key in self.keys:
+            self.pool.set(key, key, expire=600, noreply=False,
+                          callback=self.stop)
+            self.wait()
+
+    def get_pool(self):
+        # the cluster before the migration
+        return memcache.ClientPool(self.addresses[:2], ioloop=self.io_loop)
+
+    def test_migrate(self):
+        migration = Migration(self.addresses[:2], self.addresses,
+                              batch=7, ioloop=self.io_loop)
+        migration.run(callback=self.stop)
+        stats = self.wait()
+        moved = [key for key in self.keys if migration.moves(key)]
+        self.assertTrue(moved)
+        self.assertEqual(stats['scanned'], 50)
+        self.assertEqual(stats['copied'], len(moved))
+        # keys live now where the new topology looks for them
+        new = memcache.ClientPool(self.addresses, ioloop=self.io_loop)
+        new.get_many(self.keys, callback=self.stop)
+        self.assertEqual(len(self.wait()), 50)
+        # and kept their deadline
+        servers = dict(zip(self.addresses, self.servers))
+        for key in moved:
+            item = servers[migration.owners(key)[1]].items[key.encode()]
+            self.assertTrue(time.time() < item.expire <= time.time() + 600)
+
+    def test_migrate_keys_with_rate(self):
+        migration = Migration(self.addresses[:2], self.addresses, batch=10,
+                              rate=1000, ioloop=self.io_loop)
+        migration.run(self.keys[:20], callback=self.stop)
+        stats = self.wait()
+        self.assertEqual(stats['scanned'], 20)
+        self.assertEqual(stats['copied'] + stats['missing'], stats['moved'])
+
+    def test_migrate_keys_with_default_expire(self):
+        migration = Migration(self.addresses[:2], self.addresses, batch=7,
+                              default_expire=300, ioloop=self.io_loop)
+        migration.run(self.keys, callback=self.stop)
+        stats = self.wait()
+        self.assertTrue(stats['moved'])
+        self.assertEqual(stats['copied'], stats['moved'])
+        self.assertEqual(stats['expired'], 0)
+        servers = dict(zip(self.addresses, self.servers))
+        for key in self.keys:
+            if migration.moves(key):
+                item = servers[migration.owners(key)[1]].items[key.encode()]
+                self.assertTrue(time.time() < item.expire <= time.time() + 300)
+
+    def test_migrate_envelopes(self):
+        migration = Migration(self.addresses[:2], self.addresses,
+                              ioloop=self.io_loop)
+        key = [key for key in self.keys if migration.moves(key)][0]
+        pool = memcache.ClientPool(self.addresses[:2], ioloop=self.io_loop)
+        envelope = memcache.Envelope('v', 0.25, time.time() + 60)
+        pool.set(key, envelope, expire=600, noreply=False,
+                 callback=self.stop)
+        self.wait()
+        servers = dict(zip(self.addresses, self.servers))
+        old = servers[migration.owners(key)[0]].items[key.encode()]
+        migration.run([key], callback=self.stop)
+        self.assertEqual(self.wait()['copied'], 1)
+        new = servers[migration.owners(key)[1]].items[key.encode()]
+        self.assertEqual((new.flags, new.value), (old.flags, old.value))
+        self.assertTrue(new.flags & memcache.ENVELOPE_FLAG)
+        # so the copy still refreshes early
+        new_pool = memcache.ClientPool(self.addresses, ioloop=self.io_loop)
+        new_pool.get_envelope(key, callback=self.stop)
+        copy = self.wait()
+        self.assertEqual(copy[:2], (b'v', 0.25))
+        self.assertAlmostEqual(copy.expiry, envelope.expiry, places=2)
+
+    def test_metadump_paused(self):
+        # the dump of a server waits for the futures on_record returns
+        records, futures = [], []
+
+        def on_record(record):
+            records.append(record)
+            if len(records) < 3:
+                futures.append(TracebackFuture())
+                return futures[-1]
+
+        def step():
+            self.io_loop.add_timeout(self.io_loop.time() + 0.01, self.stop)
+            self.wait()
+
+        client = memcache.Client(self.addresses[:1], ioloop=self.io_loop)
+        client.metadump(on_record)
+        step()
+        self.assertEqual(len(records), 1)
+        futures[-1].set_result(None)
+        step()
+        self.assertEqual(len(records), 2)
+        # without pauses the dump runs to the end
+        futures[-1].set_result(None)
+        step()
+        self.assertEqual(len(records),
+                         len(self.server.items))
@@ -0,0 +1,73 @@
+#-*- mode: python; coding: utf-8 -*-
+
+"""
+Namespaces
+"""
+
+# tornado testing stuff
+from torncache import client as memcache
+from torncache.namespace import Namespace
+from torncache.test.util import ServerTestCase
+
+
+class NamespaceTest(ServerTestCase):
+
+    def setUp(self):
+        super(NamespaceTest, self).setUp()
+        self.ns = Namespace(self.pool, 'user:42', ttl=60)
+
+    def test_transparent(self):
+        self.ns.set_many({'a': '1', 'b': '2'}, noreply=False,
+                         callback=self.stop)
+        self.assertEqual(self.wait(), {'a': True, 'b': True})
+        self.ns.get_many(['a', 'b', 'c'], callback=self.stop)
+        self.assertEqual(self.wait(), {'a': b'1', 'b': b'2'})
+        self.ns.get('a', callback=self.stop)
+        self.assertEqual(self.wait(), b'1')
+        # keys are stored with the generation
+        key = self.ns.key('a', self.ns._generation)
+        self.pool.get(key, callback=self.stop)
+        self.assertEqual(self.wait(), b'1')
+
+    def test_invalidate(self):
+        self.ns.set('a', '1', noreply=False, callback=self.stop)
+        self.wait()
+        generation = self.ns._generation
+        self.ns.invalidate(callback=self.stop)
+        self.assertEqual(self.wait(), generation + 1)
+        self.ns.get('a', callback=self.stop)
+        self.assertEqual(self.wait(), None)
+        # other namespaces are not affected
+        other = Namespace(self.pool, 'user:43')
+        other.set('a', '2', noreply=False, callback=self.stop)
+        self.wait()
+        Namespace(self.pool, 'user:42').invalidate()
+        other.get('a', callback=self.stop)
+        self.assertEqual(self.wait(), b'2')
+
+    def test_shared_lookups(self):
+        results = []
+        for i in range(5):
+            self.ns.generation(results.append)
+        self.ns.generation(self.stop)
+        generation = self.wait()
+        self.assertEqual(results, [generation] * 5)
+        # a second instance reads the same generation
+        Namespace(self.pool, 'user:42').generation(self.stop)
+        self.assertEqual(self.wait(), generation)
+
+    def test_bytes_keys(self):
+        generation = 7
+        self.assertEqual(self.ns.key(b'k', generation),
+                         self.ns.key('k', generation))
+        self.assertEqual(self.ns.key(b'k', generation), 'user:42:7:k')
+
+    def test_lookup_error(self):
+        ns = Namespace(self.pool, 'bad name')
+        callbacks = []
+        # later lookups fail too instead of waiting for the first one
+        for i in range(2):
+            self.assertRaises(memcache.MemcacheIllegalInputError,
+                              ns.generation, callbacks.append)
+        self.assertEqual(callbacks, [])
+        self.assertEqual(ns._waiters, None)
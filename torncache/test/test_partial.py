@@ -0,0 +1,67 @@
+#-*- mode: python; coding: utf-8 -*-
+
+"""
+Partial results
+"""
+
+# tornado testing stuff
+from tornado import testing
+from torncache import client as memcache
+from torncache.test.util import ServerTestCase
+
+
+class PartialResultsTest(ServerTestCase):
+
+    server_count = 2
+
+    def setUp(self):
+        super(PartialResultsTest, self).setUp()
+        servers = dict(zip(self.addresses, self.servers))
+        self.client = memcache.Client(self.pool._servers, ioloop=self.io_loop)
+        # a key on every server
+        self.keys = {}
+        for i in range(100):
+            key = 'key{0}'.format(i)
+            self.keys.setdefault(str(self.client._get_server(key)[0]), key)
+        fast, slow = [str(server) for server in self.client._servers]
+        self.fast, self.slow = self.keys[fast], self.keys[slow]
+        self.client.set_many({self.fast: 'fast', self.slow: 'slow'},
+                             noreply=False, callback=self.stop)
+        self.wait()
+        # the second server answers late from now on
+        servers[slow].latency = 0.2
+
+    def test_deadline(self):
+        self.client.get_many([self.fast, self.slow], callback=self.stop,
+                             deadline=self.io_loop.time() + 0.05)
+        self.assertEqual(self.wait(), {self.fast: b'fast'})
+        # late replies are dropped
+        self.io_loop.add_timeout(self.io_loop.time() + 0.3, self.stop)
+        self.wait()
+
+    def test_on_batch(self):
+        batches = []
+        self.client.get_many([self.fast, self.slow], callback=self.stop,
+                             on_batch=batches.append)
+        result = self.wait()
+        self.assertEqual(batches, [{self.fast: b'fast'}, {self.slow: b'slow'}])
+        self.assertEqual(result, {self.fast: b'fast', self.slow: b'slow'})
+
+    @testing.gen_test
+    def test_iter_many(self):
+        batches = self.client.iter_many([self.fast, self.slow, 'missing'])
+        received = []
+        while True:
+            batch = yield batches.next()
+            if batch is None:
+                break
+            received.append(batch)
+        self.assertEqual(received[0], {self.fast: b'fast'})
+        self.assertEqual(received[-1], {self.slow: b'slow'})
+
+    @testing.gen_test
+    def test_iter_many_pool(self):
+        batches = self.pool.iter_many([self.fast, self.slow],
+                                      deadline=self.io_loop.time() + 0.05)
+        self.assertEqual((yield batches.next()), {self.fast: b'fast'})
+        self.assertIsNone((yield batches.next()))
@@ -0,0 +1,107 @@
+#-*- mode: python; coding: utf-8 -*-
+
+"""
+Pool sizing
+"""
+
+# tornado testing stuff
+from torncache import client as memcache
+from torncache.test.util import ServerTestCase
+
+
+class PoolSizingTest(ServerTestCase):
+
+    def setUp(self):
+        super(PoolSizingTest, self).setUp()
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.close()
+        super(PoolSizingTest, self).tearDown()
+
+    def new_pool(self, **kwargs):
+        pool = memcache.ClientPool(self.address, ioloop=self.io_loop,
+                                   **kwargs)
+        self.pools.append(pool)
+        return pool
+
+    def sleep(self, secs):
+        self.io_loop.add_timeout(self.io_loop.time() + secs, self.stop)
+        self.wait()
+
+    def grow(self, pool, n):
+        """Run n concurrent commands, so the pool holds n clients"""
+        results = []
+        for i in range(n):
+            pool.get('key', callback=results.append)
+        while len(results) < n:
+            self.sleep(0.01)
+
+    def test_prewarm(self):
+        pool = self.new_pool(prewarm=2)
+        self.assertEqual(pool.pool_stats()['idle'], 2)
+        for client in pool._clients:
+            self.assertFalse(client._servers[0].closed())
+
+    def test_reuse_most_recent(self):
+        pool = self.new_pool()
+        self.grow(pool, 3)
+        last = pool._clients[-1]
+        pool.get('key', callback=self.stop)
+        self.wait()
+        self.assertIs(pool._clients[-1], last)
+
+    def test_idle_timeout(self):
+        pool = self.new_pool(min_size=1, idle_timeout=0.05)
+        self.grow(pool, 3)
+        self.assertEqual(pool.pool_stats()['idle'], 3)
+        self.sleep(0.2)
+        stats = pool.pool_stats()
+        self.assertEqual((stats['idle'], stats['reaped']), (1, 2))
+
+    def test_max_lifetime(self):
+        pool = self.new_pool(min_size=1, max_lifetime=0.05)
+        first = pool._clients[0]
+        self.sleep(0.2)
+        self.assertTrue(pool.pool_stats()['recycled'] >= 1)
+        self.assertEqual(len(pool._clients), 1)
+        self.assertIsNot(pool._clients[0], first)
+        self.assertTrue(first._servers[0].closed())
+        # expired clients in use are recycled when they are done
+        client = pool._clients[-1]
+        pool._ages[client][0] = 0
+        pool.get('key', callback=self.stop)
+        self.wait()
+        self.assertNotIn(client, pool._clients)
+
+    def test_split_get_many(self):
+        pool = self.new_pool(max_get_keys=10)
+        values = dict(('key{0}'.format(i), str(i).encode()) for i in range(35))
+        pool.set_many(values, noreply=False, callback=self.stop)
+        self.wait()
+        traces = []
+        pool.add_hook('complete', lambda event, trace: traces.append(trace))
+        pool.get_many(list(values) + ['missing'], callback=self.stop)
+        self.assertEqual(self.wait(), values)
+        # every chunk ran on its own client
+        self.assertEqual(sorted(trace.keys for trace in traces),
+                         [6, 10, 10, 10])
+        self.assertEqual(pool.pool_stats()['idle'], 4)
+
+    def test_split_get_many_unbounded(self):
+        # chunks beyond MAX_PARALLEL_GETS share clients
+        pool = self.new_pool(max_get_keys=1)
+        keys = ['key{0}'.format(i) for i in range(40)]
+        pool.get_many(keys, callback=self.stop)
+        self.assertEqual(self.wait(), {})
+        self.assertEqual(pool.pool_stats()['created'],
+                         memcache.MAX_PARALLEL_GETS)
+
+    def test_split_get_many_sized(self):
+        # chunks beyond the pool size run one after the other
+        pool = self.new_pool(size=2, max_get_bytes=20)
+        keys = ['key{0}'.format(i) for i in range(10)]
+        pool.get_many(keys, callback=self.stop)
+        self.assertEqual(self.wait(), {})
+        self.assertEqual(pool.pool_stats()['created'], 2)
@@ -0,0 +1,75 @@
+#-*- mode: python; coding: utf-8 -*-
+
+"""
+Stats
+"""
+
+# tornado testing stuff
+from tornado.test.util import unittest
+from torncache import stats
+from torncache.test.util import ServerTestCase
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_parse_slabs(self):
+        result = stats.parse_slabs(
+            {'1:chunk_size': 96, '2:chunk_size': 120, 'active_slabs': 2})
+        self.assertEqual(result['classes'][2], {'chunk_size': 120})
+        self.assertEqual(result['total'], {'active_slabs': 2})
+
+    def test_parse_items(self):
+        result = stats.parse_items({'items:5:evicted': 3, 'bogus': 1})
+        self.assertEqual(result, {5: {'evicted': 3}})
+
+    def test_snapshot(self):
+        first = stats.Snapshot({
+            'a': {'general': {'get_hits': 1, 'get_misses': 1, 'pid': 7},
+                  'items': {'items:1:evicted': 0}},
+            'b': {'general': {'get_hits': 2, 'get_misses': 0, 'pid': 9},
+                  'items': {'items:1:evicted': 2}},
+        }, timestamp=10)
+        self.assertEqual(first.total['general']['get_hits'], 3)
+        self.assertEqual(first.total['general']['pid'], 9)
+        self.assertEqual(first.total['items'], {1: {'evicted': 2}})
+        self.assertEqual(first.hit_ratio, 0.75)
+
+        second = stats.Snapshot({
+            'a': {'general': {'get_hits': 5, 'get_misses': 1, 'pid': 7},
+                  'items': {'items:1:evicted': 4}},
+        }, timestamp=12)
+        rates = second.rates(first)
+        self.assertEqual(rates['servers']['a']['general'],
+                         {'get_hits': 2.0, 'get_misses': 0.0})
+        self.assertEqual(rates['total']['items'], {1: {'evicted': 1.0}})
+        self.assertRaises(ValueError, first.rates, second)
+
+
+class ClusterStatsTest(ServerTestCase):
+
+    server_count = 2
+
+    def test_cluster_stats(self):
+        for key in ('key1', 'key2'):
+            self.pool.set(key, 'value', noreply=False, callback=self.stop)
+            self.wait()
+        self.pool.cluster_stats(callback=self.stop)
+        snapshot = self.wait()
+        self.assertEqual(len(snapshot.servers), 2)
+        self.assertEqual(snapshot.total['general']['curr_items'], 2)
+        self.assertEqual(snapshot.total['slabs']['classes'][1]['used_chunks'], 2)
+        self.assertEqual(snapshot.total['items'][1]['number'], 2)
+        self.assertTrue('maxconns' in snapshot.total['settings'])
+
+    def test_evictions(self):
+        self.pool.cluster_stats(callback=self.stop)
+        previous = self.wait()
+        self.assertEqual(previous.total['general']['evictions'], 0)
+        self.assertIs(previous.total['settings']['evictions'], True)
+        for server in self.servers:
+            server.stats['evictions'] += 5
+        self.pool.cluster_stats(kinds=('general',), callback=self.stop)
+        snapshot = self.wait()
+        self.assertEqual(snapshot.total['general']['evictions'], 10)
+        rates = snapshot.rates(previous)
+        self.assertTrue(rates['total']['general']['evictions'] > 0)
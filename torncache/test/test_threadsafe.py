@@ -0,0 +1,66 @@
+#-*- mode: python; coding: utf-8 -*-
+
+"""
+Thread-safe client
+"""
+
+import threading
+
+from tornado.ioloop import IOLoop
+from tornado.test.util import unittest
+
+from torncache import client as memcache
+from torncache.threadsafe import ThreadSafeClient, futures
+from torncache.benchmarks.server import start_server
+
+
+@unittest.skipIf(futures is None, "concurrent.futures is not available")
+class ThreadSafeClientTest(unittest.TestCase):
+
+    def setUp(self):
+        # the IOLoop runs on its own thread, tests act as workers
+        self.io_loop = IOLoop()
+        self.server, address = start_server(io_loop=self.io_loop)
+        self.pool = memcache.ClientPool(address, ioloop=self.io_loop)
+        self.client = ThreadSafeClient(self.pool)
+        self.thread = threading.Thread(target=self.io_loop.start)
+        self.thread.start()
+
+    def tearDown(self):
+        def stop():
+            self.server.stop()
+            self.io_loop.stop()
+        self.io_loop.add_callback(stop)
+        self.thread.join()
+        self.io_loop.close(all_fds=True)
+
+    def test_roundtrip(self):
+        future = self.client.set('key', 'value', noreply=False)
+        self.assertTrue(future.result(timeout=5))
+        self.assertEqual(self.client.get('key').result(timeout=5), b'value')
+        future = self.client.get_many(['key', 'other'])
+        self.assertEqual(future.result(timeout=5), {'key': b'value'})
+
+    def test_workers(self):
+        def work(i):
+            key = 'key{0}'.format(i)
+            self.client.set(key, str(i), noreply=False).result(timeout=5)
+            return self.client.get(key).result(timeout=5)
+
+        executor = futures.ThreadPoolExecutor(max_workers=8)
+        try:
+            results = list(executor.map(work, range(100)))
+        finally:
+            executor.shutdown()
+        self.assertEqual(results, [str(i).encode() for i in range(100)])
+        self.assertEqual(self.client.stats['submitted'], 200)
+        self.assertTrue(self.client.stats['batches'] <= 200)
+
+    def test_errors(self):
+        future = self.client.get('a key')
+        with self.assertRaises(memcache.MemcacheIllegalInputError):
+            future.result(timeout=5)
+        with self.assertRaises(TypeError):
+            self.client.get('key', callback=None)
+        with self.assertRaises(AttributeError):
+            self.client.unknown
@@ -0,0 +1,59 @@
+#-*- mode: python; coding: utf-8 -*-
+
+"""
+Topology changes
+"""
+
+# tornado testing stuff
+from torncache import client as memcache
+from torncache.test.util import ServerTestCase
+
+
+class UpdateServersTest(ServerTestCase):
+
+    server_count = 2
+
+    def setUp(self):
+        super(UpdateServersTest, self).setUp()
+        self.client = memcache.Client(self.addresses[:1], ioloop=self.io_loop)
+
+    def test_add_server(self):
+        first = self.client._servers[0]
+        self.client.set('key', 'value', noreply=False, callback=self.stop)
+        self.wait()
+        self.client.update_servers(
+            [self.addresses[0], (self.addresses[1], 2)], callback=self.stop)
+        self.assertEqual(self.wait(), [])
+        # the live connection is kept
+        self.assertIs(self.client._servers[0], first)
+        self.assertFalse(first.closed())
+        self.assertEqual(len(self.client._buckets), 3)
+        self.assertEqual(self.client._servers[1].weight, 2)
+        routed = self.client._route(['key{0}'.format(i) for i in range(50)])
+        self.assertEqual(len(routed), 2)
+
+    def test_remove_server(self):
+        self.client.update_servers(self.addresses, callback=self.stop)
+        self.wait()
+        removed = self.client._servers[1]
+        # a command queued on the removed server still completes
+        results = []
+        removed.store_cmd('set', 'key', 0, False, 'value',
+                          callback=results.append)
+        self.client.update_servers(self.addresses[:1], callback=self.stop)
+        self.assertEqual(self.wait(), [self.addresses[1]])
+        self.assertEqual(results, [True])
+        self.assertTrue(removed.closed())
+        self.assertEqual(self.client._buckets, self.client._servers)
+        self.assertEqual(len(self.client._servers), 1)
+
+    def test_pool(self):
+        pool = memcache.ClientPool(self.addresses, ioloop=self.io_loop)
+        pool.set('key', 'value', noreply=False, callback=self.stop)
+        self.wait()
+        client = pool._clients[0]
+        kept = client._find_server(self.addresses[0])
+        pool.update_servers(self.addresses[:1], callback=self.stop)
+        self.assertEqual(self.wait(), [self.addresses[1]])
+        self.assertEqual(client._servers, [kept])
+        self.assertEqual(pool._servers, [(self.addresses[0], 1)])
@@ -0,0 +1,105 @@
+#-*- mode: python; coding: utf-8 -*-
+
+"""
+Write-behind
+"""
+
+# tornado testing stuff
+from torncache import client as memcache
+from torncache.writebehind import WriteBehind
+from torncache.test.util import ServerTestCase
+
+
+class WriteBehindTest(ServerTestCase):
+
+    def setUp(self):
+        super(WriteBehindTest, self).setUp()
+        self.buffer = WriteBehind(self.pool, window=0.01)
+
+    def test_coalesce(self):
+        for i in range(10):
+            self.buffer.set('key', 'value{0}'.format(i))
+        self.buffer.set('other', 'value')
+        self.buffer.delete('other')
+        self.assertEqual(self.buffer.pending, 2)
+        self.assertEqual(self.buffer.stats['superseded'], 10)
+        self.buffer.close(callback=self.stop)
+        self.wait()
+        self.assertEqual(self.buffer.pending, 0)
+        self.assertEqual(self.buffer.stats['flushes'], 1)
+        self.pool.get_many(['key', 'other'], callback=self.stop)
+        self.assertEqual(self.wait(), {'key': b'value9'})
+
+    def test_window(self):
+        self.buffer.set_many({'key1': 'a', 'key2': 'b'}, callback=self.stop)
+        self.assertEqual(self.wait(), {'key1': True, 'key2': True})
+        self.io_loop.add_timeout(self.io_loop.time() + 0.05, self.stop)
+        self.wait()
+        self.assertEqual(self.buffer.pending, 0)
+        self.pool.get('key2', callback=self.stop)
+        self.assertEqual(self.wait(), b'b')
+
+    def test_limits(self):
+        self.buffer.max_bytes = 80
+        self.buffer.set('key1', 'x' * 40)
+        self.assertEqual(self.buffer.pending, 1)
+        self.buffer.set('key2', 'x' * 40)
+        self.assertEqual(self.buffer.pending, 0)
+
+    def test_shed_while_inflight(self):
+        self.buffer.max_bytes = 80
+        self.buffer.set('key1', 'x' * 40)
+        # reaching max_bytes sends everything, which waits for a connect
+        self.buffer.set('key2', 'x' * 40, callback=self.stop)
+        self.assertTrue(self.wait())
+        self.assertEqual(self.buffer.pending, 0)
+        self.buffer.set('key3', 'x' * 40, callback=self.stop)
+        self.assertEqual(self.wait(), False)
+        self.assertEqual(self.buffer.stats['shed'], 1)
+        # writes are accepted again once batches are written
+        self.io_loop.add_timeout(self.io_loop.time() + 0.05, self.stop)
+        self.wait()
+        self.buffer.set('key3', 'x' * 40, callback=self.stop)
+        self.assertTrue(self.wait())
+        self.buffer.close(callback=self.stop)
+        self.wait()
+        self.pool.get_many(['key1', 'key2', 'key3'], callback=self.stop)
+        self.assertEqual(len(self.wait()), 3)
+
+    def test_ordered_flushes(self):
+        def pipeline(ops, callback=None):
+            writing.append(ops)
+            self.assertEqual(len(writing), 1)
+
+            def on_written(result):
+                writing.remove(ops)
+                callback(result)
+            send(ops, callback=on_written)
+
+        send, writing = self.pool.pipeline, []
+        self.pool.pipeline = pipeline
+        self.buffer.set('key', 'first')
+        self.buffer.flush()
+        self.buffer.set('key', 'second')
+        self.buffer.flush(callback=self.stop)
+        self.wait()
+        self.io_loop.add_timeout(self.io_loop.time() + 0.05, self.stop)
+        self.wait()
+        self.assertEqual(self.buffer.stats['flushes'], 2)
+        self.pool.get('key', callback=self.stop)
+        self.assertEqual(self.wait(), b'second')
+
+    def test_update_servers(self):
+        server, address = self.add_server()
+        self.pool.update_servers(address, callback=self.stop)
+        self.wait()
+        self.buffer.set('key', 'value')
+        self.buffer.close(callback=self.stop)
+        self.wait()
+        self.pool.get('key', callback=self.stop)
+        self.assertEqual(self.wait(), b'value')
+        self.assertIn(b'key', server.items)
+
+    def test_illegal_key(self):
+        with self.assertRaises(memcache.MemcacheIllegalInputError):
+            self.buffer.delete('a key')
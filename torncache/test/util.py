@@ -0,0 +1,51 @@
+#-*- mode: python; coding: utf-8 -*-
+
+"""
+Shared test fixtures
+"""
+
+# tornado testing stuff
+from tornado import testing
+from torncache import client as memcache
+from torncache.benchmarks.server import start_server
+
+
+class ServerTestCase(testing.AsyncTestCase):
+    """
+    Runs each test against fake memcached servers on the test IOLoop.
+
+    server_count servers are started, and stopped after the test, with
+    the arguments of get_server_args(). self.servers and self.addresses
+    hold them, self.server and self.address the first one, and self.pool
+    is the pool returned by get_pool().
+    """
+
+    server_count = 1
+
+    def setUp(self):
+        super(ServerTestCase, self).setUp()
+        self.servers, self.addresses = [], []
+        for i in range(self.server_count):
+            self.add_server(**self.get_server_args())
+        self.server, self.address = self.servers[0], self.addresses[0]
+        self.pool = self.get_pool()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        super(ServerTestCase, self).tearDown()
+
+    def get_server_args(self):
+        """Arguments of the servers started for every test"""
+        return {}
+
+    def get_pool(self):
+        """Pool of the test, by default a ClientPool of every server"""
+        return memcache.ClientPool(self.addresses, ioloop=self.io_loop)
+
+    def add_server(self, **kwargs):
+        """Start one more server, stopped with the others"""
+        server, address = start_server(io_loop=self.io_loop, **kwargs)
+        self.servers.append(server)
+        self.addresses.append(address)
+        return server, address
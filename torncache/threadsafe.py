@@ -0,0 +1,92 @@
+# -*- mode: python; coding: utf-8 -*-
+
+"""
+Thread-safe client
+
+Lets threads other than the IOLoop one, like ThreadPoolExecutor workers,
+use a Client or ClientPool. Commands are handed to the IOLoop with
+add_callback and results come back as concurrent.futures.Future
+instances. Submissions arriving while a batch is pending are run by the
+same loop callback. Requires the "futures" backport on python 2.
+"""
+
+import threading
+import functools
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+from tornado import stack_context
+
+from torncache.client import Client
+
+
+class ThreadSafeClient(object):
+    """
+    Run commands of a client on its IOLoop from any thread.
+
+    Args:
+      client: a Client or ClientPool. It must only be used from the
+              IOLoop thread, or through this object.
+      ioloop: optional IOLoop, the one the client runs on.
+
+    Every Client command is available with the same arguments except
+    callback, and returns a Future. Never wait for a Future on the
+    IOLoop thread, as it would block the loop that resolves it.
+    """
+
+    def __init__(self, client, ioloop=None):
+        if futures is None:
+            raise ImportError("ThreadSafeClient requires concurrent.futures")
+        self._client = client
+        self._ioloop = ioloop or client._ioloop
+        self._lock = threading.Lock()
+        self._batch = []
+        self.stats = dict.fromkeys(('submitted', 'batches'), 0)
+
+    def __getattr__(self, name):
+        if not name.startswith('_') and hasattr(Client, name):
+            return functools.partial(self.submit, name)
+        raise AttributeError(name)
+
+    def submit(self, cmd, *args, **kwargs):
+        """
+        Queue a command for the IOLoop.
+
+        Returns:
+          A Future resolved with the command result, or with its error.
+        """
+        if 'callback' in kwargs:
+            raise TypeError("Results are returned through a Future")
+        future = futures.Future()
+        with self._lock:
+            self._batch.append((cmd, args, kwargs, future))
+            self.stats['submitted'] += 1
+            # a single loop callback per batch
+            schedule = len(self._batch) == 1
+        if schedule:
+            self._ioloop.add_callback(self._run_batch)
+        return future
+
+    def _run_batch(self):
+        with self._lock:
+            batch, self._batch = self._batch, []
+            self.stats['batches'] += 1
+        for cmd, args, kwargs, future in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            on_error = functools.partial(self._on_error, future)
+            with stack_context.ExceptionStackContext(on_error):
+                kwargs['callback'] = functools.partial(self._on_result, future)
+                getattr(self._client, cmd)(*args, **kwargs)
+
+    @staticmethod
+    def _on_result(future, result=None, **kwargs):
+        future.done() or future.set_result(result)
+
+    @staticmethod
+    def _on_error(future, typ, value, tb):
+        future.done() or future.set_exception(value)
+        return True
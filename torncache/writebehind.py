@@ -0,0 +1,192 @@
+# -*- mode: python; coding: utf-8 -*-
+
+"""
+Write-behind buffer
+
+Coalesces sets and deletes issued in quick succession. Writes are kept
+per server for a short window, a later write to a key replaces any
+pending one, and each server buffer is then sent as a single pipelined
+batch of noreply commands.
+"""
+
+import time
+import functools
+
+from tornado import stack_context
+
+from torncache.hashing import text_type
+
+
+def _size(key, value=None):
+    """Estimated bytes of a buffered write"""
+    size = len(key) if isinstance(key, (bytes, text_type)) else 16
+    if value is None:
+        return size
+    if isinstance(value, (bytes, text_type)):
+        return size + len(value)
+    return size + len(str(value))
+
+
+def _notify(callbacks, result):
+    for callback in callbacks:
+        callback and callback(result)
+
+
+class WriteBehind(object):
+    """
+    Buffer sets and deletes of a client.
+
+    Args:
+      client: a Client or a ClientPool.
+      window: optional float, seconds writes are held before being sent.
+      batch_size: optional int, bytes after which a server buffer is sent
+                  without waiting for the window to end.
+      max_bytes: optional int, bytes buffered or being written across all
+                 servers. When reached, every buffer is flushed right
+                 away, and while batches sent before haven't been written
+                 yet, new writes are shed: their callback gets False.
+
+    Batches of a server are sent one after the other, even through a
+    ClientPool, so a write never overtakes an earlier one of the same key.
+    As with noreply commands, a successful callback doesn't guarantee the
+    write reached memcached. Sizes are estimated from keys and values
+    before serialization. Call close() on shutdown to flush pending
+    writes.
+    """
+
+    def __init__(self, client, window=0.05, batch_size=64 * 1024,
+                 max_bytes=4 * 1024 * 1024, ioloop=None):
+        self._client = client
+        self._ioloop = ioloop or client._ioloop
+        self.window = window
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        # server address -> {key: (op, size)} and address -> buffered bytes
+        self._buffers = {}
+        self._sizes = {}
+        self._bytes = 0
+        # bytes of batches sent but not written to their socket yet
+        self._inflight = 0
+        # server address -> callbacks of flushes waiting for its batch
+        # being written
+        self._writing = {}
+        self._timeout = None
+        self.stats = dict.fromkeys(
+            ('writes', 'superseded', 'flushes', 'shed'), 0)
+
+    @property
+    def pending(self):
+        """Number of buffered writes"""
+        return sum(len(buf) for buf in self._buffers.values())
+
+    def _enqueue(self, key, op, size, callback):
+        address = self._client.address_of(key)
+        if address is None:
+            callback and callback(None)
+            return
+        buf = self._buffers.setdefault(address, {})
+        previous = buf.get(key)
+        freed = previous[1] if previous is not None else 0
+        if self._inflight and \
+                self._inflight + self._bytes + size - freed > self.max_bytes:
+            # memcached is behind, so flushing wouldn't free anything
+            self.stats['shed'] += 1
+            callback and callback(False)
+            return
+        if previous is not None:
+            self.stats['superseded'] += 1
+            self._account(address, -freed)
+        buf[key] = (op, size)
+        self._account(address, size)
+        self.stats['writes'] += 1
+        # flush as soon as limits are reached
+        if self._bytes >= self.max_bytes:
+            self.flush()
+        elif self._sizes[address] >= self.batch_size:
+            self._flush_server(address)
+        elif self._timeout is None:
+            self._timeout = self._ioloop.add_timeout(
+                time.time() + self.window, stack_context.wrap(self.flush))
+        callback and callback(True)
+
+    def _account(self, address, size):
+        self._sizes[address] = self._sizes.get(address, 0) + size
+        self._bytes += size
+
+    def set(self, key, value, expire=0, callback=None):
+        """Buffer a "set" command. See Client.set"""
+        self._enqueue(key, ('set', key, value, expire), _size(key, value),
+                      callback)
+
+    def set_many(self, values, expire=0, callback=None):
+        """Buffer many "set" commands. See Client.set_many"""
+        retval = {}
+        for key, value in values.items():
+            self.set(key, value, expire,
+                     callback=functools.partial(retval.__setitem__, key))
+        callback and callback(retval)
+
+    def delete(self, key, callback=None):
+        """Buffer a "delete" command. See Client.delete"""
+        self._enqueue(key, ('delete', key, None, 0), _size(key), callback)
+
+    def delete_many(self, keys, callback=None):
+        """Buffer many "delete" commands. See Client.delete_many"""
+        retval = {}
+        for key in keys:
+            self.delete(key, callback=functools.partial(
+                retval.__setitem__, key))
+        callback and callback(retval)
+
+    def _flush_server(self, address, callback=None):
+        def on_written(result):
+            self._inflight -= size
+            waiting = self._writing.pop(address)
+            callback and callback(result)
+            if waiting:
+                self._flush_server(
+                    address, functools.partial(_notify, waiting))
+
+        if address in self._writing:
+            # pooled clients may use different connections, so the next
+            # batch of a server waits for the previous one to be written
+            self._writing[address].append(callback)
+            return
+        buf = self._buffers.pop(address, None)
+        if not buf:
+            callback and callback(True)
+            return
+        size = self._sizes.pop(address, 0)
+        self._bytes -= size
+        self._inflight += size
+        self._writing[address] = []
+        self.stats['flushes'] += 1
+        self._client.pipeline([op for op, _ in buf.values()],
+                              callback=stack_context.wrap(on_written))
+
+    def flush(self, callback=None):
+        """
+        Send every buffered write.
+
+        Returns:
+          True once all batches have been written to their sockets.
+        """
+        def on_flush(address, result):
+            pending.discard(address)
+            if not pending:
+                callback and callback(True)
+
+        if self._timeout is not None:
+            self._ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+        pending = set(self._buffers)
+        if not pending:
+            callback and callback(True)
+            return
+        for address in list(pending):
+            cb = stack_context.wrap(functools.partial(on_flush, address))
+            self._flush_server(address, callback=cb)
+
+    def close(self, callback=None):
+        """Flush pending writes. Call it on shutdown"""
+        self.flush(callback)